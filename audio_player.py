@@ -2,13 +2,22 @@ import discord
 import logging
 import asyncio
 import functools
+import time
 
 import utils.misc as misc
-from utils.ytdlp import Yt_Dlp
-from utils.timed_audio import TimedAudio
+import utils.config as config
+import utils.pcm_effects as pcm_effects
+from utils.timed_audio import TimedAudioMixin, create_timed_audio
+from utils.metrics import GuildMetrics, get_elapsed_ms
+from utils.metadata_cache import get_url_expiry
+from utils.audio_cache import get_cache_key
+from utils.queue_store import QueueStore, serialize_entry, deserialize_entry
+from utils.command_actor import CommandActor, Command
+from utils.resolver import PlaylistReader
+from utils.ffmpeg_budget import BudgetExhausted, PLAYING, PREROLL, PREFETCH, SPECULATIVE
 from utils.configure_logger import ConfigureLogger
 from entry import Entry, AudioMetadata, MessageInformation
-from audio_queue import AudioQueueLinkedList
+from audio_queue import AudioQueue
 
 # retrieve class logger and configure logger
 logger = logging.getLogger(__name__)
@@ -19,11 +28,11 @@ def async_func(func):
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
         try:
-            logger.info(f'Calling {func.__name__}')
+            logger.info('Calling %s', func.__name__)
             return await func(*args, **kwargs)
 
         except Exception as e:
-            logger.error(f'Error in {func.__name__}: {e}')
+            logger.error('Error in %s: %s', func.__name__, e)
     
     return wrapper
 
@@ -31,14 +40,291 @@ def async_func(func):
 # one audio player instance per guild
 class AudioPlayer():
     MAX_RESULTS = 5
+    SEEK_SECONDS = 10
 
-    def __init__(self, client:discord.Client):
+    # stream urls expiring within this many seconds are resolved again before they play
+    RESOLVE_MARGIN = 60
+
+    # a stream that fails within this many seconds of the song's end is treated as finished
+    FAILOVER_END_MARGIN = 5
+
+    def __init__(self, client:discord.Client, guild_id:int=0, metrics:GuildMetrics=None):
         self.client = client
+        self.guild_id = guild_id
+        self.metrics = metrics or GuildMetrics(guild_id)
         self.voice_client = None
-        self.yt_dlp = Yt_Dlp()
-        self.audio_queue = AudioQueueLinkedList()
+        self.audio_queue = AudioQueue()
         self.entry_buffer = None
 
+        # send opus streams to discord without decoding and re-encoding them
+        self.opus_passthrough = config.get_bool('OPUS_PASSTHROUGH', True)
+
+        # number of queued entries whose timed audio is started ahead of time
+        self.prefetch_depth = config.get_int('PREFETCH_DEPTH', 1)
+
+        # the next entry's first frames are read into memory shortly before the current entry ends
+        self.preroll_lead_time = config.get_float('PREROLL_LEAD_TIME', 5)
+        self.preroll_frames = config.get_int('PREROLL_FRAMES', 50)
+        self.preroll_task = None
+        self.track_ended_time = None
+
+        # volume, loudness normalization and crossfades applied to the pcm frames, None without numpy
+        # streams are decoded to pcm instead of passed through while an effect is on
+        # a crossfade can't be longer than the preroll lead time, the next song isn't prerolled before it
+        self.effects = None
+        if pcm_effects.is_available():
+            self.effects = pcm_effects.EffectsStage(
+                volume=config.get_int('VOLUME', 100) / 100
+                , normalize=config.get_bool('NORMALIZE', False)
+                , crossfade=misc.clamp(config.get_float('CROSSFADE', 0), 0, self.preroll_lead_time)
+            )
+
+        # time.monotonic() of the last command or playing frame, the client evicts players idle for too long
+        self.last_active_time = time.monotonic()
+
+        # a restored or interrupted entry starts at resume_time when it plays next, if it is still at the front
+        self.resume_entry = None
+        self.resume_time = 0
+
+        # what the queue store last saved, compared to skip saving unchanged queues
+        self.saved_queue_version = None
+        self.saved_playback = False
+        self.loading_saved = False
+
+        # entry -> task resolving its stream url, so an entry is only resolved once at a time
+        self.resolve_tasks = {}
+
+        # playlists are queued page by page in the background
+        self.playlist_page_size = config.get_int('PLAYLIST_PAGE_SIZE', 100)
+        self.playlist_max_entries = config.get_int('PLAYLIST_MAX_ENTRIES', 5000)
+        self.playlist_task = None
+
+        # webpage url -> timed audio of a top search result started and prerolled while the user chooses a result
+        # it is used if that result is played, and stopped otherwise
+        self.speculative_prebuffer = config.get_bool('SPECULATIVE_PREBUFFER', True)
+        self.speculative_sources = {}
+
+        # queued entries whose stream urls expire within the refresh margin are resolved again in the background
+        self.url_refresh_depth = config.get_int('URL_REFRESH_DEPTH', 10)
+        self.url_refresh_margin = config.get_float('URL_REFRESH_MARGIN', 600)
+
+        # a song whose stream fails is restarted where it stopped this many times before it is skipped
+        self.max_failovers = config.get_int('MAX_FAILOVERS', 3)
+        self.failovers = 0
+
+        # set from the moment a track is stopped or ends until the job loading the next entry runs
+        # skips coalesced behind a skip that stopped the track count against the queue in the meantime
+        self.track_change_pending = False
+
+        # the guild's commands and track changes run one at a time on this queue
+        # \play and \add resolve their audio before they are queued so a search doesn't hold up the other commands
+        self.commands = CommandActor(
+            guild_id
+            , self.run_command
+            , self.prepare_command
+            , prepared_commands=('\\play', '\\add')
+            , max_pending=config.get_int('COMMAND_QUEUE_SIZE', 20)
+            , rate=config.get_float('COMMAND_RATE', 1)
+            , burst=config.get_int('COMMAND_BURST', 5)
+            , metrics=self.metrics
+        )
+
+    def touch(self):
+        self.last_active_time = time.monotonic()
+
+    def is_playing(self) -> bool:
+        return bool(self.voice_client and self.voice_client.is_playing())
+
+    # seconds since the player was last used, a playing player is never idle
+    def get_idle_time(self) -> float:
+        if self.is_playing():
+            self.touch()
+            return 0
+
+        return time.monotonic() - self.last_active_time
+
+    # disconnects from the voice channel and stops every ffmpeg process the player started
+    # the queue keeps its metadata so the player can be used again
+    async def close(self):
+        if self.preroll_task:
+            self.preroll_task.cancel()
+            self.preroll_task = None
+
+        if self.playlist_task:
+            self.playlist_task.cancel()
+            self.playlist_task = None
+
+        self.commands.close()
+        for url in list(self.speculative_sources):
+            self.discard_speculative_source(url)
+
+        # the after function doesn't load the next entry once the voice client is unset
+        voice_client = self.voice_client
+        self.voice_client = None
+        self.track_change_pending = False
+        if voice_client:
+            logger.info('Disconnecting idle voice client from %s', voice_client.channel)
+            voice_client.stop()
+            await voice_client.disconnect()
+
+        # the interrupted entry goes back to the front of the queue and continues where it stopped on the next play
+        if self.entry_buffer and self.entry_buffer.timed_audio:
+            self.requeue_entry_buffer(self.entry_buffer.timed_audio.get_elapsed_time())
+
+        if self.entry_buffer:
+            self.release_timed_audio(self.entry_buffer)
+            self.entry_buffer = None
+
+        for entry in self.audio_queue.peek(self.prefetch_depth):
+            self.release_timed_audio(entry)
+
+    def requeue_entry_buffer(self, position:float):
+        self.audio_queue.insert(1, self.entry_buffer.audio_metadata, self.entry_buffer.message_information)
+        self.resume_entry = self.audio_queue.find_entry(1)
+        self.resume_time = position
+
+    # position the front entry of the queue starts at
+    def get_resume_time(self) -> float:
+        front_entries = self.audio_queue.peek(1)
+        return self.resume_time if front_entries and front_entries[0] is self.resume_entry else 0
+
+    # queues the guild's saved entries, the saved playing entry goes first and resumes at its saved position
+    # entries whose text channel no longer exists are dropped
+    def restore(self, guild:discord.Guild, entries:list, resume_time:float=0, playback:tuple=None):
+        if playback:
+            entry, resume_time, _ = playback
+            entries = [entry] + entries
+
+        lookups = {}
+        restored_entries = [restored_entry for restored_entry in (deserialize_entry(entry, self.client, guild, lookups) for entry in entries) if restored_entry]
+        self.audio_queue.enqueue_many(restored_entries)
+        if resume_time and restored_entries:
+            self.resume_entry = self.audio_queue.find_entry(1)
+            self.resume_time = resume_time
+
+        # the store already holds this queue unless the playing entry was moved into it
+        if not playback:
+            self.saved_queue_version = self.audio_queue.version
+
+        logger.info('Restored %s of %s entries, resuming at %ss', len(restored_entries), len(entries), resume_time)
+        return len(restored_entries)
+
+    # queues reading the guild's saved queue as the new player's first job, so the guild's commands run on the restored queue
+    # snapshots wait until it was read, the still empty queue would overwrite the saved one
+    def load_saved(self, guild:discord.Guild, queue_store:QueueStore) -> asyncio.Future:
+        self.loading_saved = True
+        return self.commands.queue_job(self.restore_saved, guild, queue_store)
+
+    # reads the saved queue off the event loop, the read flushes the store's pending writes
+    async def restore_saved(self, guild:discord.Guild, queue_store:QueueStore):
+        loop = asyncio.get_running_loop()
+        try:
+            entries, resume_time, playback = await loop.run_in_executor(None, queue_store.load, self.guild_id)
+            self.restore(guild, entries, resume_time, playback)
+
+        except Exception as e:
+            logger.error('Could not restore the saved queue of guild %s: %s', self.guild_id, e)
+
+        finally:
+            self.loading_saved = False
+
+    # (serialized entry, position, voice channel id) of the playing or paused entry, None otherwise
+    def get_playback_snapshot(self) -> tuple:
+        if not self.voice_client or not self.entry_buffer or not self.entry_buffer.timed_audio:
+            return None
+
+        if not (self.voice_client.is_playing() or self.voice_client.is_paused()):
+            return None
+
+        return serialize_entry(self.entry_buffer), self.entry_buffer.timed_audio.get_elapsed_time(), self.voice_client.channel.id
+
+    # hands the queue (when it changed) and the playing position to the store, which writes them later
+    def save_snapshot(self, queue_store:QueueStore):
+        if self.loading_saved:
+            return
+
+        if self.audio_queue.version != self.saved_queue_version:
+            queue_store.save_queue(self.guild_id, [serialize_entry(entry) for entry in self.audio_queue.iter_entries()], self.get_resume_time())
+            self.saved_queue_version = self.audio_queue.version
+
+        playback = self.get_playback_snapshot()
+        if playback or self.saved_playback:
+            queue_store.save_playback(self.guild_id, playback)
+            self.saved_playback = playback is not None
+
+    # restored entries may hold a stream url that has expired since it was resolved
+    # entries in the audio cache play from the local file and don't need their url
+    def needs_resolution(self, entry:Entry, margin:float=RESOLVE_MARGIN) -> bool:
+        if self.client.audio_cache and self.client.audio_cache.contains(get_cache_key(entry.audio_metadata)):
+            return False
+
+        url = entry.audio_metadata[AudioMetadata.URL.value]
+        if not url:
+            return True
+
+        expiry = get_url_expiry(url)
+        return expiry is not None and expiry - margin < time.time()
+
+    # replaces the entry's audio metadata with freshly resolved metadata
+    # the prefetch and the player can ask for the same entry, they share one resolution
+    # use_cache=False resolves the url even if the metadata cache holds it, for urls that stopped working
+    async def resolve_entry(self, entry:Entry, use_cache:bool=True):
+        task = self.resolve_tasks.get(entry)
+        if task is None:
+            logger.info('Resolving %s', entry.audio_metadata[AudioMetadata.TITLE.value])
+            task = asyncio.create_task(self.client.resolver.extract(self.guild_id, entry.audio_metadata[AudioMetadata.WEBPAGE_URL.value], use_cache))
+            task.add_done_callback(lambda _: self.resolve_tasks.pop(entry, None))
+            self.resolve_tasks[entry] = task
+
+        audio_metadata = await asyncio.shield(task)
+        if not audio_metadata:
+            raise ValueError(f'No audio found at {entry.audio_metadata[AudioMetadata.WEBPAGE_URL.value]}')
+
+        entry.audio_metadata = audio_metadata
+
+    # starts resolving the next queued entries whose stream urls expire within the refresh margin
+    # entries with a running timed audio already hold their connection, entries without a url are resolved when they are prefetched
+    # called periodically by the client, returns the number of entries being refreshed
+    def refresh_entries(self) -> int:
+        refreshed = 0
+        for entry in self.audio_queue.peek(self.url_refresh_depth):
+            if entry.timed_audio or entry in self.resolve_tasks or not entry.audio_metadata[AudioMetadata.URL.value]:
+                continue
+
+            if self.needs_resolution(entry, self.url_refresh_margin):
+                asyncio.create_task(self.refresh_entry(entry))
+                refreshed += 1
+
+        return refreshed
+
+    # skips the metadata cache, it can hold the same url that is about to expire until its own margin runs out
+    async def refresh_entry(self, entry:Entry):
+        try:
+            await self.resolve_entry(entry, use_cache=False)
+            self.metrics.increment('urls_refreshed_total')
+
+        except Exception as e:
+            logger.error('Error refreshing %s: %s', entry.audio_metadata[AudioMetadata.TITLE.value], e)
+
+    # resolves an entry in the prefetch horizon in the background, then starts its timed audio if it is still there
+    async def resolve_and_prefetch_entry(self, entry:Entry):
+        try:
+            await self.resolve_entry(entry)
+
+        except Exception as e:
+            logger.error('Error resolving %s: %s', entry.audio_metadata[AudioMetadata.TITLE.value], e)
+            return
+
+        if self.is_playing() and entry in self.audio_queue.peek(self.prefetch_depth):
+            self.load_timed_audio(entry, self.get_resume_time() if entry is self.resume_entry else 0, PREFETCH)
+
+    # connects to the saved voice channel and continues the restored queue
+    @async_func
+    async def resume_playback(self, channel:discord.VoiceChannel):
+        logger.info('Resuming playback in %s', channel)
+        self.voice_client = await channel.connect()
+        await self.load_entry_buffer()
+
     @async_func
     async def handle_voice_state_update(self, member:discord.Member, before: discord.VoiceState, after:discord.VoiceState):
         if before.channel is None and after.channel:
@@ -47,6 +333,7 @@ class AudioPlayer():
 
         if before.channel and after.channel is None:
             self.voice_client = None
+            self.track_change_pending = False
 
     @async_func
     async def retrieve_audio_metadata(self, message:discord.message) -> tuple:
@@ -58,82 +345,464 @@ class AudioPlayer():
             return None
         
         # check if the content is a url and retrieve content accordingly
+        # yt-dlp runs on the client's resolver so the event loop isn't blocked
+        # urls are extracted directly instead of searched for, which also works for urls outside youtube
         if misc.validate_url(content):
-            logger.info(f'Validated "{content}" as a url')
+            logger.info('Validated "%s" as a url', content)
+
+            try:
+                audio_metadata = await self.client.resolver.extract(message.guild.id, content)
 
-            audio_metadata = self.yt_dlp.retrieve(content)[0]
+            except asyncio.TimeoutError:
+                await message.channel.send(f'Retrieving "{content}" timed out.')
+                return None
 
         else:
-            logger.info(f'Invalidated "{content}" as a url')
+            logger.info('Invalidated "%s" as a url', content)
 
             await message.channel.send(f'Searching for "{content}"')
-            audio_metadatas = self.yt_dlp.retrieve(content, self.MAX_RESULTS)
 
-            printable = f'Choose a result:\n'
-            for cnt in range(1, len(audio_metadatas) + 1):
-                printable += f'{cnt}. {audio_metadatas[cnt - 1][AudioMetadata.TITLE.value]}\n'
+            try:
+                flat_metadatas = await self.client.resolver.search(message.guild.id, content, self.MAX_RESULTS)
+
+            except asyncio.TimeoutError:
+                await message.channel.send(f'Searching for "{content}" timed out.')
+                return None
+
+            if not flat_metadatas:
+                await message.channel.send(f'No results found.')
+                return None
+
+            # show the search titles right away and extract every result in the background
+            # the message is edited in place as each result's full metadata arrives
+            urls = [flat_metadata[AudioMetadata.WEBPAGE_URL.value] for flat_metadata in flat_metadatas]
+            tasks = self.client.resolver.extract_all(message.guild.id, urls)
+            results_message = await message.channel.send(self.get_results_printable(flat_metadatas, tasks))
+            results_updater = asyncio.create_task(self.update_results_message(results_message, flat_metadatas, tasks))
+            speculation = asyncio.create_task(self.prebuffer_result(tasks[0])) if self.speculative_prebuffer else None
+            choice = 0
 
-            await message.channel.send(f'{printable}')
-            
             try:
                 msg = await self.client.wait_for('message', check=lambda m: m.author == message.author and m.channel == message.channel, timeout=30)
                 msg_content = msg.content
-                if msg_content.isdigit() and int(msg_content) > 0 and int(msg_content) <= self.MAX_RESULTS:
-                    audio_metadata = audio_metadatas[int(msg_content) - 1]
-                
+                if msg_content.isdigit() and int(msg_content) > 0 and int(msg_content) <= len(tasks):
+                    choice = int(msg_content) - 1
+
                 else:
+                    choice = None
                     await message.channel.send(f'Invalid input.')
-                    return
-            
+                    return None
+
             except asyncio.TimeoutError:
-                logger.info(f'Response timed out, returning first entry')
-                audio_metadata = audio_metadatas[0]
+                logger.info('Response timed out, returning first entry')
                 await message.channel.send(f'Respond faster.')
 
-        logger.info(f'Audio metadata retrieved: {audio_metadata}')
+            finally:
+                results_updater.cancel()
+                if speculation and choice != 0:
+                    speculation.cancel()
+                    if tasks[0].done() and not tasks[0].cancelled() and not tasks[0].exception() and tasks[0].result():
+                        self.discard_speculative_source(tasks[0].result()[AudioMetadata.WEBPAGE_URL.value])
+
+                for idx, task in enumerate(tasks):
+                    if idx != choice:
+                        task.cancel()
+
+            try:
+                audio_metadata = await tasks[choice]
+
+            except Exception as e:
+                logger.error('Error extracting result %s: %s', choice + 1, e)
+                await message.channel.send(f'Could not retrieve {flat_metadatas[choice][AudioMetadata.TITLE.value]}.')
+                return None
+
+        logger.info('Audio metadata retrieved: %s', audio_metadata)
         return audio_metadata
     
+    # starts the timed audio of the top search result and reads its first frames while the user is choosing
+    # the first result is picked, or played when the choice times out, most of the time
+    async def prebuffer_result(self, task:asyncio.Task):
+        try:
+            audio_metadata = await task
+
+        except Exception:
+            return
+
+        if not audio_metadata:
+            return
+
+        if not self.client.ffmpeg_budget.try_admit(SPECULATIVE):
+            self.metrics.increment('ffmpeg_deferred_total')
+            return
+
+        logger.info('Prebuffering %s', audio_metadata[AudioMetadata.TITLE.value])
+        timed_audio = self.create_timed_audio(audio_metadata, priority=SPECULATIVE)
+        self.discard_speculative_source(audio_metadata[AudioMetadata.WEBPAGE_URL.value])
+        self.speculative_sources[audio_metadata[AudioMetadata.WEBPAGE_URL.value]] = timed_audio
+        self.metrics.increment('speculations_total')
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, timed_audio.preroll, self.preroll_frames)
+
+    # stops the prebuffered timed audio of a search result that won't be played
+    def discard_speculative_source(self, url:str):
+        timed_audio = self.speculative_sources.pop(url, None)
+        if timed_audio:
+            logger.info('Discarding prebuffered audio of %s', url)
+            timed_audio.cleanup()
+
+    # lists the search results, marking the ones that haven't been extracted yet
+    def get_results_printable(self, flat_metadatas:list[tuple], tasks:list[asyncio.Task]) -> str:
+        printable = f'Choose a result:\n'
+        for cnt, (flat_metadata, task) in enumerate(zip(flat_metadatas, tasks), start=1):
+            if not task.done():
+                status = ' (loading)'
+
+            elif task.cancelled() or task.exception():
+                status = ' (unavailable)'
+
+            else:
+                status = f' [{task.result()[AudioMetadata.DURATION.value]}]'
+
+            printable += f'{cnt}. {flat_metadata[AudioMetadata.TITLE.value]}{status}\n'
+
+        return printable
+
+    # edits the results message each time more results finish extracting
+    async def update_results_message(self, results_message:discord.Message, flat_metadatas:list[tuple], tasks:list[asyncio.Task]):
+        try:
+            async for _ in self.client.resolver.iter_completed(tasks):
+                await results_message.edit(content=self.get_results_printable(flat_metadatas, tasks))
+
+        except Exception as e:
+            logger.error('Error updating results message: %s', e)
+
+    # returns the local file of the audio if it's in the audio cache, otherwise its stream url
+    def get_audio_source(self, audio_metadata:tuple) -> str:
+        if self.client.audio_cache:
+            path = self.client.audio_cache.lookup(get_cache_key(audio_metadata))
+            if path:
+                logger.info('Audio cache hit for %s', audio_metadata[AudioMetadata.TITLE.value])
+                return path
+
+        return audio_metadata[AudioMetadata.URL.value]
+
+    # creates the entry's timed audio if it hasn't been created yet, which starts its ffmpeg process
+    # opus streams skip the decode/encode step when passthrough is enabled
+    # starts ffmpeg for the audio at start_time (in seconds), recording to the guild's metrics and applying its effects
+    # in broadcast mode guilds playing the same audio from the same time share one ffmpeg process, unless their effects are on
+    # the process is counted by the client's ffmpeg budget at priority, what it is started for
+    def create_timed_audio(self, audio_metadata:tuple, start_time:float=0, priority:int=PLAYING) -> TimedAudioMixin:
+        effects_active = self.effects and self.effects.is_active()
+        if self.client.broadcasts and not effects_active:
+            timed_audio = self.client.broadcasts.subscribe(
+                self.get_audio_source(audio_metadata)
+                , start_time
+                , codec=audio_metadata[AudioMetadata.ACODEC.value]
+                , passthrough=self.opus_passthrough
+                , priority=priority
+            )
+
+        else:
+            timed_audio = create_timed_audio(
+                self.get_audio_source(audio_metadata)
+                , start_time
+                , codec=audio_metadata[AudioMetadata.ACODEC.value]
+                , passthrough=self.opus_passthrough and not effects_active
+                , budget=self.client.ffmpeg_budget
+                , priority=priority
+            )
+
+        timed_audio.metrics = self.metrics
+        timed_audio.effects = self.effects
+        return timed_audio
+
+    # whether loading the entry's timed audio at start_time starts an ffmpeg process
+    def needs_process(self, entry:Entry, start_time:float=0) -> bool:
+        if entry.timed_audio:
+            return entry.timed_audio.start_time != start_time
+
+        return start_time != 0 or entry.audio_metadata[AudioMetadata.WEBPAGE_URL.value] not in self.speculative_sources
+
+    # entries loaded ahead of time (priority other than PLAYING) aren't loaded when the ffmpeg budget has no process left for them, None is returned
+    def load_timed_audio(self, entry:Entry, start_time:float=0, priority:int=PLAYING) -> TimedAudioMixin:
+        if priority != PLAYING and self.needs_process(entry, start_time) and not self.client.ffmpeg_budget.try_admit(priority):
+            self.metrics.increment('ffmpeg_deferred_total')
+            return None
+
+        if entry.timed_audio and entry.timed_audio.start_time != start_time:
+            self.release_timed_audio(entry)
+
+        # a search result prebuffered while the user was choosing is already running
+        if not entry.timed_audio and start_time == 0 and entry.audio_metadata[AudioMetadata.WEBPAGE_URL.value] in self.speculative_sources:
+            logger.info('Using prebuffered audio for %s', entry.audio_metadata[AudioMetadata.TITLE.value])
+            entry.timed_audio = self.speculative_sources.pop(entry.audio_metadata[AudioMetadata.WEBPAGE_URL.value])
+            self.metrics.increment('speculation_hits_total')
+
+        if not entry.timed_audio:
+            logger.info('Loading timed audio for %s', entry.audio_metadata[AudioMetadata.TITLE.value])
+            entry.timed_audio = self.create_timed_audio(entry.audio_metadata, start_time, priority)
+
+        return entry.timed_audio
+
+    # waits for the ffmpeg budget to let another song start
+    # when no process is available in time the channel is told and False is returned
+    async def wait_for_process(self, channel:discord.TextChannel, title:str) -> bool:
+        try:
+            if await self.client.ffmpeg_budget.wait():
+                self.metrics.increment('ffmpeg_queued_total')
+
+        except BudgetExhausted as e:
+            self.metrics.increment('ffmpeg_rejected_total')
+            logger.warning('Could not start %s: %s', title, e)
+            await channel.send(f'Too many songs are playing on this bot right now, {title} could not start. Try again in a moment.')
+            return False
+
+        return True
+
+    # stops the entry's ffmpeg process if its timed audio was created but won't be played
+    def release_timed_audio(self, entry:Entry):
+        if entry.timed_audio:
+            logger.info('Releasing timed audio for %s', entry.audio_metadata[AudioMetadata.TITLE.value])
+            entry.timed_audio.cleanup()
+            entry.timed_audio = None
+
+    # only the next few entries in the queue hold a timed audio
+    # playlist and restored entries are resolved once they come within this horizon, not when they are queued
+    def prefetch_entries(self):
+        for entry in self.audio_queue.peek(self.prefetch_depth):
+            if self.needs_resolution(entry):
+                if entry not in self.resolve_tasks:
+                    asyncio.create_task(self.resolve_and_prefetch_entry(entry))
+
+            else:
+                self.load_timed_audio(entry, self.get_resume_time() if entry is self.resume_entry else 0, PREFETCH)
+
+    # waits until the current entry is about to end, then prerolls the next entry in the queue
+    async def preroll_next_entry(self, timed_audio:TimedAudioMixin, duration:float):
+        while duration - timed_audio.get_elapsed_time() > self.preroll_lead_time:
+            await asyncio.sleep(max(duration - timed_audio.get_elapsed_time() - self.preroll_lead_time, 0.5))
+
+        next_entries = self.audio_queue.peek(1)
+        if not next_entries:
+            return
+
+        try:
+            if self.needs_resolution(next_entries[0]):
+                await self.resolve_entry(next_entries[0])
+
+            # without a process to spare the next entry starts its ffmpeg process when it plays
+            next_timed_audio = self.load_timed_audio(next_entries[0], self.get_resume_time(), PREROLL)
+            if not next_timed_audio:
+                logger.info('Not prerolling %s, the ffmpeg budget is exhausted', next_entries[0].audio_metadata[AudioMetadata.TITLE.value])
+                return
+
+            loop = asyncio.get_running_loop()
+            frame_count = await loop.run_in_executor(None, next_timed_audio.preroll, self.preroll_frames)
+            logger.info('Prerolled %s frames of %s', frame_count, next_entries[0].audio_metadata[AudioMetadata.TITLE.value])
+
+            # both songs have to be pcm to be mixed, the crossfade can't start before the next song is prerolled
+            if self.effects and self.effects.crossfade > 0 and not timed_audio.is_opus() and not next_timed_audio.is_opus():
+                length = min(self.effects.crossfade, self.preroll_lead_time)
+                timed_audio.start_crossfade(next_timed_audio, duration - length, length)
+
+        # the entry can be removed from the queue while it's being prerolled
+        except Exception as e:
+            logger.error('Error in preroll_next_entry: %s', e)
+
+    # replaces the preroll task of the previous timed audio with one for the playing timed audio
+    def start_preroll_task(self, timed_audio:TimedAudioMixin):
+        if self.preroll_task:
+            self.preroll_task.cancel()
+
+        duration = self.entry_buffer.audio_metadata[AudioMetadata.DURATION.value]
+        if duration:
+            self.preroll_task = asyncio.create_task(self.preroll_next_entry(timed_audio, duration))
+
+    # called from the voice thread with the time the new entry's first frame was read
+    def log_track_gap(self, first_frame_time:float):
+        if self.track_ended_time is None:
+            return
+
+        gap = (first_frame_time - self.track_ended_time) * 1000
+        self.metrics.observe('track_gap_ms', gap)
+        logger.info('Inter-track gap: %.1fms', gap)
+        self.track_ended_time = None
+
+    # releases entries that were reordered out of the prefetch window and prefetches the new ones
+    def update_prefetched_entries(self, prefetched_entries:list[Entry]):
+        next_entries = self.audio_queue.peek(self.prefetch_depth)
+        for entry in prefetched_entries:
+            if entry not in next_entries:
+                self.release_timed_audio(entry)
+
+        if self.voice_client and self.voice_client.is_playing():
+            self.prefetch_entries()
+
     @async_func
     async def load_entry_buffer(self):        
-        self.entry_buffer = self.audio_queue.dequeue()
+        self.failovers = 0
+        self.track_change_pending = False
 
-        if self.entry_buffer:
-            logger.info(f'Dequeued entry with {self.entry_buffer.audio_metadata} and {self.entry_buffer.message_information} from queue')
-            await self.play_entry_buffer()
+        # entries that can't be resolved are skipped until one resolves or the queue is empty
+        while True:
+            start_time = self.get_resume_time()
+
+            # discord.py cleans the finished source up only after the after function returned, its process is released before the next one starts
+            if self.entry_buffer:
+                self.release_timed_audio(self.entry_buffer)
+
+            self.entry_buffer = self.audio_queue.dequeue()
+            if self.entry_buffer is self.resume_entry:
+                self.resume_entry = None
+
+            if not self.entry_buffer:
+                logger.info('No more entries to dequeue')
+                return
+
+            logger.info('Dequeued entry with %s and %s from queue', self.entry_buffer.audio_metadata, self.entry_buffer.message_information)
+            if not self.needs_resolution(self.entry_buffer):
+                break
+
+            try:
+                await self.resolve_entry(self.entry_buffer)
+                break
+
+            except Exception as e:
+                logger.error('Error resolving %s, skipping it: %s', self.entry_buffer.audio_metadata[AudioMetadata.TITLE.value], e)
+
+        # the entry goes back to the front of the queue when no ffmpeg process is available, the next \play starts it
+        if self.needs_process(self.entry_buffer, start_time):
+            channel = self.entry_buffer.message_information[MessageInformation.CHANNEL.value]
+            if not await self.wait_for_process(channel, self.entry_buffer.audio_metadata[AudioMetadata.TITLE.value]):
+                self.release_timed_audio(self.entry_buffer)
+                self.requeue_entry_buffer(start_time)
+                self.entry_buffer = None
+                return
+
+        self.load_timed_audio(self.entry_buffer, start_time)
+        self.prefetch_entries()
+        await self.play_entry_buffer()
+
+    # queues a page of an imported playlist and starts the queue unless something is playing already
+    # run on the command queue by the background playlist import so the page can't land in the middle of another command
+    async def enqueue_playlist_page(self, flat_metadatas:list[tuple], message_information:tuple) -> int:
+        enqueued = self.audio_queue.enqueue_many([(flat_metadata, message_information) for flat_metadata in flat_metadatas])
+        await self.play_queue()
+        return enqueued
+
+    async def play_queue(self):
+        if not self.voice_client:
+            return
+
+        if self.voice_client.is_playing() or self.voice_client.is_paused():
+            self.prefetch_entries()
 
         else:
-            logger.info(f'No more entries to dequeue')
+            await self.load_entry_buffer()
 
+    # restarts the playing entry where its stream failed, with a freshly resolved stream url
+    # the next entry is loaded instead once the entry has failed max_failovers times
     @async_func
-    async def play_entry_buffer(self, start_time:float=0):
+    async def failover_entry_buffer(self, timed_audio:TimedAudioMixin):
+        self.track_change_pending = False
+        entry = self.entry_buffer
+        if not self.voice_client or not entry or entry.timed_audio is not timed_audio or self.failovers >= self.max_failovers:
+            await self.load_entry_buffer()
+            return
+
+        self.failovers += 1
+        self.metrics.increment('failovers_total')
+        position = timed_audio.get_elapsed_time()
+        logger.warning('Stream of %s failed at %.1fs, restarting it (attempt %s)', entry.audio_metadata[AudioMetadata.TITLE.value], position, self.failovers)
+
+        # a local file from the audio cache is opened again as is
+        if timed_audio.is_remote():
+            try:
+                await self.resolve_entry(entry, use_cache=False)
+
+            except Exception as e:
+                logger.error('Error resolving %s again, skipping it: %s', entry.audio_metadata[AudioMetadata.TITLE.value], e)
+                await self.load_entry_buffer()
+                return
+
+        # the failed process is released before waiting for a new one
+        self.release_timed_audio(entry)
+        if not await self.wait_for_process(entry.message_information[MessageInformation.CHANNEL.value], entry.audio_metadata[AudioMetadata.TITLE.value]):
+            self.requeue_entry_buffer(position)
+            self.entry_buffer = None
+            return
+
+        self.load_timed_audio(entry, position)
+        await self.play_entry_buffer(announce=False)
+
+    # announce=False restarts the entry without sending a message, e.g. after a failover
+    @async_func
+    async def play_entry_buffer(self, start_time:float=0, announce:bool=True):
         title = self.entry_buffer.audio_metadata[AudioMetadata.TITLE.value]
         # duration = self.entry_buffer.audio_metadata[AudioMetadata.DURATION.value]
 
         author = self.entry_buffer.message_information[MessageInformation.AUTHOR.value]
         channel = self.entry_buffer.message_information[MessageInformation.CHANNEL.value]
-        logger.info(f'Playing {title} requested by {author} in channel {channel}')
+        logger.info('Playing %s requested by %s in channel %s', title, author, channel)
         #  with duration {duration},
 
         def load_entry_buffer_sync(error:Exception=None):
+            self.track_ended_time = time.perf_counter()
+            self.touch()
             if error:
-                logger.error(f'Error in previous play_entry_buffer function: {error}')
+                logger.error('Error in previous play_entry_buffer function: %s', error)
 
             if not self.voice_client:
                 return
 
-            coro = self.load_entry_buffer()
+            self.track_change_pending = True
+
+            # a stream that failed before the song's end is restarted where it stopped instead of being skipped
+            # a seek may have replaced the source the entry started with
+            timed_audio = self.entry_buffer.timed_audio if self.entry_buffer else None
+            duration = self.entry_buffer.audio_metadata[AudioMetadata.DURATION.value] if self.entry_buffer else None
+            failed = timed_audio and timed_audio.ended_abnormally() and not (duration and timed_audio.get_elapsed_time() >= duration - self.FAILOVER_END_MARGIN)
+
+            # the next entry is loaded on the command queue so it can't interleave with a command
+            coro = self.commands.run(self.failover_entry_buffer, timed_audio) if failed else self.commands.run(self.load_entry_buffer)
             fut = asyncio.run_coroutine_threadsafe(coro, self.client.loop)
             
             try:
                 fut.result()
 
             except Exception as e:
-                logger.error(f'Error in load_entry_buffer_sync function: {e}')
+                logger.error('Error in load_entry_buffer_sync function: %s', e)
 
-        await channel.send(f'Playing {title}.')
+        # start playing before sending the message so the message doesn't add to the gap between entries
+        # in broadcast mode a source started ahead of time joins or starts a broadcast once it plays
         source = self.entry_buffer.timed_audio
+        if self.client.broadcasts and not (self.effects and self.effects.is_active()):
+            source = self.client.broadcasts.promote(source)
+            if source is not self.entry_buffer.timed_audio:
+                source.metrics = self.metrics
+                source.effects = self.effects
+                self.entry_buffer.timed_audio = source
+
+        source.on_first_frame = self.log_track_gap
+        self.client.ffmpeg_budget.promote(source.get_process_source())
         self.voice_client.play(source=source, after=load_entry_buffer_sync)
 
+        # played tracks are downloaded in the background so later plays don't stream them again
+        # a restarted track isn't counted as another play
+        if self.client.audio_cache:
+            cache_key = get_cache_key(self.entry_buffer.audio_metadata)
+            if announce:
+                self.client.audio_cache.count_play(cache_key, not source.is_remote())
+
+            if source.is_remote():
+                self.client.audio_cache.download(cache_key, self.entry_buffer.audio_metadata[AudioMetadata.WEBPAGE_URL.value])
+
+        self.start_preroll_task(source)
+
+        if announce:
+            await channel.send(f'Playing {title}.')
+
     def get_entry_buffer_printable(self) -> str:
         title = self.entry_buffer.audio_metadata[AudioMetadata.TITLE.value]
         duration = self.entry_buffer.audio_metadata[AudioMetadata.DURATION.value]
@@ -142,6 +811,85 @@ class AudioPlayer():
         printable = f'Now playing: {title} [{elapsed_time}/{duration}]'
         return printable
     
+    # runs a command taken off the command queue
+    async def run_command(self, command:Command):
+        message = command.message
+        match command.name:
+            case '\\hello':
+                await message.channel.send(f'Hello.')
+
+            case '\\join':
+                await self.join_voice_channel(message)
+
+            case '\\leave':
+                await self.leave_voice_channel(message)
+
+            case '\\play':
+                await self.play(message, command.argument)
+
+            case '\\playlist':
+                await self.playlist(message)
+
+            case '\\pause':
+                await self.pause(message)
+
+            case '\\resume':
+                await self.resume(message)
+
+            case '\\skip':
+                await self.skip(message, command.count)
+
+            case '\\seek':
+                await self.seek(message)
+
+            case '\\forward':
+                await self.forward(message)
+
+            case '\\rewind':
+                await self.rewind(message)
+
+            case '\\nowplaying':
+                await self.now_playing(message)
+
+            case '\\stats':
+                await self.stats(message)
+
+            case '\\list':
+                await self.list(message)
+
+            case '\\add':
+                await self.add(message, command.argument)
+
+            case '\\remove':
+                await self.remove(message)
+
+            case '\\move':
+                await self.move(message)
+
+            case '\\shuffle':
+                await self.shuffle(message)
+
+            case '\\volume':
+                await self.volume(message)
+
+            case '\\normalize':
+                await self.normalize(message)
+
+            case '\\crossfade':
+                await self.crossfade(message)
+
+        # a command's own run time doesn't count as idle time
+        self.touch()
+
+    # resolves the audio of a \play or \add before the command is queued, returns None if there is none
+    async def prepare_command(self, name:str, message:discord.message) -> tuple:
+        received_time = time.perf_counter()
+        audio_metadata = await self.retrieve_audio_metadata(message)
+        if audio_metadata and name == '\\play':
+            self.metrics.observe('play_resolve_ms', get_elapsed_ms(received_time))
+
+        return audio_metadata
+
     # sends the bot to the voice channel
     @async_func
     async def join_voice_channel(self, message:discord.message) -> discord.voice_client:
@@ -151,7 +899,7 @@ class AudioPlayer():
 
         # check if the user is in a voice channel
         if not channel:
-            logger.info(f'User not in voice channel')
+            logger.info('User not in voice channel')
 
             await message.channel.send(f'Join a voice channel.')
             return None
@@ -160,11 +908,11 @@ class AudioPlayer():
 
         # check if a voice client exists
         if not voice_client:
-            logger.info(f'Joining voice channel {channel}')
+            logger.info('Joining voice channel %s', channel)
             voice_client = await channel.connect()
 
         else:
-            logger.info(f'Already connected to a voice channel, Moving to {channel}')
+            logger.info('Already connected to a voice channel, Moving to %s', channel)
             await voice_client.move_to(channel)
 
         return voice_client
@@ -174,15 +922,21 @@ class AudioPlayer():
     async def leave_voice_channel(self, message:discord.message):
         # check if the voice client is connected to a channel
         if self.voice_client:
-            logger.info(f'Disconnecting from voice channel {self.voice_client.channel}')
+            logger.info('Disconnecting from voice channel %s', self.voice_client.channel)
             await self.voice_client.disconnect()
 
+            # queued entries keep their metadata, their ffmpeg processes are started again on the next play
+            for entry in self.audio_queue.peek(self.prefetch_depth):
+                self.release_timed_audio(entry)
+
         else:
-            logger.info(f'Voice client not connected to any voice channel')
+            logger.info('Voice client not connected to any voice channel')
 
     # sends the audio stream to the audio buffer to be played
+    # audio_metadata is the audio the command queue already resolved, it is retrieved here otherwise
     @async_func
-    async def play(self, message:discord.message):
+    async def play(self, message:discord.message, audio_metadata:tuple=None):
+        received_time = time.perf_counter()
         await self.join_voice_channel(message)
 
         if self.voice_client:
@@ -191,29 +945,39 @@ class AudioPlayer():
                 await self.load_entry_buffer()
                 return
 
-            audio_metadata = await self.retrieve_audio_metadata(message)
+            if not audio_metadata:
+                audio_metadata = await self.retrieve_audio_metadata(message)
+                if audio_metadata:
+                    self.metrics.observe('play_resolve_ms', get_elapsed_ms(received_time))
+
             message_information = MessageInformation.retrieve_message_information(message)
-            timed_audio = TimedAudio(audio_metadata[AudioMetadata.URL.value], 0)
 
             if audio_metadata and message_information:
-                self.entry_buffer = Entry(audio_metadata, message_information, timed_audio)
-                logger.info("Calling play_entry_buffer from play function")
-                await self.play_entry_buffer()
+                entry = Entry(audio_metadata, message_information, None)
+                if not self.needs_process(entry) or await self.wait_for_process(message.channel, audio_metadata[AudioMetadata.TITLE.value]):
+                    self.entry_buffer = entry
+                    self.load_timed_audio(self.entry_buffer)
+                    logger.info("Calling play_entry_buffer from play function")
+                    await self.play_entry_buffer()
+
+        # a prebuffered search result that didn't play is stopped
+        if audio_metadata:
+            self.discard_speculative_source(audio_metadata[AudioMetadata.WEBPAGE_URL.value])
 
     # pauses the audio stream
     @async_func
     async def pause(self, message:discord.message):
         # check if the voice client is connected to a voice channel
         if not self.voice_client:
-            logger.info(f'Voice client not connected to any voice channel')
+            logger.info('Voice client not connected to any voice channel')
             return
         
         # check if the voice client is streaming
         if not self.voice_client.is_playing():
-            logger.info(f'Voice client not playing')
+            logger.info('Voice client not playing')
             return
             
-        logger.info(f'Voice client paused')
+        logger.info('Voice client paused')
         await message.channel.send(f'Paused.')
         self.voice_client.pause()
 
@@ -222,34 +986,138 @@ class AudioPlayer():
     async def resume(self, message:discord.message):
         # check if the voice client is connected to a voice channel
         if not self.voice_client:
-            logger.info(f'Voice client not connected to any voice channel')
+            logger.info('Voice client not connected to any voice channel')
             return
         
         # check if the voice client is paused
         if not self.voice_client.is_paused():
-            logger.info(f'Voice client not paused')
+            logger.info('Voice client not paused')
             return
         
-        logger.info(f'Voice client resumed')
+        logger.info('Voice client resumed')
         await message.channel.send(f'Resumed.')
         self.voice_client.resume()
 
-    # skips the currently playing audio
+    # skips the currently playing audio and the count - 1 entries queued after it
     @async_func
-    async def skip(self, message:discord.message):
+    async def skip(self, message:discord.message, count:int=1):
         # check if the voice client is connected to a voice channel
         if not self.voice_client:
-            logger.info(f'Voice client not connected to any voice channel')
+            logger.info('Voice client not connected to any voice channel')
             return
         
+        # the track was stopped by a skip or ended and the next entry isn't loaded yet
+        # these skips skip the entries the next load would play instead of the stopped track
+        if self.track_change_pending:
+            prefetched_entries = self.audio_queue.peek(self.prefetch_depth)
+            skipped = 0
+            while skipped < count and self.audio_queue.dequeue():
+                skipped += 1
+
+            self.update_prefetched_entries(prefetched_entries)
+            logger.info('Skipped %s queued entries before the next entry loaded', skipped)
+            if skipped:
+                await message.channel.send(f'Skipped.' if skipped == 1 else f'Skipped {skipped} entries.')
+
+            return
+
         # check if the voice client is playing
         if not self.voice_client.is_playing():
-            logger.info(f'Voice client not playing')
+            logger.info('Voice client not playing')
             return
 
-        logger.info(f'Voice client stopped to skip audio')
-        await message.channel.send(f'Skipped.')
+        prefetched_entries = self.audio_queue.peek(self.prefetch_depth)
+        skipped = 1
+        while skipped < count and self.audio_queue.dequeue():
+            skipped += 1
+
+        self.update_prefetched_entries(prefetched_entries)
+
+        # stopped before replying, skips queued behind this one during the reply see the pending track change
+        logger.info('Voice client stopped to skip %s entries', skipped)
+        self.track_change_pending = True
         self.voice_client.stop()
+        await message.channel.send(f'Skipped.' if skipped == 1 else f'Skipped {skipped} entries.')
+
+    # restarts the playing entry at position (in seconds) without retrieving its metadata again
+    # the new timed audio is prerolled before it replaces the old one so playback doesn't stall
+    async def seek_entry_buffer(self, message:discord.message, position:float):
+        # check if the voice client is connected to a voice channel
+        if not self.voice_client:
+            logger.info('Voice client not connected to any voice channel')
+            return
+
+        # check if the voice client has audio to seek
+        if not self.entry_buffer or not (self.voice_client.is_playing() or self.voice_client.is_paused()):
+            logger.info('Voice client not playing')
+            await message.channel.send(f'No audio playing.')
+            return
+
+        audio_metadata = self.entry_buffer.audio_metadata
+        duration = audio_metadata[AudioMetadata.DURATION.value]
+        position = max(0, min(position, duration)) if duration else max(0, position)
+        seek_time = time.perf_counter()
+
+        def log_seek_latency(first_frame_time:float):
+            logger.info('Seek to %ss: first audio after %.1fms', position, (first_frame_time - seek_time) * 1000)
+
+        # the old process keeps playing until the new one is prerolled, so the seek needs a process of its own
+        if not await self.wait_for_process(message.channel, audio_metadata[AudioMetadata.TITLE.value]):
+            return
+
+        # local files from the audio cache seek almost instantly since ffmpeg seeks before opening the input
+        timed_audio = self.create_timed_audio(audio_metadata, position)
+        timed_audio.on_first_frame = log_seek_latency
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, timed_audio.preroll, self.preroll_frames)
+
+        # the voice thread may be in the middle of reading the old timed audio
+        # swapping the source doesn't call the after function, the old ffmpeg process is stopped shortly after
+        was_paused = self.voice_client.is_paused()
+        previous_timed_audio = self.entry_buffer.timed_audio
+        self.entry_buffer.timed_audio = timed_audio
+        self.voice_client.source = timed_audio
+        if was_paused:
+            self.voice_client.pause()
+
+        loop.call_later(1, previous_timed_audio.cleanup)
+        self.start_preroll_task(timed_audio)
+
+        logger.info('Seeked %s to %ss', audio_metadata[AudioMetadata.TITLE.value], position)
+        await message.channel.send(f'Moved to {misc.format_timestamp(position)}.')
+
+    # moves the currently playing audio to the given time
+    @async_func
+    async def seek(self, message:discord.message):
+        position = misc.parse_timestamp(misc.get_words_after_n(message.content, 1))
+        if position is None:
+            await message.channel.send(f'Enter a time such as 90 or 1:30.')
+            return
+
+        await self.seek_entry_buffer(message, position)
+
+    # fast forwards the currently playing audio by a number of seconds
+    @async_func
+    async def forward(self, message:discord.message):
+        content = misc.get_words_after_n(message.content, 1)
+        seconds = misc.parse_timestamp(content) if content else self.SEEK_SECONDS
+        if seconds is None or not self.entry_buffer or not self.entry_buffer.timed_audio:
+            await message.channel.send(f'Invalid input.')
+            return
+
+        await self.seek_entry_buffer(message, self.entry_buffer.timed_audio.get_elapsed_time() + seconds)
+
+    # rewinds the currently playing audio by a number of seconds
+    @async_func
+    async def rewind(self, message:discord.message):
+        content = misc.get_words_after_n(message.content, 1)
+        seconds = misc.parse_timestamp(content) if content else self.SEEK_SECONDS
+        if seconds is None or not self.entry_buffer or not self.entry_buffer.timed_audio:
+            await message.channel.send(f'Invalid input.')
+            return
+
+        await self.seek_entry_buffer(message, self.entry_buffer.timed_audio.get_elapsed_time() - seconds)
 
     # sends information about the currently playing audio
     @async_func
@@ -261,27 +1129,114 @@ class AudioPlayer():
         else:
             await message.channel.send(f'Now playing:\n{printable}')
 
-    # lists the queue
+    # lists a page of the queue
     @async_func
     async def list(self, message:discord.message):
-            printable = self.audio_queue.get_printable()
-            if not printable:
-                await message.channel.send(f'Queue is empty.')
+        if self.audio_queue.is_empty():
+            await message.channel.send(f'Queue is empty.')
+            return
 
-            else:
-                await message.channel.send(f'Current queue:\n{printable}')
+        content = misc.get_words_after_n(message.content, 1)
+        page_count = self.audio_queue.get_page_count()
+        page = min(max(int(content), 1), page_count) if content.isdigit() else 1
+
+        printable = self.audio_queue.get_page(page)
+        await message.channel.send(f'Current queue (page {page}/{page_count}, {self.audio_queue.size} entries):\n{printable}')
+
+    # sends the guild's timing histograms
+    @async_func
+    async def stats(self, message:discord.message):
+        printable = self.metrics.get_printable()
+        if self.client.resolver.pool:
+            printable += self.client.resolver.pool.get_printable()
+
+        if self.client.broadcasts:
+            printable += self.client.broadcasts.get_printable()
+
+        printable += self.client.ffmpeg_budget.get_printable()
+        if self.client.resolver.cache:
+            printable += self.client.resolver.cache.get_printable()
+
+        if self.client.audio_cache:
+            printable += self.client.audio_cache.get_printable()
+
+        speculations = self.metrics.counters['speculations_total']
+        if speculations:
+            printable += f'prebuffered search results: {self.metrics.counters["speculation_hits_total"] / speculations:.0%} played\n'
+
+        await message.channel.send(f'Timings (ms):\n{printable}')
+
+    # queues every entry of a playlist without extracting them, playing the first one right away if nothing is playing
+    @async_func
+    async def playlist(self, message:discord.message):
+        url = misc.get_words_after_n(message.content, 1)
+        if not misc.validate_url(url):
+            await message.channel.send(f'Enter a playlist url.')
+            return
+
+        if self.playlist_task and not self.playlist_task.done():
+            await message.channel.send(f'A playlist is still being imported.')
+            return
+
+        await self.join_voice_channel(message)
+        if self.voice_client:
+            message_information = MessageInformation.retrieve_message_information(message)
+            self.playlist_task = asyncio.create_task(self.import_playlist(url, message_information))
+
+    # reads the playlist listing one page at a time and queues each page as flat entries
+    async def import_playlist(self, url:str, message_information:tuple):
+        channel = message_information[MessageInformation.CHANNEL.value]
+        reader = PlaylistReader(url)
+        title = url
+        total = 0
+        first_page = True
+
+        try:
+            while total < self.playlist_max_entries:
+                count = min(self.playlist_page_size, self.playlist_max_entries - total)
+                title, flat_metadatas = await self.client.resolver.read_playlist_page(self.guild_id, reader, count)
+                total += await self.commands.run(self.enqueue_playlist_page, flat_metadatas, message_information)
+
+                if first_page:
+                    await channel.send(f'Enqueued entries from {title}, the rest are added in the background.')
+                    first_page = False
+
+                if len(flat_metadatas) < count:
+                    break
+
+            logger.info('Imported %s entries from %s', total, url)
+            await channel.send(f'Enqueued {total} entries from {title}.')
+
+        except asyncio.CancelledError:
+            logger.info('Stopped importing %s after %s entries', url, total)
+            raise
+
+        except Exception as e:
+            logger.error('Error importing %s after %s entries: %s', url, total, e)
+            await channel.send(f'Could not import the rest of {title}, enqueued {total} entries.')
+
+        finally:
+            reader.close()
 
     # adds audio to the queue
     @async_func
-    async def add(self, message:discord.message):
-        audio_metadata = await self.retrieve_audio_metadata(message)
+    async def add(self, message:discord.message, audio_metadata:tuple=None):
+        audio_metadata = audio_metadata or await self.retrieve_audio_metadata(message)
         message_information = MessageInformation.retrieve_message_information(message)
-        timed_audio = TimedAudio(audio_metadata[AudioMetadata.URL.value], 0)
 
-        if audio_metadata and message_information and timed_audio:
-            self.audio_queue.enqueue(audio_metadata, message_information, timed_audio)
+        if audio_metadata and message_information:
+            self.audio_queue.enqueue(audio_metadata, message_information)
+
+            # start the entry early if it will play next
+            if self.voice_client and self.voice_client.is_playing():
+                self.prefetch_entries()
+
             await message.channel.send(f'Enqueued {audio_metadata[AudioMetadata.TITLE.value]}.')
-            logger.info(f'Added entry with {audio_metadata} and {message_information} to queue')
+            logger.info('Added entry with %s and %s to queue', audio_metadata, message_information)
+
+        # the prebuffered audio is only kept if the entry was prefetched, entries further back start their own later
+        if audio_metadata:
+            self.discard_speculative_source(audio_metadata[AudioMetadata.WEBPAGE_URL.value])
 
     # removes audio from the queue
     @async_func
@@ -292,9 +1247,113 @@ class AudioPlayer():
             entry = self.audio_queue.remove(int(content))
 
         if entry:
+            self.release_timed_audio(entry)
             await message.channel.send(f'Removed {entry.audio_metadata[AudioMetadata.TITLE.value]}.')
-            logger.info(f'Removed entry with {entry.audio_metadata} and {entry.message_information} from queue')
+            logger.info('Removed entry with %s and %s from queue', entry.audio_metadata, entry.message_information)
 
         else:
             await message.channel.send(f'Invalid input.')
-            return
\ No newline at end of file
+            return
+
+    # moves audio to a different position in the queue
+    @async_func
+    async def move(self, message:discord.message):
+        content = misc.get_words_after_n(message.content, 1).split()
+        entry = None
+        if len(content) == 2 and all(position.isdigit() for position in content):
+            prefetched_entries = self.audio_queue.peek(self.prefetch_depth)
+            entry = self.audio_queue.move(int(content[0]), int(content[1]))
+            self.update_prefetched_entries(prefetched_entries)
+
+        if entry:
+            await message.channel.send(f'Moved {entry.audio_metadata[AudioMetadata.TITLE.value]} to position {content[1]}.')
+
+        else:
+            await message.channel.send(f'Invalid input.')
+
+    # shuffles the queue
+    @async_func
+    async def shuffle(self, message:discord.message):
+        if self.audio_queue.is_empty():
+            await message.channel.send(f'Queue is empty.')
+            return
+
+        prefetched_entries = self.audio_queue.peek(self.prefetch_depth)
+        self.audio_queue.shuffle()
+        self.update_prefetched_entries(prefetched_entries)
+        await message.channel.send(f'Shuffled {self.audio_queue.size} entries.')
+
+    # sources started ahead of time as opus passthrough or broadcast can't apply effects, they are stopped and started again as pcm
+    # the next entry is prerolled again so it can still be crossfaded into
+    def restart_opus_sources(self):
+        for url, timed_audio in list(self.speculative_sources.items()):
+            if timed_audio.is_opus():
+                self.discard_speculative_source(url)
+
+        restarted = 0
+        for entry in self.audio_queue.peek(max(self.prefetch_depth, 1)):
+            if entry.timed_audio and entry.timed_audio.is_opus():
+                self.release_timed_audio(entry)
+                restarted += 1
+
+        if restarted and self.is_playing():
+            logger.info('Restarting %s prefetched opus sources as pcm for the effects', restarted)
+            self.prefetch_entries()
+            if self.entry_buffer and self.entry_buffer.timed_audio:
+                self.start_preroll_task(self.entry_buffer.timed_audio)
+
+    # replies with the effects, or that they need numpy
+    async def send_effects(self, message:discord.message):
+        if not self.effects:
+            logger.warning('%s used in guild %s without numpy, effects are off', message.content.split()[0], self.guild_id)
+            await message.channel.send(f'Effects need numpy installed.')
+            return
+
+        printable = self.effects.get_printable()
+        if self.effects.is_active():
+            self.restart_opus_sources()
+            if self.entry_buffer and self.entry_buffer.timed_audio and self.entry_buffer.timed_audio.is_opus():
+                printable += ', from the next song'
+
+        await message.channel.send(f'Effects: {printable}.')
+
+    # sets the volume in percent of the original loudness
+    @async_func
+    async def volume(self, message:discord.message):
+        content = misc.get_words_after_n(message.content, 1)
+        if self.effects and content:
+            if not content.isdigit() or int(content) > 200:
+                await message.channel.send(f'Enter a volume from 0 to 200.')
+                return
+
+            self.effects.volume = int(content) / 100
+
+        await self.send_effects(message)
+
+    # turns loudness normalization on or off
+    @async_func
+    async def normalize(self, message:discord.message):
+        content = misc.get_words_after_n(message.content, 1).lower()
+        if self.effects and content:
+            if content not in ('on', 'off'):
+                await message.channel.send(f'Enter on or off.')
+                return
+
+            self.effects.normalize = content == 'on'
+
+        await self.send_effects(message)
+
+    # sets the seconds the end of a song is faded into the next one, 0 turns crossfades off
+    # longer crossfades are shortened to the preroll lead time
+    @async_func
+    async def crossfade(self, message:discord.message):
+        content = misc.get_words_after_n(message.content, 1)
+        if self.effects and content:
+            seconds = misc.parse_timestamp(content)
+            if seconds is None or seconds < 0:
+                await message.channel.send(f'Enter seconds from 0 to {self.preroll_lead_time:g}.')
+                return
+
+            self.effects.crossfade = misc.clamp(seconds, 0, self.preroll_lead_time)
+
+        await self.send_effects(message)
@@ -1,109 +1,268 @@
 from __future__ import annotations
+import random
 import logging
 
+import utils.misc as misc
 from utils.configure_logger import ConfigureLogger
-from utils.timed_audio import TimedAudio
+from utils.timed_audio import TimedAudioMixin
 from entry import Entry, AudioMetadata
 
 # retrieve class logger and configure logger
 logger = logging.getLogger(__name__)
 join_voice_channel_logger_config = ConfigureLogger(logger=logger)
 
-# create child class of Entry for the linked list
+# create child class of Entry for the tree nodes
+# entries are ordered by position, each node stores the size of its subtree to find positions in O(log n)
 class AudioQueueEntry(Entry):
-    __slots__ = ('next',)
+    __slots__ = ('left', 'right', 'priority', 'size')
 
-    def __init__(self, audio_metadata:tuple=None, message_information:tuple=None, timed_audio:TimedAudio=None, next:AudioQueueEntry=None):
+    def __init__(self, audio_metadata:tuple=None, message_information:tuple=None, timed_audio:TimedAudioMixin=None):
         super().__init__(audio_metadata, message_information, timed_audio)
-        self.next = next
-        logger.info(f'Creating AudioQueueEntry with audio metadata: {audio_metadata}\n, message information: {message_information}\n, and next: {next}')
-    
-    def set_next(self, next:AudioQueueEntry=None):
-        self.next = next
-        logger.info(f'Setting next: {next}')
-    
-# linked list queue implementation
-class AudioQueueLinkedList():
+        self.left = None
+        self.right = None
+        self.priority = random.random()
+        self.size = 1
+
+    def update_size(self):
+        self.size = 1 + get_size(self.left) + get_size(self.right)
+
+def get_size(entry:AudioQueueEntry=None) -> int:
+    return entry.size if entry else 0
+
+# joins two trees, every entry of left comes before every entry of right
+def merge(left:AudioQueueEntry=None, right:AudioQueueEntry=None) -> AudioQueueEntry:
+    if not left or not right:
+        return left or right
+
+    if left.priority > right.priority:
+        left.right = merge(left.right, right)
+        left.update_size()
+        return left
+
+    right.left = merge(left, right.left)
+    right.update_size()
+    return right
+
+# splits a tree into its first count entries and the remaining entries
+def split(entry:AudioQueueEntry=None, count:int=0) -> tuple[AudioQueueEntry, AudioQueueEntry]:
+    if not entry:
+        return None, None
+
+    if get_size(entry.left) < count:
+        left, right = split(entry.right, count - get_size(entry.left) - 1)
+        entry.right = left
+        entry.update_size()
+        return entry, right
+
+    left, right = split(entry.left, count)
+    entry.left = right
+    entry.update_size()
+    return left, entry
+
+# builds a tree from entries in order in O(n) using a stack along the right spine
+def build(entries:list[AudioQueueEntry]) -> AudioQueueEntry:
+    stack = []
+    for entry in entries:
+        last = None
+        while stack and stack[-1].priority < entry.priority:
+            last = stack.pop()
+            last.update_size()
+
+        entry.left = last
+        entry.right = None
+        if stack:
+            stack[-1].right = entry
+
+        stack.append(entry)
+
+    # sizes along the right spine are fixed from the bottom up
+    for entry in reversed(stack):
+        entry.update_size()
+
+    return stack[0] if stack else None
+
+# indexed queue implementation (implicit treap)
+# positions are 1-indexed, positional operations take O(log n)
+class AudioQueue():
+    PAGE_SIZE = 10
+    MAX_TITLE_LENGTH = 100
+
     def __init__(self):
-        self.size = 0
-        self.tail = AudioQueueEntry(None, None, None)
-        self.head = AudioQueueEntry(None, None, self.tail)
-        self.curr_entry = self.head
-
-    def enqueue(self, audio_metadata:tuple, message_information:tuple, timed_audio:TimedAudio):
-        logger.info(f'Enqueue requested')
-        if not audio_metadata or not message_information or not timed_audio:
+        self.root = None
+
+        # page number -> rendered page, pages are only rendered again after a change at or before them
+        self.pages = {}
+
+        # incremented on every change so a saved copy of the queue knows when it is stale
+        self.version = 0
+
+    @property
+    def size(self) -> int:
+        return get_size(self.root)
+
+    def enqueue(self, audio_metadata:tuple, message_information:tuple, timed_audio:TimedAudioMixin=None):
+        if not audio_metadata or not message_information:
             return
 
-        entry = AudioQueueEntry(audio_metadata, message_information, timed_audio, self.tail)
-        self.curr_entry.set_next(entry)
-        self.curr_entry = entry
-        self.size += 1
-        logger.info(f'Enqueuing AudioQueueEntry with metadata: {entry.audio_metadata}\n and message information: {entry.message_information}')
-        logger.info(f'Queue:\n{self.get_printable()}')
-    
+        entry = AudioQueueEntry(audio_metadata, message_information, timed_audio)
+        self.root = merge(self.root, entry)
+        self.invalidate_pages(self.size)
+        logger.info('Enqueued %s at position %s', audio_metadata[AudioMetadata.TITLE.value], self.size)
+
+    # enqueues a list of (audio metadata, message information) tuples in O(k + log n)
+    def enqueue_many(self, entries:list[tuple]) -> int:
+        queue_entries = [AudioQueueEntry(audio_metadata, message_information) for audio_metadata, message_information in entries if audio_metadata and message_information]
+        self.invalidate_pages(self.size + 1)
+        self.root = merge(self.root, build(queue_entries))
+        logger.info('Enqueued %s entries, queue size %s', len(queue_entries), self.size)
+        return len(queue_entries)
+
     def dequeue(self) -> Entry:
-        logger.info(f'Dequeue requested')
-        if self.curr_entry == self.head:
-            logger.info(f'No entries to dequeue')
+        if not self.root:
+            logger.info('No entries to dequeue')
             return None
 
-        entry = self.head.next
-        if self.curr_entry == entry:
-            self.curr_entry = self.head
-            logger.info(f'Dequeuing last entry')
-
-        self.head.set_next(entry.next)
-        self.size -= 1
-        logger.info(f'Dequeuing AudioQueueEntry with metadata: {entry.audio_metadata}\n and message information: {entry.message_information}')
-        logger.info(f'Queue:\n{self.get_printable()}')
+        entry, self.root = split(self.root, 1)
+        self.invalidate_pages(1)
+        logger.info('Dequeued %s, queue size %s', entry.audio_metadata[AudioMetadata.TITLE.value], self.size)
         return entry
-    
+
+    # inserts an entry so it ends up at position idx, positions past the end are appended
+    def insert(self, idx:int, audio_metadata:tuple, message_information:tuple, timed_audio:TimedAudioMixin=None):
+        if not audio_metadata or not message_information:
+            return
+
+        entry = AudioQueueEntry(audio_metadata, message_information, timed_audio)
+        left, right = split(self.root, max(idx, 1) - 1)
+        self.root = merge(merge(left, entry), right)
+        self.invalidate_pages(idx)
+        logger.info('Inserted %s at position %s', audio_metadata[AudioMetadata.TITLE.value], idx)
+
     def find_entry(self, idx:int=1) -> Entry:
-        logger.info(f'Find entry requested')
-        if idx < 1 or idx > self.size - 1:
-            logger.info(f'Entry out of range')
+        if idx < 1 or idx > self.size:
+            logger.info('Entry %s out of range', idx)
             return None
-                
-        entry = self.head
-        for _ in range(idx):
-            entry = entry.next
 
-        return entry
-        
+        entry = self.root
+        while entry:
+            left_size = get_size(entry.left)
+            if idx <= left_size:
+                entry = entry.left
+
+            elif idx == left_size + 1:
+                return entry
+
+            else:
+                idx -= left_size + 1
+                entry = entry.right
+
+        return None
+
     def remove(self, idx:int=1) -> Entry:
-        logger.info(f'Remove requested with index {idx}')
-        if idx < 1 or idx > self.size - 1:
-            logger.info(f'Entry out of range')
+        if idx < 1 or idx > self.size:
+            logger.info('Entry %s out of range', idx)
             return None
 
-        if idx == 1:
-            return self.dequeue()
+        left, right = split(self.root, idx - 1)
+        entry, right = split(right, 1)
+        self.root = merge(left, right)
+        self.invalidate_pages(idx)
+        logger.info('Removed %s from position %s', entry.audio_metadata[AudioMetadata.TITLE.value], idx)
+        return entry
 
-        previous_entry = self.find_entry(idx - 1)
-        entry = previous_entry.next
-        
-        previous_entry.next = entry.next
-        self.size -= 1
+    # moves the entry at position src to position dst
+    def move(self, src:int, dst:int) -> Entry:
+        if src < 1 or src > self.size or dst < 1 or dst > self.size:
+            logger.info('Move from %s to %s out of range', src, dst)
+            return None
 
-        logger.info(f'Removing AudioQueueEntry with metadata: {entry.audio_metadata}\n and message information: {entry.message_information}')
-        logger.info(f'Queue:\n{self.get_printable()}')
+        left, right = split(self.root, src - 1)
+        entry, right = split(right, 1)
+        left, right = split(merge(left, right), dst - 1)
+        self.root = merge(merge(left, entry), right)
+        self.invalidate_pages(min(src, dst))
+        logger.info('Moved %s from position %s to %s', entry.audio_metadata[AudioMetadata.TITLE.value], src, dst)
         return entry
-    
+
+    # shuffles every entry in O(n)
+    def shuffle(self):
+        entries = list(self.iter_entries())
+        random.shuffle(entries)
+        for entry in entries:
+            entry.priority = random.random()
+
+        self.root = build(entries)
+        self.invalidate_pages(1)
+        logger.info('Shuffled %s entries', len(entries))
+
+    # yields entries in order starting at position start in O(log n) plus O(1) per entry
+    def iter_entries(self, start:int=1):
+        stack = []
+        entry = self.root
+        skip = max(start, 1) - 1
+
+        # walk down to the start position, keeping the ancestors that come after it
+        while entry:
+            left_size = get_size(entry.left)
+            if skip < left_size:
+                stack.append(entry)
+                entry = entry.left
+
+            else:
+                skip -= left_size + 1
+                if skip < 0:
+                    stack.append(entry)
+                    break
+
+                entry = entry.right
+
+        while stack:
+            entry = stack.pop()
+            yield entry
+
+            entry = entry.right
+            while entry:
+                stack.append(entry)
+                entry = entry.left
+
+    # returns the first count entries without dequeuing them
+    def peek(self, count:int=1) -> list[Entry]:
+        entries = []
+        for entry in self.iter_entries():
+            if len(entries) >= count:
+                break
+
+            entries.append(entry)
+
+        return entries
+
     def is_empty(self) -> bool:
-        return (self.size == 0)
-
-    def get_printable(self) -> str:
-        logger.info(f'Get printable requested')
-        printable = f''
-        if self.size == 0:
-            return printable
-
-        curr_entry = self.head.next
-        cnt = 1
-        for _ in range(self.size - 1):
-            printable += f'{cnt}. {curr_entry.audio_metadata[AudioMetadata.TITLE.value]}\n'
-            cnt += 1
-            curr_entry = curr_entry.next
-        printable += f'{cnt}. {curr_entry.audio_metadata[AudioMetadata.TITLE.value]}\n'
-        return printable
\ No newline at end of file
+        return (self.root is None)
+
+    # drops the rendered pages that show position idx or later, called on every change
+    def invalidate_pages(self, idx:int=1):
+        self.version += 1
+        first_page = (max(idx, 1) - 1) // self.PAGE_SIZE + 1
+        for page in [page for page in self.pages if page >= first_page]:
+            del self.pages[page]
+
+    def get_page_count(self) -> int:
+        return (self.size + self.PAGE_SIZE - 1) // self.PAGE_SIZE
+
+    # returns the entries on a page (1-indexed) as text, rendering only that page's entries
+    def get_page(self, page:int=1) -> str:
+        if page in self.pages:
+            return self.pages[page]
+
+        start = (page - 1) * self.PAGE_SIZE + 1
+        printable = ''
+        for cnt, entry in zip(range(start, start + self.PAGE_SIZE), self.iter_entries(start)):
+            title = entry.audio_metadata[AudioMetadata.TITLE.value] or ''
+            if len(title) > self.MAX_TITLE_LENGTH:
+                title = title[:self.MAX_TITLE_LENGTH - 3] + '...'
+
+            duration = entry.audio_metadata[AudioMetadata.DURATION.value]
+            printable += f'{cnt}. {title}' + (f' [{misc.format_timestamp(duration)}]' if duration else '') + '\n'
+
+        self.pages[page] = printable
+        return printable
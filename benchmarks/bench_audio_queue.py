@@ -0,0 +1,70 @@
+import random
+import logging
+import argparse
+import time
+
+from audio_queue import AudioQueue
+
+# micro benchmark of the queue operations on large queues, such as queues filled by playlist imports
+# usage from the repository root: python -m benchmarks.bench_audio_queue --sizes 10000 50000 100000
+
+MESSAGE_INFORMATION = ('author', 'channel', 'content')
+
+def make_audio_metadata(idx:int) -> tuple:
+    return (f'title {idx}', None, 180, f'https://www.youtube.com/watch?v={idx}', str(idx), 'opus', 'Youtube')
+
+# returns the average microseconds per call of func over ops calls
+def time_ops(func, ops:int) -> float:
+    start = time.perf_counter()
+    for _ in range(ops):
+        func()
+
+    return (time.perf_counter() - start) * 1e6 / ops
+
+def run(size:int, ops:int) -> dict:
+    results = {}
+    entries = [(make_audio_metadata(idx), MESSAGE_INFORMATION) for idx in range(size)]
+
+    queue = AudioQueue()
+    start = time.perf_counter()
+    queue.enqueue_many(entries)
+    results['enqueue_many (total ms)'] = (time.perf_counter() - start) * 1000
+
+    queue = AudioQueue()
+    start = time.perf_counter()
+    for audio_metadata, message_information in entries:
+        queue.enqueue(audio_metadata, message_information)
+
+    results['enqueue'] = (time.perf_counter() - start) * 1e6 / size
+
+    random_position = lambda: random.randint(1, queue.size)
+    results['find_entry'] = time_ops(lambda: queue.find_entry(random_position()), ops)
+    results['move'] = time_ops(lambda: queue.move(random_position(), random_position()), ops)
+    results['remove + insert'] = time_ops(lambda: queue.insert(random_position(), *entries[0]) or queue.remove(random_position()), ops)
+    results['peek(2)'] = time_ops(lambda: queue.peek(2), ops)
+    results['page of 10'] = time_ops(lambda: [entry for entry, _ in zip(queue.iter_entries(random_position()), range(10))], ops)
+
+    start = time.perf_counter()
+    queue.shuffle()
+    results['shuffle (total ms)'] = (time.perf_counter() - start) * 1000
+
+    results['dequeue'] = time_ops(queue.dequeue, min(ops, queue.size))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='audio queue operation timings')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000, 100000], help='queue sizes to test')
+    parser.add_argument('--ops', type=int, default=1000, help='operations timed per measurement')
+    args = parser.parse_args()
+
+    # per operation logging would dominate the timings
+    logging.getLogger('audio_queue').setLevel(logging.WARNING)
+
+    for size in args.sizes:
+        print(f'queue size {size}')
+        for name, value in run(size, args.ops).items():
+            unit = '' if 'total' in name else ' us/op'
+            print(f'  {name:<24}{value:>12.2f}{unit}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import array
+import argparse
+import tracemalloc
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import utils.pcm_effects as pcm_effects
+
+# per frame cost of the pcm effects stage, every guild has its own stage and processes one frame per 20ms
+# each round processes one frame for every guild, the round has to fit in the 20ms frame budget of the voice threads
+# usage from the repository root: python -m benchmarks.bench_effects --guilds 1 100 1000 --frames 500
+
+FRAME_BUDGET_MS = 20
+
+def create_frames(count:int) -> list[bytes]:
+    numpy = pcm_effects.load_numpy()
+    generator = numpy.random.default_rng(0)
+    return [generator.integers(-12000, 12000, pcm_effects.SAMPLE_COUNT, dtype=numpy.int16).tobytes() for _ in range(count)]
+
+# the per sample python loop the stage replaces, for one frame
+def scale_frame_python(data:bytes, volume:float) -> bytes:
+    samples = array.array('h', data)
+    for idx, sample in enumerate(samples):
+        samples[idx] = max(-32768, min(32767, int(sample * volume)))
+
+    return samples.tobytes()
+
+def get_percentile(values:list, percentile:float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))] if values else 0
+
+def run(guild_count:int, frame_count:int, frames:list[bytes]) -> dict:
+    stages = [pcm_effects.EffectsStage(volume=0.8, normalize=True, crossfade=5) for _ in range(guild_count)]
+
+    # half of the guilds are in the middle of a crossfade
+    round_times = []
+    for idx in range(frame_count):
+        data = frames[idx % len(frames)]
+        mix_data = frames[(idx + 1) % len(frames)]
+        start = time.perf_counter()
+        for guild_idx, stage in enumerate(stages):
+            if guild_idx % 2:
+                stage.process(data, mix_data, 0.5)
+
+            else:
+                stage.process(data)
+
+        round_times.append((time.perf_counter() - start) * 1000)
+
+    # memory allocated per frame once the stages are warm, the returned frames are dropped right away like discord.py does
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for idx in range(100):
+        stages[0].process(frames[idx % len(frames)], frames[(idx + 1) % len(frames)], 0.5)
+
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+
+    return {
+        'frame_us': sum(round_times) * 1000 / (frame_count * guild_count)
+        , 'round_p50_ms': get_percentile(round_times, 50)
+        , 'round_p99_ms': get_percentile(round_times, 99)
+        , 'retained_bytes': retained
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='pcm effects stage cost per frame')
+    parser.add_argument('--guilds', type=int, nargs='+', default=[1, 100, 1000], help='numbers of guilds processing frames')
+    parser.add_argument('--frames', type=int, default=500, help='frames processed per guild')
+    args = parser.parse_args()
+
+    if not pcm_effects.is_available():
+        print('numpy is not installed, the effects stage is disabled', file=sys.stderr)
+        sys.exit(1)
+
+    frames = create_frames(50)
+
+    start = time.perf_counter()
+    for data in frames:
+        scale_frame_python(data, 0.8)
+
+    python_ms = (time.perf_counter() - start) * 1000 / len(frames)
+    print(f'per sample python volume      {python_ms * 1000:10.1f} us per frame')
+
+    for guild_count in args.guilds:
+        results = run(guild_count, args.frames, frames)
+        budget = results['round_p99_ms'] / FRAME_BUDGET_MS
+        print(f'{guild_count} guilds (volume, normalization, half crossfading)')
+        print(f'  per frame                   {results["frame_us"]:10.1f} us')
+        print(f'  all guilds per 20ms         p50 {results["round_p50_ms"]:8.2f} ms  p99 {results["round_p99_ms"]:8.2f} ms  ({budget:.1%} of the frame budget)')
+        print(f'  memory retained per 100 frames {results["retained_bytes"]:7} bytes')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.server
+import functools
+
+# the bot reads its settings when its modules are imported, so they are set before importing it
+# logging every message of every guild would dominate the timings, the audio cache would download the test files
+# and the queue store would restore the simulated guilds' queues from the last run
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('AUDIO_CACHE_ENABLED', 'false')
+os.environ.setdefault('QUEUE_STORE_ENABLED', 'false')
+
+import discord
+
+import bot
+import utils.timed_audio as timed_audio
+
+# end to end load test of the bot without discord or the internet
+# synthetic messages are passed to bot.Client.on_message for each simulated guild
+# voice clients are replaced by a stub that reads frames from the audio source every 20ms like discord.py's audio player
+# yt-dlp and ffmpeg read test audio from a local http server
+# usage from the repository root: python -m benchmarks.bench_load --guilds 1 10 100 --seconds 30
+
+FRAME_LENGTH = 0.02
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# writes sine wave test tracks with ffmpeg unless they exist already
+def create_test_audio(directory:str, ffmpeg:str, track_count:int, seconds:int) -> list[str]:
+    names = []
+    for idx in range(track_count):
+        name = f'track{idx}.webm'
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            subprocess.run(
+                [ffmpeg, '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency={220 + idx * 55}:duration={seconds}', '-c:a', 'libopus', '-b:a', '96k', path]
+                , check=True
+            )
+
+        names.append(name)
+
+    return names
+
+# serves the test audio on a background thread, returns the server and its base url
+def start_http_server(directory:str) -> tuple:
+    class QuietHandler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+# stands in for discord.VoiceClient, reads the source at real time pace on its own thread
+class StubVoiceClient():
+    def __init__(self, client:discord.Client, guild, channel):
+        self.client = client
+        self.guild = guild
+        self.channel = channel
+        self._source = None
+        self.after = None
+        self.playing = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        # set on the event loop when the first frame of a \play is read
+        self.first_frame_event = asyncio.Event()
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, source):
+        self._source = source
+
+    def play(self, source, *, after=None):
+        self._source = source
+        self.after = after
+        self.playing.set()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        error = None
+        next_time = time.perf_counter()
+        try:
+            while not self.stopped.is_set():
+                if not self.playing.is_set():
+                    self.playing.wait(0.1)
+                    next_time = time.perf_counter()
+                    continue
+
+                data = self._source.read()
+                if not data:
+                    break
+
+                if not self.first_frame_event.is_set():
+                    self.client.loop.call_soon_threadsafe(self.first_frame_event.set)
+
+                next_time += FRAME_LENGTH
+                time.sleep(max(0, next_time - time.perf_counter()))
+
+        except Exception as e:
+            error = e
+
+        # discord.py calls the after function before cleaning up the source
+        source = self._source
+        self.playing.clear()
+        if self.after:
+            self.after(error)
+
+        source.cleanup()
+
+    def is_playing(self) -> bool:
+        return self.thread is not None and self.thread.is_alive() and self.playing.is_set()
+
+    def is_paused(self) -> bool:
+        return self.thread is not None and self.thread.is_alive() and not self.playing.is_set()
+
+    def pause(self):
+        self.playing.clear()
+
+    def resume(self):
+        self.playing.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.playing.set()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force:bool=False):
+        self.stop()
+        self.client.stub_voice_clients.remove(self)
+        await self.client.on_voice_state_update(self.client.get_member(self.guild), FakeVoiceState(self.channel), FakeVoiceState(None))
+
+class FakeVoiceState():
+    def __init__(self, channel=None):
+        self.channel = channel
+
+class FakeUser():
+    def __init__(self, user_id:int, guild=None, voice_channel=None):
+        self.id = user_id
+        self.guild = guild
+        self.voice = FakeVoiceState(voice_channel)
+        self.name = f'user{user_id}'
+
+    def __str__(self) -> str:
+        return self.name
+
+class FakeSentMessage():
+    def __init__(self, content:str):
+        self.content = content
+
+    async def edit(self, content:str=None):
+        self.content = content
+
+class FakeTextChannel():
+    def __init__(self, guild):
+        self.guild = guild
+        self.id = guild.id
+        self.sent = 0
+
+    async def send(self, content:str=None):
+        self.sent += 1
+        return FakeSentMessage(content)
+
+    def __str__(self) -> str:
+        return f'text-{self.id}'
+
+class FakeVoiceChannel():
+    def __init__(self, client:discord.Client, guild):
+        self.client = client
+        self.guild = guild
+        self.id = guild.id
+
+    # connects like discord.py: registers the voice client and dispatches the bot's voice state update
+    async def connect(self):
+        voice_client = StubVoiceClient(self.client, self.guild, self)
+        self.client.stub_voice_clients.append(voice_client)
+        await self.client.on_voice_state_update(self.client.get_member(self.guild), FakeVoiceState(None), FakeVoiceState(self))
+        return voice_client
+
+    def __str__(self) -> str:
+        return f'voice-{self.id}'
+
+class FakeGuild():
+    def __init__(self, guild_id:int):
+        self.id = guild_id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FakeGuild) and other.id == self.id
+
+    def __str__(self) -> str:
+        return f'guild-{self.id}'
+
+class FakeMessage():
+    def __init__(self, content:str, author:FakeUser, channel:FakeTextChannel, guild:FakeGuild):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+
+# bot client whose user and voice clients are fakes, nothing connects to discord
+class BenchClient(bot.Client):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.stub_voice_clients = []
+        self.bench_user = FakeUser(0)
+
+    @property
+    def user(self):
+        return self.bench_user
+
+    @property
+    def voice_clients(self):
+        return self.stub_voice_clients
+
+    # the bot as a member of a guild, passed to on_voice_state_update
+    def get_member(self, guild:FakeGuild) -> FakeUser:
+        return FakeUser(self.bench_user.id, guild)
+
+# measures how late the event loop wakes up a sleeping task
+async def monitor_loop_lag(lags:list, interval:float=0.05):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - start - interval) * 1000)
+
+# returns the ffmpeg child processes of this process and their total rss in bytes, read from /proc on linux
+def get_ffmpeg_processes() -> tuple[int, int]:
+    count = 0
+    rss = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+
+        try:
+            with open(f'/proc/{pid}/stat') as stat_file:
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+
+            if int(fields[1]) != os.getpid():
+                continue
+
+            with open(f'/proc/{pid}/cmdline', 'rb') as cmdline_file:
+                # the second argument is the script when ffmpeg is a wrapper script
+                executables = cmdline_file.read().decode(errors='replace').split('\0')[:2]
+
+        except (OSError, IndexError):
+            continue
+
+        if timed_audio.ffmpeg_path in executables:
+            count += 1
+            rss += int(fields[21]) * PAGE_SIZE
+
+    return count, rss
+
+def get_rss() -> int:
+    with open('/proc/self/statm') as statm_file:
+        return int(statm_file.read().split()[1]) * PAGE_SIZE
+
+async def sample_processes(samples:list, interval:float=0.5):
+    while True:
+        samples.append((*get_ffmpeg_processes(), get_rss()))
+        await asyncio.sleep(interval)
+
+def get_percentile(values:list, percentile:float) -> float:
+    if not values:
+        return 0
+
+    values = sorted(values)
+    return values[min(int(percentile / 100 * len(values)), len(values) - 1)]
+
+# one guild's session: play a track, queue two more, look at the queue, skip and leave
+async def run_guild(client:BenchClient, guild_id:int, track_urls:list[str], seconds:float, latencies:dict, ttfas:list):
+    guild = FakeGuild(guild_id)
+    voice_channel = FakeVoiceChannel(client, guild)
+    text_channel = FakeTextChannel(guild)
+    author = FakeUser(guild_id, guild, voice_channel)
+
+    async def send(content:str):
+        start = time.perf_counter()
+        await client.on_message(FakeMessage(content, author, text_channel, guild))
+        latencies.setdefault(content.split()[0], []).append((time.perf_counter() - start) * 1000)
+
+    play_start = time.perf_counter()
+    await send(f'\\play {track_urls[guild_id % len(track_urls)]}')
+    for offset in (1, 2):
+        await send(f'\\add {track_urls[(guild_id + offset) % len(track_urls)]}')
+
+    for voice_client in client.stub_voice_clients:
+        if voice_client.guild == guild:
+            try:
+                await asyncio.wait_for(voice_client.first_frame_event.wait(), timeout=seconds)
+                ttfas.append((time.perf_counter() - play_start) * 1000)
+
+            except asyncio.TimeoutError:
+                pass
+
+    end_time = play_start + seconds
+    while time.perf_counter() < end_time:
+        for content in ('\\list', '\\nowplaying', '\\stats'):
+            await send(content)
+
+        await asyncio.sleep(min(5, max(0, end_time - time.perf_counter())))
+
+    await send('\\skip')
+    await send('\\leave')
+
+async def run(guild_count:int, track_urls:list[str], seconds:float) -> dict:
+    # every run starts with an empty metadata cache so earlier runs don't answer its lookups
+    metadata_cache_path = os.path.join(tempfile.mkdtemp(prefix='bench_load_'), 'metadata.sqlite3')
+    os.environ['METADATA_CACHE_PATH'] = metadata_cache_path
+    client = BenchClient(intents=discord.Intents.default())
+    client.loop = asyncio.get_running_loop()
+
+    latencies = {}
+    ttfas = []
+    lags = []
+    samples = []
+    monitors = [asyncio.create_task(monitor_loop_lag(lags)), asyncio.create_task(sample_processes(samples))]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_guild(client, guild_id, track_urls, seconds, latencies, ttfas) for guild_id in range(1, guild_count + 1)))
+    wall = time.perf_counter() - start
+
+    for monitor in monitors:
+        monitor.cancel()
+
+    client.resolver.shutdown()
+    shutil.rmtree(os.path.dirname(metadata_cache_path), ignore_errors=True)
+    return {
+        'wall': wall
+        , 'ttfas': ttfas
+        , 'latencies': latencies
+        , 'lags': lags
+        , 'max_ffmpeg': max((count for count, _, _ in samples), default=0)
+        , 'max_ffmpeg_rss': max((rss for _, rss, _ in samples), default=0)
+        , 'max_rss': max((rss for _, _, rss in samples), default=0)
+    }
+
+def print_results(guild_count:int, results:dict):
+    ttfas = results['ttfas']
+    print(f'{guild_count} guilds ({results["wall"]:.1f}s)')
+    print(f'  time to first audio   p50 {get_percentile(ttfas, 50):8.1f} ms  p95 {get_percentile(ttfas, 95):8.1f} ms  max {max(ttfas, default=0):8.1f} ms  ({len(ttfas)}/{guild_count} played)')
+    for command, values in sorted(results['latencies'].items()):
+        print(f'  {command:<20}  p50 {get_percentile(values, 50):8.1f} ms  p95 {get_percentile(values, 95):8.1f} ms  p99 {get_percentile(values, 99):8.1f} ms  (n={len(values)})')
+
+    lags = results['lags']
+    print(f'  event loop lag        p50 {get_percentile(lags, 50):8.1f} ms  p99 {get_percentile(lags, 99):8.1f} ms  max {max(lags, default=0):8.1f} ms')
+    print(f'  ffmpeg processes      max {results["max_ffmpeg"]} using {results["max_ffmpeg_rss"] / (1 << 20):.1f} MiB')
+    print(f'  bot rss               max {results["max_rss"] / (1 << 20):.1f} MiB')
+
+def main():
+    parser = argparse.ArgumentParser(description='end to end load test with simulated guilds')
+    parser.add_argument('--guilds', type=int, nargs='+', default=[1, 10, 100], help='numbers of guilds to simulate')
+    parser.add_argument('--seconds', type=float, default=30, help='seconds each guild plays for')
+    parser.add_argument('--tracks', type=int, default=5, help='number of test tracks')
+    parser.add_argument('--track-seconds', type=int, default=60, help='length of each test track')
+    parser.add_argument('--audio-dir', default=os.path.join(tempfile.gettempdir(), 'bench_load_audio'), help='directory of the test tracks')
+    parser.add_argument('--ffmpeg', default=timed_audio.ffmpeg_path, help='ffmpeg executable')
+    args = parser.parse_args()
+
+    ffmpeg = args.ffmpeg if os.path.exists(args.ffmpeg) else shutil.which('ffmpeg')
+    if not ffmpeg:
+        print(f'ffmpeg not found at {args.ffmpeg} or on the PATH', file=sys.stderr)
+        sys.exit(1)
+
+    timed_audio.ffmpeg_path = ffmpeg
+    os.makedirs(args.audio_dir, exist_ok=True)
+    os.makedirs('logs', exist_ok=True)
+
+    names = create_test_audio(args.audio_dir, ffmpeg, args.tracks, args.track_seconds)
+    server, base_url = start_http_server(args.audio_dir)
+    track_urls = [f'{base_url}/{name}' for name in names]
+
+    try:
+        for guild_count in args.guilds:
+            print_results(guild_count, asyncio.run(run(guild_count, track_urls, args.seconds)))
+
+    finally:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+import time
+import logging
+import argparse
+
+from utils.configure_logger import ConfigureLogger
+
+# measures the time a log call holds the calling thread (the event loop in the bot) for each logging backend
+# usage from the repository root: python -m benchmarks.bench_logging --calls 100000
+
+# stands in for the discord.Message logged by on_message, formatting it isn't free
+class FakeMessage():
+    def __init__(self, idx:int):
+        self.author = f'user{idx % 50}#0001'
+        self.content = f'message {idx} with some chat text in it'
+
+    def __str__(self) -> str:
+        return f'<Message author={self.author!r} content={self.content!r}>'
+
+def time_calls(logger:logging.Logger, level:int, calls:int) -> float:
+    messages = [FakeMessage(idx) for idx in range(calls)]
+    start = time.perf_counter()
+    for message in messages:
+        logger.log(level, 'Message from %s: %s', message.author, message)
+
+    return (time.perf_counter() - start) * 1e6 / calls
+
+def create_logger(name:str, log_async:bool) -> logging.Logger:
+    os.environ['LOG_ASYNC'] = '1' if log_async else '0'
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    ConfigureLogger(logger=logger, log_level=logging.INFO)
+    return logger
+
+def main():
+    parser = argparse.ArgumentParser(description='calling thread cost of each logging backend')
+    parser.add_argument('--calls', type=int, default=100000, help='log calls per measurement')
+    args = parser.parse_args()
+
+    file_logger = create_logger('bench_logging_file', False)
+    queue_logger = create_logger('bench_logging_queue', True)
+
+    results = {
+        'file handler, logged': time_calls(file_logger, logging.INFO, args.calls)
+        , 'queue handler, logged': time_calls(queue_logger, logging.INFO, args.calls)
+        , 'below level, skipped': time_calls(queue_logger, logging.DEBUG, args.calls)
+    }
+
+    ConfigureLogger.stop_listener()
+    for name, value in results.items():
+        print(f'{name:<24}{value:>10.2f} us/call')
+
+if __name__ == '__main__':
+    main()
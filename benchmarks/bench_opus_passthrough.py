@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import argparse
+
+import discord
+
+import utils.timed_audio as timed_audio
+from utils.timed_audio import TimedAudio, TimedOpusAudio
+
+# compares the cpu cost of one stream on the transcoding path (TimedAudio) and the passthrough path (TimedOpusAudio)
+# reads frames as fast as ffmpeg produces them and reports cpu milliseconds per second of audio
+# usage from the repository root: python -m benchmarks.bench_opus_passthrough [audio file] --seconds 60
+# the input should be an opus file (e.g. a webm downloaded with yt-dlp -f 251) to exercise the passthrough path
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+# returns the user + system cpu seconds used by a process, read from /proc on linux
+def get_process_cpu_time(pid:int) -> float:
+    with open(f'/proc/{pid}/stat') as stat_file:
+        fields = stat_file.read().rsplit(')', 1)[1].split()
+
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+def run(source:timed_audio.TimedAudioMixin, seconds:float, encoder:discord.opus.Encoder) -> dict:
+    frame_count = int(seconds * 1000 / 20)
+    encode = encoder and not source.is_opus()
+    frames = 0
+
+    wall_start = time.perf_counter()
+    python_start = time.thread_time()
+    for _ in range(frame_count):
+        data = source.read()
+        if not data:
+            break
+
+        # discord.py encodes pcm frames to opus in the voice thread, opus packets are sent as is
+        if encode:
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+
+        frames += 1
+
+    python_time = time.thread_time() - python_start
+    wall_time = time.perf_counter() - wall_start
+    ffmpeg_time = get_process_cpu_time(source._process.pid)
+    source.cleanup()
+
+    audio_seconds = frames * 20 / 1000
+    return {
+        'frames': frames
+        , 'wall': wall_time
+        , 'ffmpeg_cpu_ms_per_s': ffmpeg_time * 1000 / audio_seconds if audio_seconds else 0
+        , 'python_cpu_ms_per_s': python_time * 1000 / audio_seconds if audio_seconds else 0
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='cpu per stream: pcm transcoding vs opus passthrough')
+    parser.add_argument('source', help='audio file or url to play')
+    parser.add_argument('--seconds', type=float, default=60, help='seconds of audio to read per path')
+    parser.add_argument('--ffmpeg', default=timed_audio.ffmpeg_path, help='ffmpeg executable')
+    parser.add_argument('--codec', default='opus', help='codec of the source, passed to the passthrough path')
+    args = parser.parse_args()
+
+    timed_audio.ffmpeg_path = args.ffmpeg
+    os.makedirs('logs', exist_ok=True)
+
+    encoder = None
+    try:
+        encoder = discord.opus.Encoder()
+
+    except Exception as e:
+        print(f'libopus could not be loaded, pcm frames will not be encoded: {e}', file=sys.stderr)
+
+    results = {
+        'pcm (decode + encode)': run(TimedAudio(args.source, 0), args.seconds, encoder)
+        , 'opus passthrough': run(TimedOpusAudio(args.source, 0, codec=args.codec), args.seconds, encoder)
+    }
+
+    print(f'{"path":<24}{"frames":>8}{"wall s":>9}{"ffmpeg ms/s":>14}{"python ms/s":>14}{"total ms/s":>13}')
+    for name, result in results.items():
+        total = result['ffmpeg_cpu_ms_per_s'] + result['python_cpu_ms_per_s']
+        print(f'{name:<24}{result["frames"]:>8}{result["wall"]:>9.2f}{result["ffmpeg_cpu_ms_per_s"]:>14.2f}{result["python_cpu_ms_per_s"]:>14.2f}{total:>13.2f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+# the bot reads its settings when its modules are imported and when the client is created
+# a single resolver worker keeps the yt-dlp pool warming up from competing with the timed code
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('AUDIO_CACHE_ENABLED', 'false')
+os.environ.setdefault('RESOLVER_WORKERS', '1')
+
+import discord
+
+import bot
+from utils.queue_store import QueueStore
+
+# measures saving queues with the write-behind queue store and restoring every guild's queue after a restart
+# usage from the repository root: python -m benchmarks.bench_queue_store --guilds 1000 --entries 50
+
+class FakeChannel():
+    def __init__(self, channel_id:int):
+        self.id = channel_id
+
+class FakeGuild():
+    def __init__(self, guild_id:int):
+        self.id = guild_id
+
+    def get_member(self, member_id:int):
+        return None
+
+# bot client that knows every simulated guild and channel without connecting to discord
+class BenchClient(bot.Client):
+    def get_guild(self, guild_id:int):
+        return FakeGuild(guild_id)
+
+    def get_channel(self, channel_id:int):
+        return FakeChannel(channel_id)
+
+def make_entry(guild_id:int, idx:int) -> tuple:
+    audio_metadata = (f'title {idx}', f'https://example.com/{guild_id}/{idx}.webm?expire=2000000000', 180, f'https://www.youtube.com/watch?v={idx}', str(idx), 'opus', 'Youtube')
+    return audio_metadata, (guild_id, FakeChannel(guild_id), f'\\add song {idx}')
+
+# the client's queue store and metadata cache are files in directory, never the bot's default cache files
+def create_client(directory:str) -> BenchClient:
+    os.environ['QUEUE_STORE_PATH'] = os.path.join(directory, 'queues.sqlite3')
+    os.environ['METADATA_CACHE_PATH'] = os.path.join(directory, 'metadata.sqlite3')
+    client = BenchClient(intents=discord.Intents.default())
+    client.loop = asyncio.get_running_loop()
+    return client
+
+# fills the store through the bot's save path: every guild's queue is snapshotted, then flushed in one batch
+async def populate(directory:str, guild_count:int, entry_count:int) -> dict:
+    client = create_client(directory)
+    audio_players = [client.get_audio_player(FakeGuild(guild_id)) for guild_id in range(1, guild_count + 1)]
+
+    # a new player reads its saved queue as its first job, queued behind it the job below runs once it was read
+    await asyncio.gather(*(audio_player.commands.run(asyncio.sleep, 0) for audio_player in audio_players))
+    for audio_player in audio_players:
+        audio_player.audio_queue.enqueue_many([make_entry(audio_player.guild_id, idx) for idx in range(entry_count)])
+
+    start = time.perf_counter()
+    for audio_player in client.audio_players.values():
+        audio_player.save_snapshot(client.queue_store)
+
+    snapshot_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rows = client.queue_store.flush()
+    flush_time = time.perf_counter() - start
+
+    # with write-behind an enqueue only marks the queue as changed, it is saved with the next batch
+    audio_player = client.audio_players[1]
+    start = time.perf_counter()
+    for idx in range(100):
+        audio_player.audio_queue.enqueue(*make_entry(1, idx))
+
+    enqueue_time = (time.perf_counter() - start) / 100
+
+    client.resolver.shutdown()
+    client.queue_store.close()
+    return {
+        'rows': rows
+        , 'snapshot_ms': snapshot_time * 1000
+        , 'flush_ms': flush_time * 1000
+        , 'enqueue_us': enqueue_time * 1e6
+    }
+
+# an enqueue that commits the queue before returning, what it would pay without write-behind
+def time_synchronous_writes(path:str, entry_count:int) -> float:
+    queue_store = QueueStore(path)
+    entries = [[list(make_entry(1, idx)[0]), 1, 1, ''] for idx in range(entry_count)]
+    start = time.perf_counter()
+    for _ in range(100):
+        queue_store.save_queue(1, entries)
+        queue_store.flush()
+
+    elapsed = (time.perf_counter() - start) / 100
+    queue_store.close()
+    return elapsed * 1e6
+
+async def recover(directory:str, max_players:int) -> dict:
+    client = create_client(directory)
+    client.max_players = max_players
+
+    start = time.perf_counter()
+    await client.restore_audio_players()
+    restore_time = time.perf_counter() - start
+
+    restored = len(client.audio_players)
+    entries = sum(audio_player.audio_queue.size for audio_player in client.audio_players.values())
+    client.resolver.shutdown()
+    client.queue_store.close()
+    return {'players': restored, 'entries': entries, 'restore_ms': restore_time * 1000}
+
+def main():
+    parser = argparse.ArgumentParser(description='queue store save and restart recovery timings')
+    parser.add_argument('--guilds', type=int, default=1000, help='guilds with a saved queue')
+    parser.add_argument('--entries', type=int, default=50, help='queued entries per guild')
+    args = parser.parse_args()
+
+    logging.getLogger('audio_queue').setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix='bench_queue_store_') as directory:
+        saved = asyncio.run(populate(directory, args.guilds, args.entries))
+        print(f'saved {saved["rows"]} queues of {args.entries} entries')
+        print(f'  snapshot on the event loop   {saved["snapshot_ms"]:10.1f} ms')
+        print(f'  batched flush                {saved["flush_ms"]:10.1f} ms')
+        print(f'  enqueue with write-behind    {saved["enqueue_us"]:10.1f} us')
+        print(f'  enqueue + synchronous write  {time_synchronous_writes(os.path.join(directory, "sync.sqlite3"), args.entries):10.1f} us')
+
+        recovered = asyncio.run(recover(directory, args.guilds))
+        print(f'restored {recovered["players"]} players with {recovered["entries"]} entries in {recovered["restore_ms"]:.1f} ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# cold start of the bot up to the created client, each run in a fresh interpreter
+# also reports the deferred loads the first search and the first effect pay for when STARTUP_WARM is off
+# usage from the repository root: python -m benchmarks.bench_startup --runs 10
+
+CHILD = '''
+import json
+import main
+from utils.startup_profile import startup_profile
+from utils.ytdlp_pool import create_warm_yt_dlp
+import utils.pcm_effects as pcm_effects
+
+intents = main.discord.Intents.default()
+with startup_profile.measure('create client'):
+    client = main.bot.Client(intents=intents)
+
+startup_profile.set_ready()
+with startup_profile.measure('first yt-dlp instance'):
+    create_warm_yt_dlp()
+
+if pcm_effects.is_available():
+    with startup_profile.measure('first effects stage'):
+        pcm_effects.EffectsStage(volume=0.5)
+
+print(json.dumps(startup_profile.get_stats()))
+'''
+
+def run_child() -> dict:
+    env = dict(os.environ, LOG_LEVEL='WARNING', QUEUE_STORE_ENABLED='false', AUDIO_CACHE_ENABLED='false', METADATA_CACHE_PATH=':memory:')
+    result = subprocess.run([sys.executable, '-c', CHILD], env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description='cold start time of the bot')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters started')
+    args = parser.parse_args()
+
+    # phase name -> durations of every run, in the order the phases first ended
+    durations = {}
+    ready_times = []
+    for _ in range(args.runs):
+        stats = run_child()
+        ready_times.append(stats['ready_ms'])
+        for phase in stats['phases']:
+            if phase['duration_ms']:
+                durations.setdefault(phase['name'], []).append(phase['duration_ms'])
+
+    print(f'client created after            median {statistics.median(ready_times):8.1f} ms  max {max(ready_times):8.1f} ms  ({args.runs} runs)')
+    for name, values in durations.items():
+        print(f'  {name:<30} median {statistics.median(values):8.1f} ms  max {max(values):8.1f} ms')
+
+if __name__ == '__main__':
+    main()
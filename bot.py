@@ -1,7 +1,21 @@
 import discord
 import logging
+import asyncio
+import functools
+import time
+import collections
 
 import utils.misc as misc
+import utils.config as config
+import utils.pcm_effects as pcm_effects
+from utils.startup_profile import startup_profile
+from utils.resolver import Resolver
+from utils.metadata_cache import MetadataCache
+from utils.audio_cache import AudioCache
+from utils.metrics import Metrics
+from utils.queue_store import QueueStore
+from utils.broadcast import BroadcastHub
+from utils.ffmpeg_budget import FFmpegBudget
 from utils.configure_logger import ConfigureLogger
 from audio_player import AudioPlayer
 
@@ -11,68 +25,331 @@ bot_logger_config = ConfigureLogger(logger=logger)
 
 # create child class of discord.py Client
 class Client(discord.Client):
+    COMMANDS = ('\\hello', '\\join', '\\leave', '\\play', '\\playlist', '\\pause', '\\resume', '\\skip', '\\seek', '\\forward', '\\rewind', '\\nowplaying', '\\stats', '\\list', '\\add', '\\remove', '\\move', '\\shuffle', '\\volume', '\\normalize', '\\crossfade')
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.audio_players = {}
+
+        # guild id -> audio player, least recently used first
+        # idle players are disconnected and evicted by the sweeper, the least recently used are evicted past the cap
+        self.audio_players = collections.OrderedDict()
+        self.max_players = config.get_int('MAX_PLAYERS', 1000)
+        self.player_idle_timeout = config.get_float('PLAYER_IDLE_TIMEOUT', 300)
+        self.player_sweep_interval = config.get_float('PLAYER_SWEEP_INTERVAL', 60)
+        self.sweeper_task = None
+
+        # guild id -> task closing the guild's evicted player, a new player of the guild waits for it
+        self.closing_players = {}
+
+        # queued stream urls close to expiring are resolved again in the background
+        self.url_refresh_interval = config.get_float('URL_REFRESH_INTERVAL', 60)
+        self.refresher_task = None
+
+        # when yt-dlp, its extractors, validators and numpy are loaded in the background: 'startup' once logged in, 'ready' after on_ready,
+        # 'off' when they are first used
+        self.startup_warm = config.get_str('STARTUP_WARM', 'ready')
+
+        # shared yt-dlp resolver, every guild's searches run on its workers
+        # repeated searches and songs are answered from the metadata cache
+        metadata_cache = MetadataCache(
+            path=config.get_str('METADATA_CACHE_PATH', 'cache/metadata.sqlite3')
+            , max_entries=config.get_int('METADATA_CACHE_SIZE', 1024)
+        )
+        self.resolver = Resolver(
+            max_workers=config.get_int('RESOLVER_WORKERS', 8)
+            , max_concurrent=config.get_int('RESOLVER_MAX_CONCURRENT', 8)
+            , max_concurrent_per_guild=config.get_int('RESOLVER_MAX_CONCURRENT_PER_GUILD', 5)
+            , timeout=config.get_float('RESOLVER_TIMEOUT', 20)
+            , use_processes=config.get_bool('RESOLVER_USE_PROCESSES', False)
+            , pool_size=config.get_int('RESOLVER_POOL_SIZE', 0)
+            , cache=metadata_cache
+            , warm=False
+        )
+
+        # local copies of played tracks, None when disabled
+        self.audio_cache = None
+        if config.get_bool('AUDIO_CACHE_ENABLED', True):
+            self.audio_cache = AudioCache(
+                directory=config.get_str('AUDIO_CACHE_DIR', 'cache/audio')
+                , max_bytes=config.get_int('AUDIO_CACHE_MAX_BYTES', 1 << 30)
+                , max_pending=config.get_int('AUDIO_CACHE_MAX_PENDING', 20)
+                , pool=self.resolver.pool
+            )
+
+        # every guild's ffmpeg processes, capped by FFMPEG_MAX_PROCESSES with the playing songs going first
+        max_processes = config.get_int('FFMPEG_MAX_PROCESSES', 0)
+        self.ffmpeg_budget = FFmpegBudget(
+            max_processes=max_processes
+            , reserved=config.get_int('FFMPEG_RESERVED_PROCESSES', max_processes // 4)
+            , max_queued=config.get_int('FFMPEG_MAX_QUEUED', 50)
+            , queue_timeout=config.get_float('FFMPEG_QUEUE_TIMEOUT', 10)
+        )
+
+        # guilds playing the same audio from the same time share one ffmpeg process and opus encoder, None when disabled
+        self.broadcasts = None
+        if config.get_bool('BROADCAST_ENABLED', False):
+            self.broadcasts = BroadcastHub(
+                buffer_frames=config.get_int('BROADCAST_BUFFER_FRAMES', 250)
+                , lead_frames=config.get_int('BROADCAST_LEAD_FRAMES', 50)
+                , join_window=config.get_float('BROADCAST_JOIN_WINDOW', 10)
+                , budget=self.ffmpeg_budget
+            )
+
+        # per guild timing histograms, served for prometheus when METRICS_PORT is set
+        self.metrics = Metrics()
+        self.metrics.add_gauges(self.ffmpeg_budget.get_gauges)
+        self.metrics.add_counters(metadata_cache.get_counters)
+        self.metrics.add_gauges(metadata_cache.get_gauges)
+        if self.audio_cache:
+            self.metrics.add_counters(self.audio_cache.get_counters)
+            self.metrics.add_gauges(self.audio_cache.get_gauges)
+
+        # queues and playing positions saved in the background and restored after a restart, None when disabled
+        self.queue_store = None
+        self.queue_store_interval = config.get_float('QUEUE_STORE_INTERVAL', 5)
+        self.queue_store_task = None
+        if config.get_bool('QUEUE_STORE_ENABLED', True):
+            self.queue_store = QueueStore(config.get_str('QUEUE_STORE_PATH', 'cache/queues.sqlite3'))
 
     def get_audio_player(self, guild:discord.Guild) -> AudioPlayer:
-        logger.info(f'Retrieving audio player from {guild}')
+        logger.debug('Retrieving audio player from %s', guild)
         
-        if guild in self.audio_players:
-            logger.info(f'Audio player found')
-            return self.audio_players[guild]
+        if guild.id in self.audio_players:
+            logger.debug('Audio player found')
+            self.audio_players.move_to_end(guild.id)
+            audio_player = self.audio_players[guild.id]
         
         else:
-            logger.info(f'Audio player not found, initializing audio player')
-            self.audio_players[guild] = AudioPlayer(self)
-            return self.audio_players[guild]
-        
+            logger.info('Audio player not found, initializing audio player')
+            audio_player = AudioPlayer(self, guild.id, self.metrics.get_guild(guild.id))
+
+            # the evicted player has to leave the voice channel and save its queue before this one starts
+            closing_task = self.closing_players.get(guild.id)
+            if closing_task:
+                audio_player.commands.queue_job(asyncio.wait, [closing_task])
+
+            if self.queue_store:
+                audio_player.load_saved(guild, self.queue_store)
+
+            self.audio_players[guild.id] = audio_player
+            self.evict_audio_players()
+
+        audio_player.touch()
+        return audio_player
+
+    # the queue is saved before the player is dropped, closing it can put the interrupted entry back so it is saved again after
+    def evict_audio_player(self, guild_id:int):
+        audio_player = self.audio_players[guild_id]
+        if self.queue_store:
+            audio_player.save_snapshot(self.queue_store)
+
+        del self.audio_players[guild_id]
+        closing_task = asyncio.create_task(self.close_audio_player(audio_player))
+        self.closing_players[guild_id] = closing_task
+        closing_task.add_done_callback(functools.partial(self.forget_closing_player, guild_id))
+        logger.info('Evicted audio player of guild %s with %s queued entries', guild_id, audio_player.audio_queue.size)
+
+    # the guild can have been evicted again by the time the earlier close finished
+    def forget_closing_player(self, guild_id:int, closing_task:asyncio.Task):
+        if self.closing_players.get(guild_id) is closing_task:
+            del self.closing_players[guild_id]
+
+    # the evicted player's queue is saved so the player can be restored on the guild's next command
+    async def close_audio_player(self, audio_player:AudioPlayer):
+        try:
+            await audio_player.close()
+
+        finally:
+            if self.queue_store:
+                audio_player.save_snapshot(self.queue_store)
+
+    # evicts the least recently used players that aren't playing until the cap is met
+    def evict_audio_players(self):
+        for guild_id in list(self.audio_players):
+            if len(self.audio_players) <= self.max_players:
+                break
+
+            if not self.audio_players[guild_id].is_playing():
+                self.evict_audio_player(guild_id)
+
+    # periodically disconnects players that have been idle longer than the idle timeout
+    # players with an empty queue are evicted, they are created again on their guild's next command
+    async def sweep_audio_players(self):
+        while True:
+            await asyncio.sleep(self.player_sweep_interval)
+
+            for guild_id, audio_player in list(self.audio_players.items()):
+                try:
+                    if audio_player.get_idle_time() < self.player_idle_timeout:
+                        continue
+
+                    if audio_player.audio_queue.is_empty():
+                        self.evict_audio_player(guild_id)
+
+                    elif audio_player.voice_client or audio_player.entry_buffer:
+                        logger.info('Closing idle audio player of guild %s', guild_id)
+                        await audio_player.close()
+
+                except Exception as e:
+                    logger.error('Error sweeping audio player of guild %s: %s', guild_id, e)
+
+    # periodically resolves again the queued stream urls that expire soon, so they don't need resolving when they play
+    async def refresh_audio_players(self):
+        while True:
+            await asyncio.sleep(self.url_refresh_interval)
+
+            refreshed = 0
+            for guild_id, audio_player in list(self.audio_players.items()):
+                try:
+                    refreshed += audio_player.refresh_entries()
+
+                except Exception as e:
+                    logger.error('Error refreshing audio player of guild %s: %s', guild_id, e)
+
+            if refreshed:
+                logger.info('Refreshing %s stream urls', refreshed)
+
+    # periodically hands every player's changed queue and playing position to the queue store and writes them off the event loop
+    async def save_audio_players(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.queue_store_interval)
+
+            try:
+                for audio_player in list(self.audio_players.values()):
+                    audio_player.save_snapshot(self.queue_store)
+
+                await loop.run_in_executor(None, self.queue_store.flush)
+
+            except Exception as e:
+                logger.error('Error saving audio players: %s', e)
+
+    # restores the most recently saved queues in bulk, other guilds are restored on their next command
+    # with QUEUE_RESUME_PLAYBACK the guilds that were playing reconnect and continue at their saved position
+    async def restore_audio_players(self):
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        saved = await loop.run_in_executor(None, self.queue_store.load_all, self.max_players)
+        resume_playback = config.get_bool('QUEUE_RESUME_PLAYBACK', False)
+
+        restored_entries = 0
+        for guild_id, (entries, resume_time, playback) in saved.items():
+            guild = self.get_guild(guild_id)
+            if not guild or guild_id in self.audio_players:
+                continue
+
+            audio_player = AudioPlayer(self, guild_id, self.metrics.get_guild(guild_id))
+            restored_entries += audio_player.restore(guild, entries, resume_time, playback)
+            self.audio_players[guild_id] = audio_player
+
+            voice_channel = self.get_channel(playback[2]) if playback and playback[2] else None
+            if resume_playback and voice_channel:
+                asyncio.create_task(audio_player.resume_playback(voice_channel))
+
+        logger.info('Restored %s queues with %s entries in %.1fms', len(saved), restored_entries, (time.perf_counter() - start) * 1000)
+
+    async def close(self):
+        if self.sweeper_task:
+            self.sweeper_task.cancel()
+
+        if self.refresher_task:
+            self.refresher_task.cancel()
+
+        # evicted players save their queue once they closed
+        if self.closing_players:
+            await asyncio.wait(list(self.closing_players.values()))
+
+        if self.queue_store:
+            if self.queue_store_task:
+                self.queue_store_task.cancel()
+
+            for audio_player in self.audio_players.values():
+                audio_player.save_snapshot(self.queue_store)
+
+            self.queue_store.close()
+
+        self.resolver.shutdown()
+        if self.audio_cache:
+            self.audio_cache.shutdown()
+
+        self.metrics.close()
+        metrics_path = config.get_str('METRICS_PATH', '')
+        if metrics_path:
+            self.metrics.dump(metrics_path)
+
+        await super().close()
+
     async def on_voice_state_update(self, member, before, after):
+        # an evicted player doesn't need to hear that the bot left
         if member.id == self.user.id:
-            audio_player = self.get_audio_player(member.guild)
-            await audio_player.handle_voice_state_update(member, before, after)
+            audio_player = self.get_audio_player(member.guild) if after.channel else self.audio_players.get(member.guild.id)
+            if audio_player:
+                await audio_player.handle_voice_state_update(member, before, after)
 
-    async def on_ready(self):
-        logger.info(f'Logged on as {self.user}')
+    # loads the modules deferred at startup off the event loop, so the first search and effect don't pay for them
+    def warm(self):
+        loop = asyncio.get_running_loop()
+        self.resolver.warm()
+        loop.run_in_executor(None, startup_profile.import_module, 'validators')
+        if pcm_effects.is_available():
+            loop.run_in_executor(None, pcm_effects.load_numpy)
 
-    async def on_message(self, message):
-        logger.info(f'Message from {message.author}: {message.content}')
+    # logs how long the startup took, and appends it to STARTUP_PROFILE_PATH to track it over time
+    def report_startup(self):
+        logger.info(startup_profile.get_printable())
+        profile_path = config.get_str('STARTUP_PROFILE_PATH', '')
+        if profile_path:
+            try:
+                startup_profile.dump(profile_path)
 
-        if message.author == self.user:
-            return
-        
-        audio_player = self.get_audio_player(message.guild)
-        
-        match misc.get_first_n_words(message.content, 1):
-            case '\\hello':
-                await message.channel.send(f'Hello.')
+            except OSError as e:
+                logger.error('Error writing the startup profile to %s: %s', profile_path, e)
+
+    async def setup_hook(self):
+        startup_profile.mark('logged in')
+        if self.startup_warm == 'startup':
+            self.warm()
 
-            case'\\join':
-                await audio_player.join_voice_channel(message)
+    async def on_ready(self):
+        logger.info('Logged on as %s', self.user)
+
+        # on_ready runs again after a reconnect
+        if startup_profile.set_ready():
+            self.report_startup()
+            if self.startup_warm == 'ready':
+                self.warm()
 
-            case '\\leave':
-                await audio_player.leave_voice_channel(message)
+        if not self.sweeper_task:
+            self.sweeper_task = asyncio.create_task(self.sweep_audio_players())
 
-            case '\\play':
-                await audio_player.play(message)
+        if not self.refresher_task:
+            self.refresher_task = asyncio.create_task(self.refresh_audio_players())
 
-            case '\\pause':
-                await audio_player.pause(message)
+        if self.queue_store and not self.queue_store_task:
+            self.queue_store_task = asyncio.create_task(self.save_audio_players())
+            await self.restore_audio_players()
 
-            case '\\resume':
-                await audio_player.resume(message)
+        metrics_port = config.get_int('METRICS_PORT', 0)
+        if metrics_port:
+            await self.metrics.start_server(config.get_str('METRICS_HOST', '127.0.0.1'), metrics_port)
 
-            case '\\skip':
-                await audio_player.skip(message)
+    async def on_message(self, message):
+        logger.debug('Message from %s: %s', message.author, message.content)
 
-            case '\\nowplaying':
-                await audio_player.now_playing(message)
+        if message.author == self.user:
+            return
 
-            case '\\list':
-                await audio_player.list(message)
+        # most messages aren't commands, they are dropped before an audio player is looked up or created
+        if not message.content.startswith('\\') or not message.guild:
+            return
 
-            case '\\add':
-                await audio_player.add(message)
+        command = misc.get_first_n_words(message.content, 1)
+        if command not in self.COMMANDS:
+            return
 
-            case '\\remove':
-                await audio_player.remove(message)
\ No newline at end of file
+        # the guild's commands run one at a time on its audio player's command queue
+        # a rate limited command or one past the full queue is dropped
+        audio_player = self.get_audio_player(message.guild)
+        future = audio_player.commands.submit(command, message)
+        if future:
+            await future
\ No newline at end of file
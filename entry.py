@@ -1,19 +1,25 @@
 import discord
 from enum import Enum
 
-from utils.timed_audio import TimedAudio
+from utils.timed_audio import TimedAudioMixin
 
 class Entry():
-    def __init__(self, audio_metadata:tuple, message_information:tuple, timed_audio:TimedAudio):
+    __slots__ = ('timed_audio', 'audio_metadata', 'message_information')
+
+    def __init__(self, audio_metadata:tuple, message_information:tuple, timed_audio:TimedAudioMixin):
         self.timed_audio = timed_audio
         self.audio_metadata = audio_metadata
         self.message_information = message_information
 
-AUDIO_METADATA = ('title', 'url', 'duration')
+AUDIO_METADATA = ('title', 'url', 'duration', 'webpage_url', 'id', 'acodec', 'extractor_key')
 class AudioMetadata(Enum):
     TITLE = 0
     URL = 1
     DURATION = 2
+    WEBPAGE_URL = 3
+    ID = 4
+    ACODEC = 5
+    EXTRACTOR_KEY = 6
 
     # takes in the a dictionary from yt-dlp
     # returns a standardized audio metadata formated into a dict
@@ -21,7 +27,16 @@ class AudioMetadata(Enum):
         if not audio:
             return None
         
-        return tuple(audio[metadata] for metadata in AUDIO_METADATA)
+        return tuple(audio.get(metadata) for metadata in AUDIO_METADATA)
+
+    # takes in a flat search entry from yt-dlp, which only links to the webpage
+    # returns audio metadata without a stream url
+    def retrieve_flat_audio_metadata(audio:dict=None) -> tuple:
+        if not audio:
+            return None
+
+        flat_audio = dict(audio, url=None, acodec=None, webpage_url=audio.get('webpage_url') or audio.get('url'), extractor_key=audio.get('extractor_key') or audio.get('ie_key'))
+        return AudioMetadata.retrieve_audio_metadata(flat_audio)
 
 MESSAGE_INFORMATION = ('author', 'channel', 'content')
 class MessageInformation(Enum):
@@ -1,24 +1,33 @@
-import discord
+from utils.startup_profile import startup_profile
+
 import logging
 import os
 from dotenv import load_dotenv, find_dotenv
 
+# load environment variables from credentials.env
+# loaded before the other modules are imported since their loggers are configured at import time
+load_dotenv(override=True)
+
+with startup_profile.measure('import discord'):
+    import discord
+
 from utils.configure_logger import ConfigureLogger
-import bot
+
+with startup_profile.measure('import bot'):
+    import bot
 
 # retrieve discord's logger and configure logger
 logger = logging.getLogger('discord')
 discord_logger_config = ConfigureLogger(logger=logger)
-
-# load environment variables from credentials.env
-load_dotenv(override=True)
-logger.info(f'Loading .env from {find_dotenv()}')
+logger.info('Loaded .env from %s', find_dotenv())
 
 def main():
     intents = discord.Intents.default()
     intents.message_content = True
 
-    client = bot.Client(intents=intents)
+    with startup_profile.measure('create client'):
+        client = bot.Client(intents=intents)
+
     token = os.getenv('CLIENT_TOKEN')
     client.run(
         token=token
@@ -26,4 +35,4 @@ def main():
     )
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
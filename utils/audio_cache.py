@@ -0,0 +1,219 @@
+import os
+import re
+import time
+import logging
+import threading
+import concurrent.futures
+from collections import OrderedDict
+
+from utils.ytdlp_pool import YtDlpPool
+from utils.configure_logger import ConfigureLogger
+from entry import AudioMetadata
+
+# retrieve class logger and configure logger
+logger = logging.getLogger('audio_cache')
+audio_cache_logger_config = ConfigureLogger(logger=logger)
+
+# files yt-dlp leaves behind while a download is in progress
+PARTIAL_SUFFIXES = ('.part', '.ytdl', '.temp')
+
+# extensions of the files a bestaudio download produces, other files in the cache directory aren't indexed or evicted
+AUDIO_EXTENSIONS = ('.webm', '.m4a', '.mp4', '.mp3', '.opus', '.ogg', '.oga', '.aac', '.flac', '.wav', '.mka')
+
+# yt-dlp extractor keys, e.g. Youtube or Soundcloud, the names of the cache's subdirectories
+EXTRACTOR_KEY_PATTERN = re.compile(r'[A-Za-z0-9]+')
+
+# returns the cache key of a song, 'extractor_key:id' since ids are only unique within their extractor
+# None when yt-dlp didn't report either of them
+def get_cache_key(audio_metadata:tuple) -> str:
+    extractor_key = audio_metadata[AudioMetadata.EXTRACTOR_KEY.value]
+    video_id = audio_metadata[AudioMetadata.ID.value]
+    if not extractor_key or not video_id:
+        return None
+
+    return f'{extractor_key}:{video_id}'
+
+# size bounded directory of downloaded audio files keyed by extractor and video id, one subdirectory per extractor
+# a track is downloaded in the background the first time it plays, later plays read the local file
+# least recently played files are deleted once the directory is over its byte budget
+# downloads borrow an instance from the resolver's yt-dlp pool, a played track isn't downloaded while max_pending downloads are queued or running
+class AudioCache():
+    def __init__(self, directory:str='cache/audio', max_bytes:int=1 << 30, max_downloads:int=2, max_pending:int=20, pool:YtDlpPool=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+        self.pool = pool or YtDlpPool(max_downloads)
+
+        # cache key -> (path, size) in least to most recently used order
+        self.files = OrderedDict()
+        self.total_bytes = 0
+        self.downloading = set()
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_downloads, thread_name_prefix='audio-cache')
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.downloads = 0
+        self.skipped_downloads = 0
+        self.evictions = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.load_directory()
+        logger.info('Audio cache opened at %s with %s files and %s bytes', self.directory, len(self.files), self.total_bytes)
+
+    # rebuilds the index from the files on disk, ordered by modification time which is touched on each hit
+    # only audio files in extractor subdirectories are indexed, anything else in the directory is left alone
+    def load_directory(self):
+        entries = []
+        for extractor_key in os.listdir(self.directory):
+            extractor_directory = os.path.join(self.directory, extractor_key)
+            if not EXTRACTOR_KEY_PATTERN.fullmatch(extractor_key) or not os.path.isdir(extractor_directory):
+                continue
+
+            for name in os.listdir(extractor_directory):
+                path = os.path.join(extractor_directory, name)
+                if not os.path.isfile(path):
+                    continue
+
+                if name.endswith(PARTIAL_SUFFIXES):
+                    os.remove(path)
+                    continue
+
+                video_id, extension = os.path.splitext(name)
+                if extension.lower() not in AUDIO_EXTENSIONS:
+                    continue
+
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, f'{extractor_key}:{video_id}', path, stat.st_size))
+
+        for _, key, path, size in sorted(entries):
+            self.files[key] = (path, size)
+            self.total_bytes += size
+
+        self.evict()
+
+    # checks for the song without counting a hit or marking it as used
+    def contains(self, key:str=None) -> bool:
+        return key in self.files
+
+    # returns the local path of the song's audio, or None if it isn't cached
+    # sources started ahead of time look songs up too, hits and misses are counted by count_play once the song plays
+    def lookup(self, key:str=None) -> str:
+        with self.lock:
+            if key not in self.files:
+                return None
+
+            path, _ = self.files[key]
+            self.files.move_to_end(key)
+
+        try:
+            os.utime(path)
+
+        except OSError:
+            pass
+
+        return path
+
+    # counts a song that started playing, from its local file or streamed
+    def count_play(self, key:str=None, cached:bool=False):
+        with self.lock:
+            if not cached or key not in self.files:
+                self.misses += 1
+                return
+
+            self.hits += 1
+            self.bytes_saved += self.files[key][1]
+
+    # starts downloading the song's audio in the background if it isn't cached or downloading already
+    def download(self, key:str=None, webpage_url:str=None):
+        if not key or not webpage_url:
+            return
+
+        with self.lock:
+            if key in self.files or key in self.downloading:
+                return
+
+            if len(self.downloading) >= self.max_pending:
+                self.skipped_downloads += 1
+                logger.info('Not caching %s, %s downloads pending', key, len(self.downloading))
+                return
+
+            self.downloading.add(key)
+
+        self.executor.submit(self.download_sync, key, webpage_url, time.perf_counter())
+
+    def download_sync(self, key:str, webpage_url:str, queued_time:float):
+        extractor_key, _, video_id = key.partition(':')
+        outtmpl = os.path.join(self.directory, extractor_key, f'{video_id}.%(ext)s')
+
+        try:
+            # the pool imports yt-dlp with its first instance, not when the bot starts
+            path = self.pool.call(queued_time, 'download_audio', webpage_url, outtmpl)
+            size = os.path.getsize(path)
+            with self.lock:
+                self.files[key] = (path, size)
+                self.total_bytes += size
+                self.downloads += 1
+                self.evict()
+
+            logger.info('Cached %s at %s (%s bytes)', key, path, size)
+
+        except Exception as e:
+            logger.error('Error caching %s: %s', key, e)
+
+        finally:
+            with self.lock:
+                self.downloading.discard(key)
+
+    # deletes the least recently used files until the cache fits its byte budget
+    # a file that is still being played stays readable by ffmpeg until it is closed
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.files:
+            key, (path, size) = self.files.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+
+            try:
+                os.remove(path)
+
+            except OSError as e:
+                logger.error('Error evicting %s: %s', path, e)
+
+            logger.info('Evicted %s (%s bytes)', key, size)
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits
+            , 'misses': self.misses
+            , 'hit_rate': self.hits / lookups if lookups else 0
+            , 'bytes_saved': self.bytes_saved
+            , 'downloads': self.downloads
+            , 'skipped_downloads': self.skipped_downloads
+            , 'evictions': self.evictions
+            , 'files': len(self.files)
+            , 'bytes': self.total_bytes
+        }
+
+    # process wide counters and gauges for the metrics endpoint
+    def get_counters(self) -> dict:
+        return {
+            'audio_cache_hits_total': self.hits
+            , 'audio_cache_misses_total': self.misses
+            , 'audio_cache_bytes_saved_total': self.bytes_saved
+            , 'audio_cache_downloads_total': self.downloads
+            , 'audio_cache_downloads_skipped_total': self.skipped_downloads
+            , 'audio_cache_evictions_total': self.evictions
+        }
+
+    def get_gauges(self) -> dict:
+        return {'audio_cache_files': len(self.files), 'audio_cache_bytes': self.total_bytes}
+
+    def get_printable(self) -> str:
+        stats = self.get_stats()
+        return f'audio cache: {stats["hits"]} hits, {stats["misses"]} misses, {stats["hit_rate"]:.0%} hit rate, {stats["bytes_saved"]} bytes saved, {stats["files"]} files ({stats["bytes"]} bytes), {stats["downloads"]} downloads ({stats["skipped_downloads"]} skipped), {stats["evictions"]} evictions\n'
+
+    def shutdown(self):
+        logger.info('Shutting down audio cache with stats %s', self.get_stats())
+        self.executor.shutdown(wait=False, cancel_futures=True)
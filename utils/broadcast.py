@@ -0,0 +1,302 @@
+import logging
+import weakref
+import threading
+import collections
+
+import discord
+
+from utils.timed_audio import TimedAudioMixin, create_timed_audio, OPUS_CODECS
+from utils.ffmpeg_budget import FFmpegBudget, PLAYING
+from utils.configure_logger import ConfigureLogger
+
+# retrieve class logger and configure logger
+logger = logging.getLogger('broadcast')
+broadcast_logger_config = ConfigureLogger(logger=logger)
+
+# reads the opus packets a broadcast pushes to one subscriber
+# each subscriber has its own bounded buffer, a subscriber that falls behind drops its oldest packets instead of holding up the others
+class BroadcastReader(discord.AudioSource):
+    def init_reader(self, broadcast, max_frames:int=250):
+        self.broadcast = broadcast
+        self.packets = collections.deque()
+        self.max_frames = max_frames
+        self.condition = threading.Condition()
+        self.closed = False
+
+        # packets this subscriber never read, it joined late or fell behind, counted towards its elapsed time
+        self.dropped_frames = 0
+
+    # called from the broadcast's thread
+    def push(self, packet:bytes):
+        with self.condition:
+            if len(self.packets) >= self.max_frames:
+                self.packets.popleft()
+                self.dropped_frames += 1
+
+            self.packets.append(packet)
+            self.condition.notify()
+
+    def finish(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def get_buffered(self) -> int:
+        return len(self.packets)
+
+    # packets are encoded once by the broadcast, discord.py sends them as is
+    def is_opus(self) -> bool:
+        return True
+
+    # blocks until the broadcast pushes a packet, returns b'' once it ended and the buffer is empty
+    def read(self) -> bytes:
+        with self.condition:
+            while not self.packets and not self.broadcast.ended and not self.closed:
+                self.condition.wait(0.5)
+
+            packet = self.packets.popleft() if self.packets else b''
+
+        self.broadcast.request_frames()
+        return packet
+
+    def cleanup(self):
+        if not self.closed:
+            self.closed = True
+            self.broadcast.hub.unsubscribe(self.broadcast, self)
+
+# a subscriber's view of a broadcast, used by the audio player like any other timed audio
+class BroadcastSource(TimedAudioMixin, BroadcastReader):
+    def __init__(self, broadcast, start_time:float=0, max_frames:int=250):
+        self.init_timed_audio(broadcast.source.input_source, start_time)
+        self.init_reader(broadcast, max_frames)
+
+        # a subscriber joining a running broadcast starts where the broadcast is
+        self.dropped_frames = broadcast.frames
+
+    def get_elapsed_time(self):
+        return super().get_elapsed_time() + self.dropped_frames * 0.02
+
+    def get_process_source(self):
+        return self.broadcast.source
+
+    # the shared pipeline's failure is every subscriber's failure
+    def ended_abnormally(self, timeout:float=1) -> bool:
+        return self.ended and self.broadcast.abnormal
+
+# one ffmpeg pipeline shared by every subscriber of the same audio and start time
+# a thread reads the frames, encodes pcm to opus once, and pushes each packet to every subscriber
+# it reads ahead of the subscriber furthest along by at most lead_frames, so prefetched subscribers don't lose their first frames
+class Broadcast():
+    def __init__(self, hub, key:tuple, source:TimedAudioMixin, lead_frames:int=50):
+        self.hub = hub
+        self.key = key
+        self.source = source
+        self.lead_frames = lead_frames
+
+        # guarded by the hub's lock
+        self.subscribers = set()
+        self.stopped = False
+
+        self.frames = 0
+        self.ended = False
+        self.abnormal = False
+        self.wanted = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f'broadcast-{source.stderr_reader.name}', daemon=True)
+
+    def get_position(self) -> float:
+        return self.source.start_time + self.frames * 0.02
+
+    # wakes the thread up when a subscriber read a packet
+    def request_frames(self):
+        self.wanted.set()
+
+    def run(self):
+        subscribers = []
+        try:
+            encoder = None if self.source.is_opus() else discord.opus.Encoder()
+            while not self.stopped:
+                with self.hub.lock:
+                    subscribers = list(self.subscribers)
+
+                if not any(subscriber.get_buffered() < self.lead_frames for subscriber in subscribers):
+                    self.wanted.wait(0.02)
+                    self.wanted.clear()
+                    continue
+
+                data = self.source.read()
+                if not data:
+                    break
+
+                packet = data if encoder is None else encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+                self.frames += 1
+                for subscriber in subscribers:
+                    subscriber.push(packet)
+
+        except Exception as e:
+            logger.error('Error in broadcast of %s: %s', self.source.input_source, e)
+
+        finally:
+            self.abnormal = not self.stopped and self.source.ended_abnormally()
+            self.ended = True
+            self.hub.remove(self)
+
+            with self.hub.lock:
+                subscribers = list(self.subscribers)
+
+            for subscriber in subscribers:
+                subscriber.finish()
+
+            self.source.cleanup()
+            logger.info('Broadcast of %s ended after %s frames', self.source.input_source, self.frames)
+
+# process wide registry of broadcasts, keyed by audio source, start time and whether the stream is passed through as opus
+# subscribers are reference counted, the pipeline stops when its last subscriber is cleaned up
+class BroadcastHub():
+    def __init__(self, buffer_frames:int=250, lead_frames:int=50, join_window:float=10, budget:FFmpegBudget=None):
+        self.buffer_frames = buffer_frames
+        self.lead_frames = lead_frames
+
+        # counts the broadcasts' ffmpeg processes, one per broadcast however many guilds subscribe
+        self.budget = budget
+
+        # seconds a broadcast can have played for and still be joined, later subscribers start their own
+        self.join_window = join_window
+
+        self.broadcasts = {}
+        self.lock = threading.Lock()
+
+        # sources started ahead of time -> the key of the broadcast they join or start once they play
+        self.pending = weakref.WeakKeyDictionary()
+
+        self.created = 0
+        self.joined = 0
+        self.can_encode = None
+
+    # pcm streams are encoded by the broadcast, which needs the opus library discord.py loads for voice
+    def is_encoder_available(self) -> bool:
+        if self.can_encode is None:
+            try:
+                discord.opus.Encoder()
+                self.can_encode = True
+
+            except discord.opus.OpusNotLoaded:
+                logger.warning('Opus library not loaded, only opus streams are broadcast')
+                self.can_encode = False
+
+        return self.can_encode
+
+    # returns a running broadcast of key that can still be joined, None if there is none, called with the lock held
+    def get_joinable(self, key:tuple) -> Broadcast:
+        broadcast = self.broadcasts.get(key)
+        if broadcast and (broadcast.ended or broadcast.stopped or broadcast.get_position() - key[1] > self.join_window):
+            return None
+
+        return broadcast
+
+    # adds a subscriber to the broadcast and starts its thread if it's new, called with the lock held
+    def add_subscriber(self, broadcast:Broadcast, start_time:float) -> BroadcastSource:
+        subscriber = BroadcastSource(broadcast, start_time, self.buffer_frames)
+        broadcast.subscribers.add(subscriber)
+        if not broadcast.thread.is_alive():
+            broadcast.thread.start()
+
+        return subscriber
+
+    # returns a source playing the audio at start_time, sharing a running broadcast of it when there is one
+    # pcm streams play from their own ffmpeg process when they can't be encoded
+    # only playing sources share a broadcast, a source started ahead of time (priority other than PLAYING) gets its own process
+    # so a guild playing the audio doesn't read it past the frames the source buffers, it joins or starts a broadcast in promote
+    def subscribe(self, source:str, start_time:float=0, codec:str=None, passthrough:bool=True, priority:int=PLAYING) -> TimedAudioMixin:
+        is_opus = passthrough and codec in OPUS_CODECS
+        if not is_opus and not self.is_encoder_available():
+            return create_timed_audio(source, start_time, codec=codec, passthrough=passthrough, budget=self.budget, priority=priority)
+
+        key = (source, start_time, is_opus)
+        if priority != PLAYING:
+            timed_audio = create_timed_audio(source, start_time, codec=codec, passthrough=passthrough, budget=self.budget, priority=priority)
+            with self.lock:
+                self.pending[timed_audio] = key
+
+            return timed_audio
+
+        with self.lock:
+            broadcast = self.get_joinable(key)
+            if broadcast:
+                self.joined += 1
+
+            else:
+                broadcast = Broadcast(self, key, create_timed_audio(source, start_time, codec=codec, passthrough=passthrough, budget=self.budget, priority=priority), self.lead_frames)
+                self.broadcasts[key] = broadcast
+                self.created += 1
+
+            subscriber = self.add_subscriber(broadcast, start_time)
+
+        logger.info('Subscribed to broadcast of %s at %ss, %s subscribers', source, start_time, len(broadcast.subscribers))
+        return subscriber
+
+    # called when a source started ahead of time by subscribe starts playing, returns the source to play
+    # it joins a running broadcast of its audio and stops its own process, or its process becomes the pipeline of a new broadcast
+    # the frames it already read ahead are played first, sources that aren't pending are returned as they are
+    def promote(self, timed_audio:TimedAudioMixin) -> TimedAudioMixin:
+        with self.lock:
+            key = self.pending.pop(timed_audio, None)
+            if key is None or timed_audio.cleaned_up:
+                return timed_audio
+
+            broadcast = self.get_joinable(key)
+            if broadcast:
+                self.joined += 1
+
+            else:
+                # the broadcast's source is read by its thread, the guild's timings and effects are the subscriber's
+                timed_audio.metrics = None
+                timed_audio.effects = None
+                broadcast = Broadcast(self, key, timed_audio, self.lead_frames)
+                broadcast.frames = int(timed_audio.elapsed_time / 20)
+                self.broadcasts[key] = broadcast
+                self.created += 1
+
+            subscriber = self.add_subscriber(broadcast, key[1])
+
+        if broadcast.source is not timed_audio:
+            timed_audio.cleanup()
+
+        if self.budget:
+            self.budget.promote(broadcast.source)
+
+        logger.info('Promoted %s into a broadcast of %s subscribers', timed_audio.input_source, len(broadcast.subscribers))
+        return subscriber
+
+    def unsubscribe(self, broadcast:Broadcast, subscriber:BroadcastSource):
+        with self.lock:
+            broadcast.subscribers.discard(subscriber)
+            last = not broadcast.subscribers
+            if last:
+                broadcast.stopped = True
+                if self.broadcasts.get(broadcast.key) is broadcast:
+                    del self.broadcasts[broadcast.key]
+
+        # stops ffmpeg so the thread's read returns
+        if last:
+            logger.info('Last subscriber left the broadcast of %s', broadcast.source.input_source)
+            broadcast.wanted.set()
+            broadcast.source.cleanup()
+
+    def remove(self, broadcast:Broadcast):
+        with self.lock:
+            if self.broadcasts.get(broadcast.key) is broadcast:
+                del self.broadcasts[broadcast.key]
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            broadcasts = list(self.broadcasts.values())
+
+        return {
+            'broadcasts': len(broadcasts)
+            , 'subscribers': sum(len(broadcast.subscribers) for broadcast in broadcasts)
+            , 'created': self.created
+            , 'joined': self.joined
+        }
+
+    def get_printable(self) -> str:
+        stats = self.get_stats()
+        return f'broadcasts: {stats["broadcasts"]} running with {stats["subscribers"]} subscribers, {stats["joined"]} of {stats["joined"] + stats["created"]} sources shared\n'
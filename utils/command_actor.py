@@ -0,0 +1,185 @@
+import time
+import asyncio
+import logging
+import functools
+import collections
+
+from utils.metrics import GuildMetrics, get_elapsed_ms
+from utils.configure_logger import ConfigureLogger
+
+# retrieve class logger and configure logger
+logger = logging.getLogger('command_actor')
+command_actor_logger_config = ConfigureLogger(logger=logger)
+
+# repeats of these queued right behind each other run once with a count, e.g. three \skip run as one skip of 3
+COUNTED_COMMANDS = ('\\skip',)
+
+# identical repeats of these queued right behind each other share one reply
+SHARED_COMMANDS = ('\\list', '\\nowplaying', '\\stats')
+
+# a queued command, or a job of the audio player when func is set
+class Command():
+    def __init__(self, name:str, message=None, func=None):
+        self.name = name
+        self.message = message
+        self.func = func
+        self.count = 1
+
+        # result of the prepare function, e.g. the audio metadata a \play resolved before it was queued
+        self.argument = None
+
+        # resolved once the command ran, shared by the commands coalesced into it
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_time = time.perf_counter()
+
+    def can_coalesce(self, command) -> bool:
+        if self.func or command.func or self.name != command.name:
+            return False
+
+        if self.name in COUNTED_COMMANDS:
+            return True
+
+        return self.name in SHARED_COMMANDS and self.message.channel == command.message.channel and self.message.content == command.message.content
+
+# token bucket per user, a user can send burst commands at once and rate commands per second after that
+class RateLimiter():
+    MAX_BUCKETS = 1024
+
+    def __init__(self, rate:float=1, burst:int=5):
+        self.rate = rate
+        self.burst = burst
+
+        # user id -> (tokens, time of the last update)
+        self.buckets = {}
+
+    def allow(self, key:int) -> bool:
+        now = time.monotonic()
+        tokens, last_time = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last_time) * self.rate)
+        allowed = tokens >= 1
+        self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+
+        # users whose bucket refilled are forgotten
+        if len(self.buckets) > self.MAX_BUCKETS:
+            self.buckets = {
+                key: (tokens, last_time) for key, (tokens, last_time) in self.buckets.items()
+                if tokens + (now - last_time) * self.rate < self.burst
+            }
+
+        return allowed
+
+# single consumer queue of one guild's commands
+# commands run one at a time in the order they were queued so they can't interleave on the audio player's state
+# commands in prepared_commands run their prepare function first, outside the queue, so a search waiting on
+# the user's choice doesn't hold up the guild's other commands, they are queued once prepared
+class CommandActor():
+    def __init__(self, guild_id:int, handler, prepare=None, prepared_commands:tuple=(), max_pending:int=20, rate:float=1, burst:int=5, metrics:GuildMetrics=None):
+        self.guild_id = guild_id
+        self.handler = handler
+        self.prepare = prepare
+        self.prepared_commands = prepared_commands
+        self.max_pending = max_pending
+        self.rate_limiter = RateLimiter(rate, burst)
+        self.metrics = metrics or GuildMetrics(guild_id)
+
+        self.pending = collections.deque()
+        self.preparing = set()
+        self.consumer_task = None
+
+    # queues a command from a message, returns a future resolved once it ran or None if it was rejected
+    def submit(self, name:str, message) -> asyncio.Future:
+        if not self.rate_limiter.allow(message.author.id):
+            logger.info('Rate limited %s from %s in guild %s', name, message.author, self.guild_id)
+            self.metrics.increment('commands_rate_limited_total')
+            return None
+
+        if len(self.pending) + len(self.preparing) >= self.max_pending:
+            logger.info('Rejected %s in guild %s, %s commands pending', name, self.guild_id, len(self.pending) + len(self.preparing))
+            self.metrics.increment('commands_rejected_total')
+            return None
+
+        self.metrics.increment('commands_total')
+        command = Command(name, message)
+        if self.prepare and name in self.prepared_commands and len(message.content.split()) > 1:
+            task = asyncio.create_task(self.prepare_command(command))
+            self.preparing.add(task)
+            task.add_done_callback(self.preparing.discard)
+            return command.future
+
+        return self.queue(command)
+
+    # queues a job of the audio player and waits for it to run, e.g. starting the next entry when a track ends
+    # must not be awaited from inside a command, the command would wait on itself
+    async def run(self, func, *args):
+        return await self.queue_job(func, *args)
+
+    # queues a job of the audio player without waiting for it, returns a future resolved once it ran
+    def queue_job(self, func, *args) -> asyncio.Future:
+        return self.queue(Command(func.__name__, func=functools.partial(func, *args)))
+
+    async def prepare_command(self, command:Command):
+        try:
+            command.argument = await self.prepare(command.name, command.message)
+
+        except asyncio.CancelledError:
+            command.future.cancel()
+            raise
+
+        except Exception as e:
+            logger.error('Error preparing %s in guild %s: %s', command.name, self.guild_id, e)
+
+        # the prepare function has told the user why it failed
+        if command.argument is None:
+            command.future.set_result(None)
+            return
+
+        command.queued_time = time.perf_counter()
+        self.queue(command)
+
+    # merges the command into the last queued one when they can be coalesced, returns the future of the command that will run
+    def queue(self, command:Command) -> asyncio.Future:
+        if self.pending and self.pending[-1].can_coalesce(command):
+            self.pending[-1].count += 1
+            self.metrics.increment('commands_coalesced_total')
+            logger.info('Coalesced %s into %s of count %s in guild %s', command.name, command.name, self.pending[-1].count, self.guild_id)
+            return self.pending[-1].future
+
+        self.pending.append(command)
+        if not self.consumer_task:
+            self.consumer_task = asyncio.create_task(self.consume())
+
+        return command.future
+
+    # runs queued commands until the queue is empty, a new consumer is started by the next command
+    async def consume(self):
+        while self.pending:
+            command = self.pending.popleft()
+            self.metrics.observe('command_wait_ms', get_elapsed_ms(command.queued_time))
+
+            try:
+                result = await (command.func() if command.func else self.handler(command))
+                if not command.future.done():
+                    command.future.set_result(result)
+
+            except asyncio.CancelledError:
+                command.future.cancel()
+                raise
+
+            except Exception as e:
+                logger.error('Error running %s in guild %s: %s', command.name, self.guild_id, e)
+                if not command.future.done():
+                    command.future.set_exception(e)
+
+        self.consumer_task = None
+
+    # drops every pending command, called when the audio player closes
+    def close(self):
+        for task in list(self.preparing):
+            task.cancel()
+
+        if self.consumer_task:
+            self.consumer_task.cancel()
+            self.consumer_task = None
+
+        while self.pending:
+            self.pending.popleft().future.cancel()
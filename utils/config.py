@@ -0,0 +1,24 @@
+import os
+
+# retrieves configuration values from environment variables (loaded from .env in main.py)
+# values are read when they are needed instead of at import time so .env has already been loaded
+# falls back to the default when the variable is unset or empty
+
+def get_str(name:str='', default:str='') -> str:
+    value = os.getenv(name)
+    return value if value else default
+
+def get_int(name:str='', default:int=0) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+def get_float(name:str='', default:float=0) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+def get_bool(name:str='', default:bool=False) -> bool:
+    value = os.getenv(name)
+    if not value:
+        return default
+
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
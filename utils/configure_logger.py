@@ -1,31 +1,101 @@
 import logging
+import logging.handlers
 import os
-import contextvars
-from contextlib import contextmanager
+import queue
+import atexit
+
+import utils.config as config
+
+# hands records to the listener thread without formatting them on the calling thread
+# each record is queued with the file handler of the logger it was logged to, which formats and writes it on the listener thread
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue:queue.SimpleQueue, target:logging.Handler):
+        super().__init__(queue)
+        self.target = target
+
+    def prepare(self, record:logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record:logging.LogRecord):
+        self.queue.put_nowait((self.target, record))
+
+# single background thread writing the records of every logger to that logger's file handler
+class DispatchingQueueListener(logging.handlers.QueueListener):
+    def handle(self, item:tuple):
+        target, record = item
+        target.handle(record)
 
 # handles output to separate files and configures logger output
 class ConfigureLogger():
     # make logs directory if it doesn't exist
     os.makedirs('logs', exist_ok=True)
 
+    # queue and background writer thread shared by every logger using the queue backend, stopped at exit to flush them
+    log_queue = queue.SimpleQueue()
+    listener = None
+
     # initialize
     def __init__(self, logger:logging.Logger, log_level:int=logging.DEBUG):
         # set logger as an instance variable
         self.logger = logger
 
-        # set log level
-        self.logger.setLevel(log_level)
+        # set log level, LOG_LEVEL sets the default and LOG_LEVELS sets single loggers (audio_queue=WARNING,discord=INFO)
+        self.logger.setLevel(self.get_configured_level(log_level))
+
+        # format log messages 
+        dt_fmt = '%Y-%m-%d %H:%M:%S'
+        formatter = logging.Formatter('[{asctime}] [{levelname:<8}] {funcName}: {message}', dt_fmt, style='{')
 
         # set up logging handler to write logs to separate .log files in the logs directory
+        # files are opened by their first record, loggers that stay quiet don't open a file at startup
         self.filename = f'logs/{self.logger.name}.log'
-        handler = logging.FileHandler(
+        if config.get_bool('LOG_ASYNC', False):
+            handler = self.configure_queue_handler(formatter)
+
+        else:
+            handler = logging.FileHandler(
+                filename=self.filename
+                , encoding='utf-8'
+                , mode='w'
+                , delay=True
+            )
+            handler.setFormatter(formatter)
+
+        self.logger.addHandler(handler)
+
+    # returns the level configured for this logger, or log_level if none is configured
+    def get_configured_level(self, log_level:int) -> int:
+        level_name = config.get_str('LOG_LEVEL', logging.getLevelName(log_level))
+        for logger_level in config.get_str('LOG_LEVELS', '').split(','):
+            name, _, logger_level_name = logger_level.partition('=')
+            if name.strip() == self.logger.name and logger_level_name:
+                level_name = logger_level_name
+
+        return logging.getLevelName(level_name.strip().upper())
+
+    # records are put on the shared queue and written by the shared background thread to this logger's rotating file
+    # keeps disk writes off the event loop thread
+    def configure_queue_handler(self, formatter:logging.Formatter) -> logging.Handler:
+        file_handler = logging.handlers.RotatingFileHandler(
             filename=self.filename
             , encoding='utf-8'
-            , mode='w'
+            , maxBytes=config.get_int('LOG_MAX_BYTES', 10 * 1024 * 1024)
+            , backupCount=config.get_int('LOG_BACKUP_COUNT', 3)
+            , delay=True
         )
-        self.logger.addHandler(handler)
+        file_handler.setFormatter(formatter)
 
-        # format log messages 
-        dt_fmt = '%Y-%m-%d %H:%M:%S'
-        formatter = logging.Formatter('[{asctime}] [{levelname:<8}] {funcName}: {message}', dt_fmt, style='{')
-        handler.setFormatter(formatter)
\ No newline at end of file
+        if ConfigureLogger.listener is None:
+            ConfigureLogger.listener = DispatchingQueueListener(ConfigureLogger.log_queue)
+            ConfigureLogger.listener.start()
+
+        return DeferredQueueHandler(ConfigureLogger.log_queue, file_handler)
+
+    # writes the queued records and stops the background thread, a logger configured after this starts it again
+    @staticmethod
+    def stop_listener():
+        if ConfigureLogger.listener is not None:
+            ConfigureLogger.listener.stop()
+            ConfigureLogger.listener = None
+
+atexit.register(ConfigureLogger.stop_listener)
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import weakref
+import threading
+import collections
+
+from utils.configure_logger import ConfigureLogger
+
+# retrieve class logger and configure logger
+logger = logging.getLogger('ffmpeg_budget')
+ffmpeg_budget_logger_config = ConfigureLogger(logger=logger)
+
+# what a source's ffmpeg process is started for, the most important first
+PLAYING = 0
+PREROLL = 1
+PREFETCH = 2
+SPECULATIVE = 3
+PRIORITY_NAMES = ('playing', 'preroll', 'prefetch', 'speculative')
+
+# raised when a playing source can't get an ffmpeg process
+class BudgetExhausted(Exception):
+    pass
+
+# process wide cap on the ffmpeg processes of every guild's sources
+# playing sources can use every process, prefetch, preroll and prebuffered sources leave the reserved processes to them
+# a playing source over the cap waits in line for a process to exit and is rejected when the line is full or it waited too long,
+# other sources over their cap aren't started, they are started once they play
+class FFmpegBudget():
+    def __init__(self, max_processes:int=0, reserved:int=None, max_queued:int=50, queue_timeout:float=10):
+        # 0 doesn't cap the processes, they are still counted
+        self.max_processes = max_processes
+        self.reserved = max_processes // 4 if reserved is None else reserved
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+
+        # running source -> priority, sources are added when their ffmpeg process starts and removed when it is cleaned up
+        # cleanups happen on the voice threads as well as the event loop
+        self.sources = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+        # one token per playing source waiting for a process, first in line first
+        self.waiters = collections.deque()
+        self.condition = asyncio.Condition()
+        self.loop = None
+
+        self.peak = 0
+        self.queued = 0
+        self.rejected = [0] * len(PRIORITY_NAMES)
+
+    def get_active(self) -> int:
+        return len(self.sources)
+
+    def has_process(self, priority:int=PLAYING) -> bool:
+        if not self.max_processes:
+            return True
+
+        limit = self.max_processes if priority == PLAYING else self.max_processes - self.reserved
+        return self.get_active() < limit
+
+    # whether a source that isn't playing yet can start its process now, counted as rejected if it can't
+    # playing sources waiting in line go first
+    def try_admit(self, priority:int) -> bool:
+        if self.has_process(priority) and not self.waiters:
+            return True
+
+        self.rejected[priority] += 1
+        logger.info('Not starting a %s source, %s of %s processes running and %s waiting', PRIORITY_NAMES[priority], self.get_active(), self.max_processes, len(self.waiters))
+        return False
+
+    # waits until a playing source can start its process, returns whether it had to wait
+    # the source has to be started right after, without awaiting in between, so nothing takes the process first
+    async def wait(self) -> bool:
+        if not self.waiters and self.has_process(PLAYING):
+            return False
+
+        if len(self.waiters) >= self.max_queued:
+            self.rejected[PLAYING] += 1
+            raise BudgetExhausted(f'{len(self.waiters)} sources are already waiting for one of {self.max_processes} ffmpeg processes')
+
+        self.loop = asyncio.get_running_loop()
+        token = object()
+        self.waiters.append(token)
+        self.queued += 1
+        logger.info('Waiting for an ffmpeg process, %s running and %s waiting', self.get_active(), len(self.waiters))
+
+        try:
+            async with self.condition:
+                await asyncio.wait_for(self.condition.wait_for(lambda: self.waiters[0] is token and self.has_process(PLAYING)), self.queue_timeout)
+
+        except asyncio.TimeoutError:
+            self.rejected[PLAYING] += 1
+            raise BudgetExhausted(f'no ffmpeg process exited within {self.queue_timeout:g}s') from None
+
+        finally:
+            self.waiters.remove(token)
+            self.notify_waiters()
+
+        return True
+
+    def add(self, source, priority:int=PLAYING):
+        with self.lock:
+            self.sources[source] = priority
+            self.peak = max(self.peak, len(self.sources))
+
+    # called from the source's cleanup, on any thread
+    def remove(self, source):
+        with self.lock:
+            self.sources.pop(source, None)
+
+        self.notify_waiters()
+
+    # a prefetched or prerolled source that starts playing counts as playing
+    def promote(self, source, priority:int=PLAYING):
+        with self.lock:
+            if source in self.sources:
+                self.sources[source] = min(self.sources[source], priority)
+
+    def notify_waiters(self):
+        if self.waiters and self.loop and not self.loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self.notify_all(), self.loop)
+
+    async def notify_all(self):
+        async with self.condition:
+            self.condition.notify_all()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            priorities = list(self.sources.values())
+
+        return {
+            'max_processes': self.max_processes
+            , 'active': len(priorities)
+            , 'active_by_priority': {name: priorities.count(priority) for priority, name in enumerate(PRIORITY_NAMES)}
+            , 'waiting': len(self.waiters)
+            , 'peak': self.peak
+            , 'queued': self.queued
+            , 'rejected_by_priority': dict(zip(PRIORITY_NAMES, self.rejected))
+        }
+
+    # process wide gauges for the metrics endpoint
+    def get_gauges(self) -> dict:
+        return {'ffmpeg_processes': self.get_active(), 'ffmpeg_waiting': len(self.waiters)}
+
+    def get_printable(self) -> str:
+        stats = self.get_stats()
+        limit = f' of {stats["max_processes"]}' if stats['max_processes'] else ''
+        active = ', '.join(f'{count} {name}' for name, count in stats['active_by_priority'].items() if count)
+        rejected = ', '.join(f'{count} {name}' for name, count in stats['rejected_by_priority'].items() if count)
+        return f'ffmpeg processes: {stats["active"]}{limit} running ({active or "none"}), peak {stats["peak"]}, {stats["waiting"]} waiting, {stats["queued"]} waited, not started: {rejected or "none"}\n'
@@ -0,0 +1,94 @@
+import os
+import re
+import time
+import logging
+import threading
+import collections
+
+import utils.config as config
+from utils.configure_logger import ConfigureLogger
+
+# retrieve class logger and configure logger
+logger = logging.getLogger('ffmpeg')
+ffmpeg_logger_config = ConfigureLogger(logger=logger)
+
+# directory holding the stderr tail of each stream that ended abnormally
+ffmpeg_tail_directory = os.path.join(os.getcwd(), 'logs', 'ffmpeg')
+FFMPEG_STDERR_LINES = config.get_int('FFMPEG_STDERR_LINES', 200)
+
+# ffmpeg runs with -loglevel level+info so each line carries its level, after the component when there is one
+# e.g. "[error] ..." or "[https @ 0x55d0c8] [error] HTTP error 403 Forbidden"
+LEVEL_PATTERN = re.compile(r'\[(fatal|error|warning|info)\]')
+BITRATE_PATTERN = re.compile(r'bitrate: (\d+) kb/s')
+RECONNECT_PATTERN = re.compile(r'Will reconnect at')
+
+# the output header is written once the input is opened and seeked to the -ss position, before the first frame is decoded
+OUTPUT_PATTERN = re.compile(r'Output #\d+')
+
+# receives one stream's ffmpeg stderr, passed to discord.py as the stderr file object
+# discord.py's reader thread calls write with each chunk read from the pipe
+# the last lines are kept in a bounded ring buffer and key events are counted instead of writing everything to disk
+class FFmpegStderrReader():
+    # seek_position is the -ss position in seconds the stream was started at
+    def __init__(self, name:str='', max_lines:int=FFMPEG_STDERR_LINES, seek_position:float=0):
+        self.name = name
+        self.created_time = time.perf_counter()
+        self.lines = collections.deque(maxlen=max_lines)
+        self.partial = b''
+        self.lock = threading.Lock()
+
+        self.stats = {
+            'bitrate_kbps': None
+            , 'reconnects': 0
+            , 'warnings': 0
+            , 'errors': 0
+            , 'first_frame_ms': None
+            , 'seek_position': seek_position
+            , 'seek_ms': None
+        }
+
+    def write(self, data:bytes):
+        with self.lock:
+            lines = (self.partial + data).split(b'\n')
+            self.partial = lines.pop()
+            for line in lines:
+                self.parse_line(line.decode(errors='replace').rstrip('\r'))
+
+    def parse_line(self, line:str):
+        if not line:
+            return
+
+        self.lines.append(line)
+        level = LEVEL_PATTERN.search(line)
+        if level and level.group(1) in ('fatal', 'error'):
+            self.stats['errors'] += 1
+
+        elif level and level.group(1) == 'warning':
+            self.stats['warnings'] += 1
+
+        if RECONNECT_PATTERN.search(line):
+            self.stats['reconnects'] += 1
+
+        # time ffmpeg took to open the input and seek to the start position
+        if self.stats['seek_position'] and self.stats['seek_ms'] is None and OUTPUT_PATTERN.search(line):
+            self.stats['seek_ms'] = (time.perf_counter() - self.created_time) * 1000
+
+        bitrate = BITRATE_PATTERN.search(line)
+        if bitrate and self.stats['bitrate_kbps'] is None:
+            self.stats['bitrate_kbps'] = int(bitrate.group(1))
+
+    def flush(self):
+        pass
+
+    # writes the ring buffer to its own file, only done for streams that ended abnormally
+    def dump(self, reason:str='') -> str:
+        os.makedirs(ffmpeg_tail_directory, exist_ok=True)
+        path = os.path.join(ffmpeg_tail_directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{self.name}.log')
+        with self.lock:
+            with open(path, 'w', encoding='utf-8') as tail_file:
+                tail_file.write(f'{reason}\n{self.stats}\n')
+                tail_file.write('\n'.join(self.lines))
+                if self.partial:
+                    tail_file.write('\n' + self.partial.decode(errors='replace'))
+
+        return path
@@ -0,0 +1,216 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+import concurrent.futures
+from collections import OrderedDict
+
+from utils.configure_logger import ConfigureLogger
+from entry import AudioMetadata
+
+# retrieve class logger and configure logger
+logger = logging.getLogger('metadata_cache')
+metadata_cache_logger_config = ConfigureLogger(logger=logger)
+
+# matches the expire timestamp signed into googlevideo stream urls
+# appears as a query parameter (expire=123) or a path segment (/expire/123/)
+EXPIRE_PATTERN = re.compile(r'[?&/]expire[=/](\d+)')
+
+# returns the unix time a stream url stops working, or None if the url doesn't say
+def get_url_expiry(url:str='') -> float:
+    match = EXPIRE_PATTERN.search(url or '')
+    return float(match.group(1)) if match else None
+
+# two level cache of yt-dlp results: an in memory LRU in front of a sqlite file that survives restarts
+# maps normalized search queries to flat results and webpage urls to audio metadata tuples
+# writes are batched and committed by the cache's writer thread, reads of the sqlite file belong on an executor
+class MetadataCache():
+    # bump when the audio metadata tuple changes shape so stale rows are ignored
+    CACHE_VERSION = 1
+
+    def __init__(self, path:str='cache/metadata.sqlite3', max_entries:int=1024, query_ttl:float=86400, metadata_ttl:float=21600, expiry_margin:float=600):
+        self.max_entries = max_entries
+        self.query_ttl = query_ttl
+        self.metadata_ttl = metadata_ttl
+        self.expiry_margin = expiry_margin
+
+        # key -> (value, expires at)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # held while the sqlite file is read or written so the memory lookups on the event loop don't wait on the disk
+        self.connection_lock = threading.Lock()
+
+        # key -> (json value, expires at) not written yet, written together by the next flush
+        self.pending = {}
+        self.flush_scheduled = False
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='metadata-cache')
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.writes = 0
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)')
+        self.connection.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+        self.connection.commit()
+
+        logger.info('Metadata cache opened at %s', path)
+
+    # with read_disk=False only the memory is checked and a miss isn't counted, so it can be called on the event loop
+    def get(self, key:str='', read_disk:bool=True):
+        now = time.time()
+        with self.lock:
+            if key in self.entries:
+                value, expires_at = self.entries[key]
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self.entries[key]
+
+            if not read_disk:
+                return None
+
+            # evicted from memory before the writer got to it
+            row = self.pending.get(key)
+
+        if not row:
+            with self.connection_lock:
+                row = self.connection.execute('SELECT value, expires_at FROM cache WHERE key = ? AND expires_at > ?', (key, now)).fetchone()
+
+        with self.lock:
+            if not row or row[1] <= now:
+                self.misses += 1
+                return None
+
+            value = json.loads(row[0])
+            self.remember(key, value, row[1])
+            self.hits += 1
+            self.disk_hits += 1
+            return value
+
+    # keeps the value in memory right away, the row is written by the writer thread
+    def set(self, key:str='', value=None, expires_at:float=0):
+        if value is None or expires_at <= time.time():
+            return
+
+        with self.lock:
+            self.remember(key, value, expires_at)
+            self.pending[key] = (json.dumps(value), expires_at)
+            if self.flush_scheduled:
+                return
+
+            self.flush_scheduled = True
+
+        try:
+            self.executor.submit(self.flush)
+
+        except RuntimeError:
+            logger.warning('Metadata cache closed, not writing %s', key)
+
+    # writes every pending row in one transaction, returns the number of rows written
+    def flush(self) -> int:
+        with self.lock:
+            rows = [(key, value, expires_at) for key, (value, expires_at) in self.pending.items()]
+            self.pending = {}
+            self.flush_scheduled = False
+
+        if not rows:
+            return 0
+
+        with self.connection_lock:
+            try:
+                self.connection.executemany('INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)', rows)
+                self.connection.commit()
+                self.writes += len(rows)
+
+            except sqlite3.Error as e:
+                logger.error('Error writing %s metadata cache rows: %s', len(rows), e)
+                return 0
+
+        return len(rows)
+
+    # keeps the value in memory, evicting the least recently used entries past the limit
+    def remember(self, key:str, value, expires_at:float):
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_query_key(self, content:str='', max_results:int=1) -> str:
+        normalized = ' '.join(content.lower().split())
+        return f'v{self.CACHE_VERSION}:query:{max_results}:{normalized}'
+
+    def get_metadata_key(self, webpage_url:str='') -> str:
+        return f'v{self.CACHE_VERSION}:metadata:{webpage_url}'
+
+    # returns a list of flat audio metadata tuples, or None on a miss
+    def get_query(self, content:str='', max_results:int=1, read_disk:bool=True) -> list[tuple]:
+        flat_metadatas = self.get(self.get_query_key(content, max_results), read_disk)
+        if flat_metadatas is None:
+            return None
+
+        return [tuple(flat_metadata) for flat_metadata in flat_metadatas]
+
+    def set_query(self, content:str='', max_results:int=1, flat_metadatas:list[tuple]=None):
+        if not flat_metadatas:
+            return
+
+        self.set(self.get_query_key(content, max_results), flat_metadatas, time.time() + self.query_ttl)
+
+    # returns an audio metadata tuple, or None on a miss
+    def get_metadata(self, webpage_url:str='', read_disk:bool=True) -> tuple:
+        audio_metadata = self.get(self.get_metadata_key(webpage_url), read_disk)
+        return tuple(audio_metadata) if audio_metadata is not None else None
+
+    # the entry expires a margin before its stream url does so ffmpeg is never given a dead link
+    def set_metadata(self, webpage_url:str='', audio_metadata:tuple=None):
+        if not audio_metadata:
+            return
+
+        expires_at = time.time() + self.metadata_ttl
+        url_expiry = get_url_expiry(audio_metadata[AudioMetadata.URL.value])
+        if url_expiry:
+            expires_at = min(expires_at, url_expiry - self.expiry_margin)
+
+        self.set(self.get_metadata_key(webpage_url), audio_metadata, expires_at)
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits
+            , 'disk_hits': self.disk_hits
+            , 'misses': self.misses
+            , 'hit_rate': self.hits / lookups if lookups else 0
+            , 'memory_entries': len(self.entries)
+            , 'writes': self.writes
+            , 'pending_writes': len(self.pending)
+        }
+
+    # process wide counters and gauges for the metrics endpoint
+    def get_counters(self) -> dict:
+        return {'metadata_cache_hits_total': self.hits, 'metadata_cache_disk_hits_total': self.disk_hits, 'metadata_cache_misses_total': self.misses}
+
+    def get_gauges(self) -> dict:
+        return {'metadata_cache_memory_entries': len(self.entries)}
+
+    def get_printable(self) -> str:
+        stats = self.get_stats()
+        return f'metadata cache: {stats["hits"]} hits ({stats["disk_hits"]} from disk), {stats["misses"]} misses, {stats["hit_rate"]:.0%} hit rate, {stats["memory_entries"]} in memory\n'
+
+    # writes the pending rows before closing the sqlite file
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.flush()
+        logger.info('Closing metadata cache with stats %s', self.get_stats())
+        with self.connection_lock:
+            self.connection.close()
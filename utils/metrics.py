@@ -0,0 +1,234 @@
+import time
+import bisect
+import asyncio
+import logging
+import threading
+
+from utils.configure_logger import ConfigureLogger
+
+# retrieve class logger and configure logger
+logger = logging.getLogger('metrics')
+metrics_logger_config = ConfigureLogger(logger=logger)
+
+# upper bounds in milliseconds, shared by every histogram so they can be compared and summed
+BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+# histogram descriptions, also used as the prometheus HELP lines
+HISTOGRAMS = {
+    'play_resolve_ms': '\\play received to audio metadata resolved'
+    , 'first_frame_ms': 'ffmpeg spawned to the first frame it produced, whether prerolled or played'
+    , 'frame_jitter_ms': 'difference between the time between frame reads and 20ms'
+    , 'track_gap_ms': 'end of a track to the first frame of the next track'
+    , 'command_wait_ms': 'command queued to the command queue starting it'
+}
+
+# counter descriptions
+COUNTERS = {
+    'frames_total': 'frames read from timed audio'
+    , 'underruns_total': 'frame reads that waited on ffmpeg for longer than a frame'
+    , 'urls_refreshed_total': 'queued stream urls resolved again before they expired'
+    , 'failovers_total': 'songs restarted where their stream failed'
+    , 'speculations_total': 'top search results prebuffered while the user chose a result'
+    , 'speculation_hits_total': 'prebuffered search results that were played'
+    , 'commands_total': 'commands accepted into the command queue'
+    , 'commands_coalesced_total': 'commands merged into the command queued before them'
+    , 'commands_rate_limited_total': 'commands dropped by the per user rate limit'
+    , 'commands_rejected_total': 'commands dropped because the command queue was full'
+    , 'ffmpeg_queued_total': 'songs that waited for an ffmpeg process before they started'
+    , 'ffmpeg_rejected_total': 'songs that could not start because no ffmpeg process was available'
+    , 'ffmpeg_deferred_total': 'prefetched, prerolled and prebuffered songs not started to stay within the ffmpeg process budget'
+}
+
+# process wide counter descriptions, their values are read from the functions added with add_counters
+PROCESS_COUNTERS = {
+    'metadata_cache_hits_total': 'searches and songs answered from the metadata cache'
+    , 'metadata_cache_disk_hits_total': 'metadata cache hits read from its sqlite file'
+    , 'metadata_cache_misses_total': 'searches and songs not in the metadata cache'
+    , 'audio_cache_hits_total': 'songs played from a downloaded file'
+    , 'audio_cache_misses_total': 'songs not downloaded yet when they played'
+    , 'audio_cache_bytes_saved_total': 'bytes played from downloaded files instead of streamed'
+    , 'audio_cache_downloads_total': 'songs downloaded into the audio cache'
+    , 'audio_cache_downloads_skipped_total': 'played songs not downloaded because too many downloads were pending'
+    , 'audio_cache_evictions_total': 'downloaded songs deleted to stay within the audio cache size'
+}
+
+# process wide gauge descriptions, their values are read from the functions added with add_gauges
+GAUGES = {
+    'ffmpeg_processes': 'ffmpeg processes running'
+    , 'ffmpeg_waiting': 'songs waiting for an ffmpeg process'
+    , 'metadata_cache_memory_entries': 'metadata cache entries kept in memory'
+    , 'audio_cache_files': 'downloaded songs in the audio cache'
+    , 'audio_cache_bytes': 'bytes of the downloaded songs in the audio cache'
+}
+
+# fixed bucket histogram, observe is called from the voice threads as well as the event loop
+class Histogram():
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value:float):
+        with self.lock:
+            self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    # upper bound of the bucket holding the quantile, the maximum for the last bucket
+    def get_quantile(self, quantile:float) -> float:
+        if not self.count:
+            return 0
+
+        rank = quantile * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[idx], self.max) if idx < len(BUCKETS) else self.max
+
+        return self.max
+
+    # cumulative counts per upper bound, as prometheus expects
+    def get_cumulative_counts(self) -> list[tuple]:
+        cumulative = []
+        seen = 0
+        for bound, count in zip(list(BUCKETS) + ['+Inf'], self.counts):
+            seen += count
+            cumulative.append((bound, seen))
+
+        return cumulative
+
+# timings of one guild, kept when the guild's audio player is recreated
+class GuildMetrics():
+    def __init__(self, guild_id:int=0):
+        self.guild_id = guild_id
+        self.histograms = {name: Histogram() for name in HISTOGRAMS}
+        self.counters = {name: 0 for name in COUNTERS}
+
+    def observe(self, name:str, value:float):
+        self.histograms[name].observe(value)
+
+    # each counter is only incremented from one thread, the frame counters from the guild's voice thread and the command counters from the event loop
+    def increment(self, name:str, value:int=1):
+        self.counters[name] += value
+
+    def get_printable(self) -> str:
+        printable = ''
+        for name, histogram in self.histograms.items():
+            if not histogram.count:
+                printable += f'{name}: no samples\n'
+                continue
+
+            printable += f'{name}: n={histogram.count} avg={histogram.sum / histogram.count:.1f} p50<={histogram.get_quantile(0.5):g} p95<={histogram.get_quantile(0.95):g} max={histogram.max:.1f}\n'
+
+        for name, value in self.counters.items():
+            printable += f'{name}: {value}\n'
+
+        return printable
+
+# guild id -> guild metrics, rendered in the prometheus text format
+class Metrics():
+    PREFIX = 'discord_bot_'
+
+    def __init__(self):
+        self.guilds = {}
+        self.server = None
+        self.counter_functions = []
+        self.gauge_functions = []
+
+    def get_guild(self, guild_id:int=0) -> GuildMetrics:
+        if guild_id not in self.guilds:
+            self.guilds[guild_id] = GuildMetrics(guild_id)
+
+        return self.guilds[guild_id]
+
+    # func returns a dict of counter name -> value, called each time the metrics are rendered
+    def add_counters(self, func):
+        self.counter_functions.append(func)
+
+    # func returns a dict of gauge name -> value, called each time the metrics are rendered
+    def add_gauges(self, func):
+        self.gauge_functions.append(func)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name, description in HISTOGRAMS.items():
+            metric = self.PREFIX + name
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} histogram')
+            for guild_id, guild_metrics in list(self.guilds.items()):
+                histogram = guild_metrics.histograms[name]
+                for bound, count in histogram.get_cumulative_counts():
+                    lines.append(f'{metric}_bucket{{guild="{guild_id}",le="{bound}"}} {count}')
+
+                lines.append(f'{metric}_sum{{guild="{guild_id}"}} {histogram.sum}')
+                lines.append(f'{metric}_count{{guild="{guild_id}"}} {histogram.count}')
+
+        for name, description in COUNTERS.items():
+            metric = self.PREFIX + name
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} counter')
+            for guild_id, guild_metrics in list(self.guilds.items()):
+                lines.append(f'{metric}{{guild="{guild_id}"}} {guild_metrics.counters[name]}')
+
+        for metric_type, descriptions, functions in (('counter', PROCESS_COUNTERS, self.counter_functions), ('gauge', GAUGES, self.gauge_functions)):
+            values = {}
+            for func in functions:
+                values.update(func())
+
+            for name, description in descriptions.items():
+                if name in values:
+                    metric = self.PREFIX + name
+                    lines.append(f'# HELP {metric} {description}')
+                    lines.append(f'# TYPE {metric} {metric_type}')
+                    lines.append(f'{metric} {values[name]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path:str):
+        with open(path, 'w') as metrics_file:
+            metrics_file.write(self.render_prometheus())
+
+        logger.info('Metrics written to %s', path)
+
+    # serves the metrics on http://host:port/metrics for prometheus to scrape
+    async def start_server(self, host:str='127.0.0.1', port:int=9100):
+        if self.server:
+            return
+
+        self.server = await asyncio.start_server(self.handle_request, host, port)
+        logger.info('Serving metrics on %s:%s', host, port)
+
+    async def handle_request(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+
+            if request_line.split(b' ')[1:2] in ([b'/metrics'], [b'/']):
+                status, body = '200 OK', self.render_prometheus()
+
+            else:
+                status, body = '404 Not Found', ''
+
+            body = body.encode()
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+
+        except Exception as e:
+            logger.error('Error serving metrics: %s', e)
+
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+
+# milliseconds since a time.perf_counter() value
+def get_elapsed_ms(start_time:float) -> float:
+    return (time.perf_counter() - start_time) * 1000
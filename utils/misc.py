@@ -1,8 +1,11 @@
-import validators
+import math
+
+from utils.startup_profile import startup_profile
 
 # checks if the input is a valid url
+# validators is imported by the first check, not when the bot starts
 def validate_url(content:str='') -> bool:
-    return validators.url(content) is True
+    return startup_profile.import_module('validators').url(content) is True
 
 # gets the first n words of a string
 def get_first_n_words(content:str='', n:int=1) -> str:
@@ -10,4 +13,33 @@ def get_first_n_words(content:str='', n:int=1) -> str:
 
 # gets the remaining words after the first n words
 def get_words_after_n(content:str='', n:int=0) -> str:
-    return ' '.join(content.split()[n:])
\ No newline at end of file
+    return ' '.join(content.split()[n:])
+
+# parses seconds ("90") or a timestamp ("1:30", "1:02:03") into seconds
+# returns None if the content isn't a time, float() also accepts inf and nan which aren't
+def parse_timestamp(content:str='') -> float:
+    try:
+        seconds = 0
+        for part in content.strip().split(':'):
+            seconds = seconds * 60 + float(part)
+
+    except ValueError:
+        return None
+
+    return seconds if math.isfinite(seconds) else None
+
+# limits value to low and high, a value that isn't finite becomes low
+def clamp(value:float=0, low:float=0, high:float=0) -> float:
+    if not math.isfinite(value):
+        return low
+
+    return min(max(value, low), high)
+
+# formats seconds as a timestamp ("1:30", "1:02:03")
+def format_timestamp(seconds:float=0) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f'{hours}:{minutes:02}:{seconds:02}'
+
+    return f'{minutes}:{seconds:02}'
@@ -0,0 +1,118 @@
+import math
+import logging
+import importlib.util
+
+import discord
+
+from utils.startup_profile import startup_profile
+from utils.configure_logger import ConfigureLogger
+
+# numpy is optional, the effects are unavailable without it and pcm frames pass through untouched
+# it is imported by load_numpy, when the first effect is turned on or in the background after startup
+numpy = None
+
+# retrieve class logger and configure logger
+logger = logging.getLogger('pcm_effects')
+pcm_effects_logger_config = ConfigureLogger(logger=logger)
+
+# one 20ms frame of 48kHz stereo 16 bit pcm, as discord.py reads it from ffmpeg
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+SAMPLE_COUNT = FRAME_SIZE // 2
+
+def is_available() -> bool:
+    return numpy is not None or importlib.util.find_spec('numpy') is not None
+
+def load_numpy():
+    global numpy
+    if numpy is None:
+        numpy = startup_profile.import_module('numpy')
+
+    return numpy
+
+# one guild's volume, loudness normalization and crossfade, applied to the pcm frames of the playing source
+# the settings are changed by commands on the event loop and read by the voice thread
+# only one source of a guild is processed at a time, so the frame buffers are allocated once and reused for every frame
+class EffectsStage():
+    # loudness normalization aims for this frame rms, about -20 dBFS
+    TARGET_RMS = 3277
+
+    # frames quieter than this are silence and don't change the normalization gain
+    SILENCE_RMS = 100
+
+    # limits and smoothing of the normalization gain, so it follows the song's loudness without pumping
+    MIN_GAIN = 0.25
+    MAX_GAIN = 4
+    GAIN_SMOOTHING = 0.02
+
+    def __init__(self, volume:float=1, normalize:bool=False, crossfade:float=0):
+        self.volume = volume
+        self.normalize = normalize
+        self.crossfade = crossfade
+        self.gain = 1
+
+        # allocated by the first frame an effect is applied to, stages of guilds that never turn an effect on don't need numpy
+        self.frame = None
+        if self.is_active():
+            self.allocate()
+
+    # frames are copied into the int16 buffers through byte views and mixed in the float32 buffers
+    # frame is set last, it marks the buffers as allocated
+    def allocate(self):
+        load_numpy()
+        frame = numpy.zeros(SAMPLE_COUNT, dtype=numpy.int16)
+        self.frame_bytes = memoryview(frame).cast('B')
+        self.mix_frame = numpy.zeros(SAMPLE_COUNT, dtype=numpy.int16)
+        self.mix_frame_bytes = memoryview(self.mix_frame).cast('B')
+        self.scratch = numpy.zeros(SAMPLE_COUNT, dtype=numpy.float32)
+        self.mix_scratch = numpy.zeros(SAMPLE_COUNT, dtype=numpy.float32)
+        self.frame = frame
+
+    # sources of a guild with active effects are decoded to pcm instead of passed through as opus
+    def is_active(self) -> bool:
+        return self.volume != 1 or self.normalize or self.crossfade > 0
+
+    # smooths the normalization gain towards the gain that brings the frame in scratch to the target rms
+    def update_gain(self):
+        rms = math.sqrt(float(numpy.dot(self.scratch, self.scratch)) / SAMPLE_COUNT)
+        if rms < self.SILENCE_RMS:
+            return
+
+        target_gain = min(max(self.TARGET_RMS / rms, self.MIN_GAIN), self.MAX_GAIN)
+        self.gain += (target_gain - self.gain) * self.GAIN_SMOOTHING
+
+    # returns the processed frame
+    # mix_data is a frame of the next song faded in over this one, fade goes from 0 to 1 over the crossfade
+    def process(self, data:bytes, mix_data:bytes=None, fade:float=0) -> bytes:
+        if len(data) != FRAME_SIZE:
+            return data
+
+        mixing = mix_data is not None and len(mix_data) == FRAME_SIZE
+        if self.volume == 1 and not self.normalize and not mixing:
+            return data
+
+        if self.frame is None:
+            self.allocate()
+
+        self.frame_bytes[:] = data
+        numpy.copyto(self.scratch, self.frame)
+        if self.normalize:
+            self.update_gain()
+
+        gain = self.volume * (self.gain if self.normalize else 1)
+        numpy.multiply(self.scratch, gain * (1 - fade) if mixing else gain, out=self.scratch)
+
+        if mixing:
+            self.mix_frame_bytes[:] = mix_data
+            numpy.copyto(self.mix_scratch, self.mix_frame)
+            numpy.multiply(self.mix_scratch, gain * fade, out=self.mix_scratch)
+            numpy.add(self.scratch, self.mix_scratch, out=self.scratch)
+
+        numpy.clip(self.scratch, -32768, 32767, out=self.scratch)
+        numpy.copyto(self.frame, self.scratch, casting='unsafe')
+
+        # discord.py's encoder needs bytes, the copy handed to it is the only allocation per frame
+        return self.frame.tobytes()
+
+    def get_printable(self) -> str:
+        normalize = f'on (gain {self.gain:.2f})' if self.normalize else 'off'
+        return f'volume {self.volume:.0%}, normalization {normalize}, crossfade {self.crossfade:g}s'
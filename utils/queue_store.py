@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+from utils.configure_logger import ConfigureLogger
+from entry import Entry
+
+# retrieve class logger and configure logger
+logger = logging.getLogger('queue_store')
+queue_store_logger_config = ConfigureLogger(logger=logger)
+
+# entries are stored as [audio metadata, author id, channel id, content], discord objects are looked up again on restore
+def serialize_entry(entry:Entry) -> list:
+    author, channel, content = entry.message_information
+    return [list(entry.audio_metadata), getattr(author, 'id', author), getattr(channel, 'id', channel), content]
+
+# returns (audio metadata, message information), or None if the entry's text channel no longer exists
+# lookups caches the channels and members found so far, most entries of a queue share them
+def deserialize_entry(row:list, client, guild, lookups:dict=None) -> tuple:
+    audio_metadata, author_id, channel_id, content = row
+    lookups = {} if lookups is None else lookups
+
+    if ('channel', channel_id) not in lookups:
+        lookups[('channel', channel_id)] = client.get_channel(channel_id)
+
+    channel = lookups[('channel', channel_id)]
+    if channel is None:
+        return None
+
+    if ('member', author_id) not in lookups:
+        lookups[('member', author_id)] = guild.get_member(author_id) if guild else None
+
+    return tuple(audio_metadata), (lookups[('member', author_id)] or author_id, channel, content)
+
+# sqlite store of every guild's queue and the position of its playing entry, restored when the bot restarts
+# saves only update pending rows in memory, flush writes them in one transaction off the event loop
+# a guild saved again before the flush replaces its pending row so only the latest snapshot is written
+class QueueStore():
+    # stored as the file's user_version, bump when the serialized entry changes shape
+    # rows saved by another version can't be restored and are dropped when the store opens
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path:str='cache/queues.sqlite3'):
+        # guild id -> row to write, None deletes the guild's row
+        self.pending_queues = {}
+        self.pending_playbacks = {}
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.flush_time = 0
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS queues (guild_id INTEGER PRIMARY KEY, entries TEXT NOT NULL, resume_time REAL NOT NULL, updated_at REAL NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS playbacks (guild_id INTEGER PRIMARY KEY, entry TEXT NOT NULL, position REAL NOT NULL, voice_channel_id INTEGER, updated_at REAL NOT NULL)')
+
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            if version:
+                logger.warning('Dropping the saved queues of schema version %s, expected version %s', version, self.SCHEMA_VERSION)
+                self.connection.execute('DELETE FROM queues')
+                self.connection.execute('DELETE FROM playbacks')
+
+            self.connection.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+
+        self.connection.commit()
+
+        logger.info('Queue store opened at %s', path)
+
+    # entries is a list of serialized entries, resume_time is the position the first entry starts at
+    def save_queue(self, guild_id:int, entries:list, resume_time:float=0):
+        with self.lock:
+            self.pending_queues[guild_id] = (entries, resume_time) if entries else None
+
+    # playback is (serialized entry, position, voice channel id), None once nothing is playing
+    def save_playback(self, guild_id:int, playback:tuple=None):
+        with self.lock:
+            self.pending_playbacks[guild_id] = playback
+
+    # writes every pending row, returns the number of rows written
+    # the write lock is held from taking the pending rows to committing them so flushes can't commit out of order
+    def flush(self) -> int:
+        with self.write_lock:
+            with self.lock:
+                pending_queues, self.pending_queues = self.pending_queues, {}
+                pending_playbacks, self.pending_playbacks = self.pending_playbacks, {}
+
+            if not pending_queues and not pending_playbacks:
+                return 0
+
+            start = time.perf_counter()
+            now = time.time()
+            queue_rows = [(guild_id, json.dumps(queue[0]), queue[1], now) for guild_id, queue in pending_queues.items() if queue]
+            playback_rows = [(guild_id, json.dumps(playback[0]), playback[1], playback[2], now) for guild_id, playback in pending_playbacks.items() if playback]
+            deleted_queues = [(guild_id,) for guild_id, queue in pending_queues.items() if not queue]
+            deleted_playbacks = [(guild_id,) for guild_id, playback in pending_playbacks.items() if not playback]
+
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO queues (guild_id, entries, resume_time, updated_at) VALUES (?, ?, ?, ?)', queue_rows)
+                self.connection.executemany('INSERT OR REPLACE INTO playbacks (guild_id, entry, position, voice_channel_id, updated_at) VALUES (?, ?, ?, ?, ?)', playback_rows)
+                self.connection.executemany('DELETE FROM queues WHERE guild_id = ?', deleted_queues)
+                self.connection.executemany('DELETE FROM playbacks WHERE guild_id = ?', deleted_playbacks)
+
+            rows = len(pending_queues) + len(pending_playbacks)
+            self.flushes += 1
+            self.rows_written += rows
+            self.flush_time += time.perf_counter() - start
+
+        logger.debug('Flushed %s rows in %.1fms', rows, (time.perf_counter() - start) * 1000)
+        return rows
+
+    # returns guild id -> (entries, resume time, playback) for the most recently saved guilds
+    def load_all(self, limit:int=-1) -> dict:
+        self.flush()
+        with self.write_lock:
+            queue_rows = self.connection.execute('SELECT guild_id, entries, resume_time FROM queues ORDER BY updated_at DESC LIMIT ?', (limit,)).fetchall()
+            playback_rows = self.connection.execute('SELECT guild_id, entry, position, voice_channel_id FROM playbacks ORDER BY updated_at DESC LIMIT ?', (limit,)).fetchall()
+
+        saved = {guild_id: (json.loads(entries), resume_time, None) for guild_id, entries, resume_time in queue_rows}
+        for guild_id, entry, position, voice_channel_id in playback_rows:
+            entries, resume_time, _ = saved.get(guild_id, ([], 0, None))
+            saved[guild_id] = (entries, resume_time, (json.loads(entry), position, voice_channel_id))
+
+        return saved
+
+    # returns (entries, resume time, playback) of one guild, including rows that haven't been flushed yet
+    def load(self, guild_id:int) -> tuple:
+        self.flush()
+        with self.write_lock:
+            queue_row = self.connection.execute('SELECT entries, resume_time FROM queues WHERE guild_id = ?', (guild_id,)).fetchone()
+            playback_row = self.connection.execute('SELECT entry, position, voice_channel_id FROM playbacks WHERE guild_id = ?', (guild_id,)).fetchone()
+
+        entries, resume_time = (json.loads(queue_row[0]), queue_row[1]) if queue_row else ([], 0)
+        playback = (json.loads(playback_row[0]), playback_row[1], playback_row[2]) if playback_row else None
+        return entries, resume_time, playback
+
+    def get_stats(self) -> dict:
+        return {
+            'flushes': self.flushes
+            , 'rows_written': self.rows_written
+            , 'avg_flush_ms': self.flush_time * 1000 / self.flushes if self.flushes else 0
+            , 'pending': len(self.pending_queues) + len(self.pending_playbacks)
+        }
+
+    def close(self):
+        self.flush()
+        logger.info('Closing queue store with stats %s', self.get_stats())
+        with self.write_lock:
+            self.connection.close()
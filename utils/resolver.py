@@ -0,0 +1,233 @@
+import time
+import asyncio
+import itertools
+import logging
+import threading
+import weakref
+import concurrent.futures
+
+from utils.ytdlp_pool import YtDlpPool, create_warm_yt_dlp
+from utils.startup_profile import startup_profile
+from utils.metadata_cache import MetadataCache
+from utils.configure_logger import ConfigureLogger
+
+# retrieve class logger and configure logger
+logger = logging.getLogger('resolver')
+resolver_logger_config = ConfigureLogger(logger=logger)
+
+# with a process pool each worker process keeps its own Yt_Dlp instance, thread workers borrow from the YtDlpPool
+_worker_state = threading.local()
+
+def get_worker_yt_dlp():
+    yt_dlp = getattr(_worker_state, 'yt_dlp', None)
+    if yt_dlp is None:
+        yt_dlp = create_warm_yt_dlp()
+        _worker_state.yt_dlp = yt_dlp
+
+    return yt_dlp
+
+# module level functions so they can be pickled and sent to a process pool
+def search(content:str='', max_results:int=1) -> list[tuple]:
+    return get_worker_yt_dlp().search(content, max_results)
+
+def extract(url:str='') -> tuple:
+    return get_worker_yt_dlp().extract(url)
+
+# reads one playlist's listing page by page, each page continues the listing where the previous page stopped
+# keeps its own Yt_Dlp for the whole import since the listing is read across several requests
+# pages are read on a worker thread, close is called from the event loop and never waits on a page being read
+class PlaylistReader():
+    def __init__(self, url:str=''):
+        self.url = url
+        self.title = url
+        self.yt_dlp = None
+        self.entries = None
+
+        # a page still being read when the reader is closed, e.g. after its request timed out, closes the instance itself
+        self.lock = threading.Lock()
+        self.reading = False
+        self.closed = False
+
+    # returns (playlist title, flat audio metadata tuples of the next count entries), fewer once the listing ends
+    # stops at the next entry once the reader is closed
+    def read_page(self, count:int=100) -> tuple:
+        with self.lock:
+            if self.closed:
+                return self.title, []
+
+            if self.reading:
+                raise RuntimeError(f'a page of {self.url} is still being read')
+
+            self.reading = True
+
+        flat_metadatas = []
+        try:
+            if self.entries is None:
+                self.yt_dlp = startup_profile.import_module('utils.ytdlp').Yt_Dlp(noplaylist=False)
+                title, self.entries = self.yt_dlp.open_playlist(self.url)
+                self.title = title or self.url
+
+            for flat_metadata in itertools.islice(self.entries, count):
+                flat_metadatas.append(flat_metadata)
+                if self.closed:
+                    break
+
+        finally:
+            with self.lock:
+                self.reading = False
+                closed = self.closed
+
+            if closed:
+                self.close_yt_dlp()
+
+        logger.info('Playlist "%s" retrieved %s entries', self.title, len(flat_metadatas))
+        return self.title, flat_metadatas
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.reading:
+                return
+
+        self.close_yt_dlp()
+
+    def close_yt_dlp(self):
+        if self.yt_dlp:
+            self.yt_dlp.close()
+            self.yt_dlp = None
+
+# runs blocking yt-dlp calls on an executor so the event loop keeps running
+# one resolver per client, shared by every guild's audio player
+class Resolver():
+    def __init__(self, max_workers:int=8, max_concurrent:int=8, max_concurrent_per_guild:int=5, timeout:float=20, use_processes:bool=False, cache:MetadataCache=None, pool_size:int=None, warm:bool=True):
+        self.timeout = timeout
+        self.cache = cache
+        self.max_concurrent_per_guild = max_concurrent_per_guild
+
+        # worker processes warm their own instance when they start
+        # worker threads share a pool of instances that is warmed in the background
+        self.pool = None
+        if use_processes:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=get_worker_yt_dlp)
+
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='resolver')
+            self.pool = YtDlpPool(pool_size or max_workers)
+
+        # without warm the instances are created by warm() or by the first requests
+        if warm:
+            self.warm()
+
+        # global limit across all guilds and a limit per guild so one guild can't use every worker
+        # guild semaphores are dropped once no request holds them
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.guild_semaphores = weakref.WeakValueDictionary()
+
+        logger.info('Resolver started with %s %s workers', max_workers, "process" if use_processes else "thread")
+
+    # imports yt-dlp and loads its extractors in the background
+    # starts the worker processes, which warm their instance in the initializer
+    def warm(self):
+        if self.pool:
+            self.executor.submit(self.pool.warm)
+
+        else:
+            self.executor.submit(int)
+
+    def get_guild_semaphore(self, guild_id:int) -> asyncio.Semaphore:
+        semaphore = self.guild_semaphores.get(guild_id)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrent_per_guild)
+            self.guild_semaphores[guild_id] = semaphore
+
+        return semaphore
+
+    # runs func on the executor, raises asyncio.TimeoutError if it takes longer than the timeout
+    # cancelling the awaiting task releases the guild's slot right away, the worker finishes in the background
+    # with the thread pool func is called as the method of the same name on an instance lent by the pool
+    # pooled=False calls func itself on a worker thread, for work that keeps its own instance
+    async def run(self, guild_id:int, func, *args, pooled:bool=True):
+        queued_time = time.perf_counter()
+        guild_semaphore = self.get_guild_semaphore(guild_id)
+        async with guild_semaphore:
+            async with self.semaphore:
+                loop = asyncio.get_running_loop()
+                if not pooled:
+                    future = loop.run_in_executor(self.executor if self.pool else None, func, *args)
+
+                elif self.pool:
+                    future = loop.run_in_executor(self.executor, self.pool.call, queued_time, func.__name__, *args)
+
+                else:
+                    future = loop.run_in_executor(self.executor, func, *args)
+
+                try:
+                    return await asyncio.wait_for(future, timeout=self.timeout)
+
+                except asyncio.TimeoutError:
+                    logger.warning('%s%s timed out after %ss in guild %s', func.__name__, args, self.timeout, guild_id)
+                    raise
+
+    # answers from the cache's memory on the event loop, reading its sqlite file on the default executor on a memory miss
+    async def get_cached(self, func, *args):
+        value = func(*args, read_disk=False)
+        if value is not None:
+            return value
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    # returns a list of flat audio metadata tuples without stream urls
+    async def search(self, guild_id:int, content:str='', max_results:int=1) -> list[tuple]:
+        if self.cache:
+            flat_metadatas = await self.get_cached(self.cache.get_query, content, max_results)
+            if flat_metadatas is not None:
+                logger.info('Cache hit for search "%s"', content)
+                return flat_metadatas
+
+        flat_metadatas = await self.run(guild_id, search, content, max_results)
+        if self.cache:
+            self.cache.set_query(content, max_results, flat_metadatas)
+
+        return flat_metadatas
+
+    # returns the full audio metadata tuple of a webpage url
+    # use_cache=False skips the cached metadata, e.g. when its stream url stopped working
+    async def extract(self, guild_id:int, url:str='', use_cache:bool=True) -> tuple:
+        if self.cache and use_cache:
+            audio_metadata = await self.get_cached(self.cache.get_metadata, url)
+            if audio_metadata is not None:
+                logger.info('Cache hit for %s', url)
+                return audio_metadata
+
+        audio_metadata = await self.run(guild_id, extract, url)
+        if self.cache:
+            self.cache.set_metadata(url, audio_metadata)
+
+        return audio_metadata
+
+    # returns (playlist title, flat audio metadata tuples) of the reader's next page
+    # the reader can't be sent to a worker process, it runs on a worker thread either way
+    async def read_playlist_page(self, guild_id:int, reader:PlaylistReader, count:int=100) -> tuple:
+        return await self.run(guild_id, reader.read_page, count, pooled=False)
+
+    # starts extracting every url at once, returns one task per url in the same order
+    # await a task to get its audio metadata, cancel the tasks that are no longer needed
+    def extract_all(self, guild_id:int, urls:list[str]) -> list[asyncio.Task]:
+        return [asyncio.create_task(self.extract(guild_id, url)) for url in urls]
+
+    # yields (index, task) for each task in the order the tasks finish
+    @staticmethod
+    async def iter_completed(tasks:list[asyncio.Task]):
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield tasks.index(task), task
+
+    def shutdown(self):
+        logger.info('Shutting down resolver with pool stats %s', self.pool.get_stats() if self.pool else None)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+        if self.cache:
+            self.cache.close()
@@ -0,0 +1,77 @@
+import sys
+import json
+import time
+import importlib
+import contextlib
+
+# time.perf_counter() of when the process started importing the bot, main imports this module first
+START_TIME = time.perf_counter()
+
+# records how long each step of the startup took, from the first import to on_ready
+# heavy modules imported on first use record their import here too, so deferred imports show up when they are paid for
+class StartupProfile():
+    def __init__(self, start_time:float=START_TIME):
+        self.start_time = start_time
+
+        # (name, seconds since start, duration in seconds), in the order they ended
+        self.phases = []
+        self.ready_time = None
+
+    @contextlib.contextmanager
+    def measure(self, name:str):
+        start = time.perf_counter()
+        try:
+            yield
+
+        finally:
+            end = time.perf_counter()
+            self.phases.append((name, start - self.start_time, end - start))
+
+    # records a point of the startup without a duration
+    def mark(self, name:str):
+        self.phases.append((name, time.perf_counter() - self.start_time, 0))
+
+    # imports a module, recording how long the import took if it wasn't imported yet
+    def import_module(self, name:str):
+        if name in sys.modules:
+            return sys.modules[name]
+
+        with self.measure(f'import {name}'):
+            return importlib.import_module(name)
+
+    # returns False if the bot was ready before
+    def set_ready(self) -> bool:
+        if self.ready_time is not None:
+            return False
+
+        self.mark('ready')
+        self.ready_time = time.perf_counter() - self.start_time
+        return True
+
+    def get_stats(self) -> dict:
+        return {
+            'ready_ms': self.ready_time * 1000 if self.ready_time is not None else None
+            , 'phases': [
+                {'name': name, 'at_ms': offset * 1000, 'duration_ms': duration * 1000}
+                for name, offset, duration in self.phases
+            ]
+        }
+
+    def get_printable(self) -> str:
+        printable = f'startup profile, ready after {self.ready_time * 1000:.1f}ms\n' if self.ready_time is not None else 'startup profile, not ready yet\n'
+        for name, offset, duration in self.phases:
+            took = f'took {duration * 1000:8.1f}ms' if duration else ''
+            printable += f'  at {offset * 1000:8.1f}ms  {took:<18} {name}\n'
+
+        return printable
+
+    # appends the profile as one json line, one line per start to compare startups over time
+    def dump(self, path:str):
+        stats = self.get_stats()
+        stats['time'] = time.time()
+        stats['python'] = sys.version.split()[0]
+        with open(path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(stats) + '\n')
+
+# the profile of this process
+startup_profile = StartupProfile()
@@ -1,34 +1,240 @@
 import discord
 import os
+import time
+import threading
+import collections
 
-# configure stderr and ffmpeg path for discord.py
-ffmpeg_stderr_path = os.path.join(os.getcwd(), 'logs', 'ffmpeg.log')
+from utils.ffmpeg_stderr import FFmpegStderrReader, logger
+from utils.ffmpeg_budget import FFmpegBudget, PLAYING
+
+# configure ffmpeg path for discord.py
 ffmpeg_path = os.path.join(os.getcwd(), 'bin', 'ffmpeg')
 
-# create child class of discord.py Client
-# one timed FFmpegPCMAudio instance per audio
-class TimedAudio(discord.FFmpegPCMAudio):
-    def __init__(self, source:str='', start_time:int=0):
+# codecs ffmpeg can copy into discord's opus packets without decoding
+OPUS_CODECS = ('opus', 'libopus')
+
+# shared timing and preroll behaviour for the ffmpeg audio sources
+# must come before the discord.py class in the bases so read is wrapped
+class TimedAudioMixin():
+    def init_timed_audio(self, source:str='', start_time:int=0):
+        self.input_source = source
         self.start_time = start_time
         self.elapsed_time = 0
-        self.ffmpeg_stderr_file = open(ffmpeg_stderr_path, 'w')
+        self.spawn_time = time.perf_counter()
+        self.cleaned_up = False
+
+        # set once ffmpeg's output ran out, as opposed to the source being stopped
+        self.ended = False
+
+        # each stream's stderr goes to its own in memory reader instead of a shared log file
+        self.stderr_reader = FFmpegStderrReader(f'{os.getpid()}-{id(self):x}', seek_position=start_time)
+
+        # frames read ahead of time by preroll, served before reading from ffmpeg
+        self.preroll_buffer = collections.deque()
+        self.read_lock = threading.Lock()
+
+        # called with the time.perf_counter() of the first frame read for playback, which may be long after ffmpeg produced it
+        self.on_first_frame = None
+        self.first_frame_time = None
+
+        # guild metrics the read timings are recorded to, None to skip recording
+        self.metrics = None
+        self.last_read_time = None
+
+        # the guild's pcm effects stage, None to pass frames through untouched
+        # the next song's source is mixed in from crossfade_start (seconds) over crossfade_length seconds
+        self.effects = None
+        self.crossfade_source = None
+        self.crossfade_start = 0
+        self.crossfade_length = 0
+
+        # the budget counting this source's ffmpeg process, None if it isn't counted
+        self.budget = None
+
+    # reconnect options only apply to network streams, local files from the audio cache don't need them
+    def is_remote(self) -> bool:
+        return self.input_source.startswith(('http://', 'https://'))
 
-        ffmpeg_options = {
-                'executable': ffmpeg_path
-                , 'stderr': self.ffmpeg_stderr_file
-                , 'before_options': f'-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -loglevel debug  -ss {self.start_time}'
-                , 'options': '-vn'
-                }
+    def get_ffmpeg_options(self) -> dict:
+        # rw_timeout (microseconds) makes a stalled connection fail instead of blocking the read forever
+        reconnect_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -rw_timeout 15000000 ' if self.is_remote() else ''
+        # the log level goes in the output options so it comes after (and overrides) the one FFmpegOpusAudio adds
+        return {
+            'executable': ffmpeg_path
+            , 'stderr': self.stderr_reader
+            , 'before_options': f'{reconnect_options}-ss {self.start_time}'
+            , 'options': '-vn -loglevel level+info'
+            }
 
-        super().__init__(source=source, **ffmpeg_options)
+    # a stream ended abnormally if ffmpeg exited with an error code on its own or logged errors
+    def is_abnormal(self) -> bool:
+        process = getattr(self, '_process', None)
+        returncode = process.poll() if process else None
+        return bool(returncode) or self.stderr_reader.stats['errors'] > 0
+
+    # whether ffmpeg's output ran out because the stream failed, waits for ffmpeg to exit so its return code is set
+    # called from the after function on the voice thread, before the source is cleaned up
+    def ended_abnormally(self, timeout:float=1) -> bool:
+        if not self.ended:
+            return False
+
+        process = getattr(self, '_process', None)
+        if process:
+            try:
+                process.wait(timeout=timeout)
+
+            except Exception:
+                pass
+
+        return self.is_abnormal()
 
     def cleanup(self):
-        self.ffmpeg_stderr_file.close()
+        if self.cleaned_up:
+            return
+
+        # check before cleaning up since killing ffmpeg sets its return code
+        self.cleaned_up = True
+        abnormal = self.is_abnormal()
         super().cleanup()
+        if self.budget:
+            self.budget.remove(self)
+
+        logger.info('Stream %s ended with stats %s', self.stderr_reader.name, self.stderr_reader.stats)
+        if abnormal:
+            path = self.stderr_reader.dump(f'source: {self.input_source}\nstart time: {self.start_time}\nelapsed time: {self.get_elapsed_time()}')
+            logger.warning('Stream %s ended abnormally, stderr tail written to %s', self.stderr_reader.name, path)
 
+    # each read returns one 20ms frame, pcm or an opus packet
     def read(self) -> bytes:
-        self.elapsed_time += 20
-        return super().read()
+        data = self.read_frame()
+        if self.effects and data and not self.is_opus():
+            data = self.process_effects(data)
+
+        return data
+
+    # fades the next song's source in over the end of this one
+    # the next source keeps its position, so it continues from the end of the crossfade once it plays
+    def start_crossfade(self, source, start:float, length:float):
+        self.crossfade_start = start
+        self.crossfade_length = length
+        self.crossfade_source = source
+
+    def process_effects(self, data:bytes) -> bytes:
+        source = self.crossfade_source
+        if not source or source.cleaned_up or self.get_elapsed_time() < self.crossfade_start:
+            return self.effects.process(data)
+
+        # this source ends once the next one is fully faded in, the next one plays on from there
+        fade = (self.get_elapsed_time() - self.crossfade_start) / self.crossfade_length
+        if fade >= 1:
+            return b''
+
+        try:
+            mix_data = source.read_frame()
+
+        except Exception as e:
+            logger.error('Error reading crossfade source %s: %s', source.stderr_reader.name, e)
+            self.crossfade_source = None
+            return self.effects.process(data)
+
+        return self.effects.process(data, mix_data, fade)
+
+    # reads one frame, from the preroll buffer first, and records its timings
+    def read_frame(self) -> bytes:
+        with self.read_lock:
+            read_time = time.perf_counter()
+            if self.first_frame_time is None:
+                self.first_frame_time = read_time
+                if self.on_first_frame:
+                    self.on_first_frame(self.first_frame_time)
+
+            self.elapsed_time += 20
+            if self.preroll_buffer:
+                data = self.preroll_buffer.popleft()
+
+            else:
+                data = self.read_source()
+                if not data:
+                    self.ended = True
+
+            if self.metrics:
+                self.record_read(read_time)
+
+            return data
+
+    # reads a frame from ffmpeg, recording how long ffmpeg took to produce its first one
+    # prefetched sources produce it when they are prerolled, not when they start playing
+    def read_source(self) -> bytes:
+        data = super().read()
+        if data and self.stderr_reader.stats['first_frame_ms'] is None:
+            self.stderr_reader.stats['first_frame_ms'] = (time.perf_counter() - self.spawn_time) * 1000
+            if self.metrics:
+                self.metrics.observe('first_frame_ms', self.stderr_reader.stats['first_frame_ms'])
+
+        return data
+
+    # discord.py reads a frame every 20ms, jitter is how far off the time since the previous read is
+    # an underrun is a read that waited on ffmpeg for longer than a frame, gaps over a second are pauses
+    def record_read(self, read_time:float):
+        now = time.perf_counter()
+        if self.last_read_time is not None:
+            interval = (read_time - self.last_read_time) * 1000
+            if interval < 1000:
+                self.metrics.observe('frame_jitter_ms', abs(interval - 20))
+
+            if (now - read_time) * 1000 > 20:
+                self.metrics.increment('underruns_total')
+
+        self.metrics.increment('frames_total')
+        self.last_read_time = read_time
+
+    # blocks until frame_count frames are read from ffmpeg into memory
+    # run it before the audio plays so the first frames are ready immediately
+    def preroll(self, frame_count:int=50) -> int:
+        with self.read_lock:
+            while len(self.preroll_buffer) < frame_count:
+                data = self.read_source()
+                if not data:
+                    break
+
+                self.preroll_buffer.append(data)
+
+            return len(self.preroll_buffer)
     
     def get_elapsed_time(self):
-        return self.elapsed_time / 1000 + self.start_time
\ No newline at end of file
+        return self.elapsed_time / 1000 + self.start_time
+
+    # the source running the ffmpeg process this source reads from
+    def get_process_source(self):
+        return self
+
+# create child class of discord.py FFmpegPCMAudio
+# ffmpeg decodes to pcm and discord.py encodes each frame to opus
+# one timed FFmpegPCMAudio instance per audio
+class TimedAudio(TimedAudioMixin, discord.FFmpegPCMAudio):
+    def __init__(self, source:str='', start_time:int=0):
+        self.init_timed_audio(source, start_time)
+        super().__init__(source=source, **self.get_ffmpeg_options())
+
+# create child class of discord.py FFmpegOpusAudio
+# opus streams are remuxed by ffmpeg (-c:a copy) and sent as is, other codecs are encoded to opus by ffmpeg
+class TimedOpusAudio(TimedAudioMixin, discord.FFmpegOpusAudio):
+    def __init__(self, source:str='', start_time:int=0, codec:str=None):
+        self.init_timed_audio(source, start_time)
+        super().__init__(source=source, codec=codec, **self.get_ffmpeg_options())
+
+# returns an opus passthrough source when the stream is already opus, otherwise falls back to transcoding
+# codec is the audio codec yt-dlp reported for the stream, None if unknown
+# the source's process is counted by budget at priority until the source is cleaned up
+def create_timed_audio(source:str='', start_time:int=0, codec:str=None, passthrough:bool=True, budget:FFmpegBudget=None, priority:int=PLAYING) -> TimedAudioMixin:
+    if passthrough and codec in OPUS_CODECS:
+        timed_audio = TimedOpusAudio(source, start_time, codec=codec)
+
+    else:
+        timed_audio = TimedAudio(source, start_time)
+
+    if budget:
+        budget.add(timed_audio, priority)
+        timed_audio.budget = budget
+
+    return timed_audio
@@ -9,11 +9,14 @@ logger = logging.getLogger('ytdl')
 ytdl_manager_logger_config = ConfigureLogger(logger=logger)
 
 class Yt_Dlp(yt_dlp.YoutubeDL):
-    def __init__(self):
+    # urls that point at another extractor followed when opening a playlist
+    MAX_PLAYLIST_REDIRECTS = 3
+
+    def __init__(self, noplaylist:bool=True):
         ytdl_options = {
                 'format': 'bestaudio/best'
                 , 'default_search': 'auto'
-                , 'noplaylist': True
+                , 'noplaylist': noplaylist
                 , 'extract_flat': True
                 , 'force_generic_extractor': False
                 , 'logger': logger
@@ -21,24 +24,55 @@ class Yt_Dlp(yt_dlp.YoutubeDL):
         
         super().__init__(ytdl_options)
 
-    # returns a list of audio metadata tuples
-    def retrieve(self, content:str='', max_results:int=1) -> list[tuple]:
-        logger.info(f'Searching and retrieving {content}')
+    # returns a list of flat audio metadata tuples from a single search request
+    # the stream urls are not resolved yet, use extract on each webpage url
+    def search(self, content:str='', max_results:int=1) -> list[tuple]:
+        logger.info('Searching %s', content)
 
         results = self.extract_info(f'ytsearch{max_results}:{content}', download=False)
         entries = results['entries']
 
-        logger.info(f'Search query "{content}" retrieved, filtering info')
+        logger.info('Search query "%s" retrieved %s entries', content, len(entries))
+        return [AudioMetadata.retrieve_flat_audio_metadata(entry) for entry in entries]
+
+    # returns the full audio metadata tuple of a webpage url
+    def extract(self, url:str='') -> tuple:
+        logger.info('extracting entry from %s', url)
+
+        entry = self.extract_info(url, download=False)
+        entry_metadata = AudioMetadata.retrieve_audio_metadata(entry)
+        logger.info('retrieved metadata:\n%s', entry_metadata)
+
+        return entry_metadata
+
+    # downloads the audio of a webpage url to outtmpl, returns the path of the downloaded file
+    # the output template is only changed for this call, pooled instances are lent to one request at a time
+    def download_audio(self, url:str='', outtmpl:str='') -> str:
+        logger.info('Downloading %s', url)
+
+        previous_outtmpl = self.params['outtmpl']
+        self.params['outtmpl'] = {'default': outtmpl}
+        try:
+            info = self.extract_info(url, download=True)
+            return self.prepare_filename(info)
+
+        finally:
+            self.params['outtmpl'] = previous_outtmpl
+
+    # returns (playlist title, iterator of flat audio metadata tuples)
+    # the listing isn't processed, its pages are fetched as the iterator is consumed, each only once
+    # a url of a single video returns that video as the only entry
+    def open_playlist(self, url:str='') -> tuple:
+        logger.info('Opening playlist %s', url)
+
+        info = self.extract_info(url, download=False, process=False)
+        for _ in range(self.MAX_PLAYLIST_REDIRECTS):
+            if info.get('_type') not in ('url', 'url_transparent'):
+                break
 
-        queried_info = []
-        for initial_entry in entries:
-            url = initial_entry['webpage_url']
-            logger.info(f'extracting entry from {url}')
+            info = self.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
 
-            entry = self.extract_info(url, download=False)
-            entry_metadata = AudioMetadata.retrieve_audio_metadata(entry)
-            logger.info(f'retrieved metadata:\n{entry_metadata}')
-            
-            queried_info.append(entry_metadata)
+        if 'entries' not in info:
+            return info.get('title'), iter([AudioMetadata.retrieve_flat_audio_metadata(info)])
 
-        return queried_info
\ No newline at end of file
+        return info.get('title'), (AudioMetadata.retrieve_flat_audio_metadata(entry) for entry in info['entries'] if entry)
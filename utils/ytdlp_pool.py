@@ -0,0 +1,124 @@
+import time
+import queue
+import logging
+import threading
+import contextlib
+
+from utils.startup_profile import startup_profile
+from utils.configure_logger import ConfigureLogger
+
+# retrieve class logger and configure logger
+logger = logging.getLogger('ytdl_pool')
+ytdl_pool_logger_config = ConfigureLogger(logger=logger)
+
+# extractors used by searches and url extraction, instantiated ahead of time by warm
+WARM_EXTRACTORS = ('Youtube', 'YoutubeSearch', 'Generic')
+
+# creates a Yt_Dlp and loads the extractors it will use so its first request doesn't pay for them
+# yt-dlp is imported by the first instance, not when the bot starts
+def create_warm_yt_dlp():
+    yt_dlp = startup_profile.import_module('utils.ytdlp').Yt_Dlp()
+    for extractor in WARM_EXTRACTORS:
+        yt_dlp.get_info_extractor(extractor)
+
+    return yt_dlp
+
+# usage of one pooled instance
+class PooledYtDlp():
+    def __init__(self, idx:int):
+        self.idx = idx
+        self.yt_dlp = create_warm_yt_dlp()
+        self.created_time = time.perf_counter()
+        self.uses = 0
+        self.busy_time = 0
+
+    def get_utilization(self) -> float:
+        uptime = time.perf_counter() - self.created_time
+        return self.busy_time / uptime if uptime else 0
+
+# process wide pool of warm Yt_Dlp instances shared by every guild
+# a YoutubeDL instance is not safe to share between threads, so each request borrows one for its duration
+# requests wait for an instance when every instance is lent out
+class YtDlpPool():
+    def __init__(self, size:int=8):
+        self.size = size
+        self.instances = []
+
+        # most recently returned instance is lent first
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+        self.lends = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    # creates an instance unless the pool is full, returns None if it is
+    def create_instance(self) -> PooledYtDlp:
+        with self.lock:
+            if len(self.instances) >= self.size:
+                return None
+
+            idx = len(self.instances)
+            self.instances.append(None)
+
+        instance = PooledYtDlp(idx)
+        self.instances[idx] = instance
+        return instance
+
+    # fills the pool, run at startup in the background so the first requests find warm instances
+    def warm(self):
+        start = time.perf_counter()
+        while True:
+            instance = self.create_instance()
+            if not instance:
+                break
+
+            self.idle.put(instance)
+
+        logger.info('Warmed %s yt-dlp instances in %.1fms', self.size, (time.perf_counter() - start) * 1000)
+
+    # lends an instance for the duration of the with block
+    # queued_time is the time.perf_counter() of when the request was made, to measure its wait
+    @contextlib.contextmanager
+    def lend(self, queued_time:float=None):
+        try:
+            instance = self.idle.get_nowait()
+
+        except queue.Empty:
+            instance = self.create_instance() or self.idle.get()
+
+        lent_time = time.perf_counter()
+        wait = lent_time - (queued_time or lent_time)
+        with self.lock:
+            self.lends += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+        try:
+            yield instance.yt_dlp
+
+        finally:
+            instance.uses += 1
+            instance.busy_time += time.perf_counter() - lent_time
+            self.idle.put(instance)
+
+    # calls a Yt_Dlp method on a lent instance
+    def call(self, queued_time:float, method:str, *args):
+        with self.lend(queued_time) as yt_dlp:
+            return getattr(yt_dlp, method)(*args)
+
+    def get_stats(self) -> dict:
+        return {
+            'lends': self.lends
+            , 'avg_wait_ms': self.total_wait * 1000 / self.lends if self.lends else 0
+            , 'max_wait_ms': self.max_wait * 1000
+            , 'instances': [
+                {'uses': instance.uses, 'utilization': instance.get_utilization()}
+                for instance in self.instances if instance
+            ]
+        }
+
+    def get_printable(self) -> str:
+        stats = self.get_stats()
+        utilizations = ' '.join(f'{instance["utilization"]:.0%}' for instance in stats['instances'])
+        return f'yt-dlp pool: {stats["lends"]} requests, wait avg {stats["avg_wait_ms"]:.1f}ms max {stats["max_wait_ms"]:.1f}ms, utilization {utilizations or "n/a"}\n'